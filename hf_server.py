@@ -1,9 +1,12 @@
 import base64
 import json
 import io
+import time
+from threading import Thread, Event
 from typing import List, Optional, Dict, Any, Union
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from PIL import Image
 import uvicorn
@@ -11,6 +14,7 @@ import argparse
 from wlm.encoder.siglip_encoder import SiglipEncoder
 import types
 import torch
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 from wlm.processing_wlm import ProcessWLM
 from wlm.modeling_rwkv7_wlm import RWKV7VLForConditionalGeneration  
 
@@ -137,6 +141,57 @@ def convert_messages(messages_obj):
     return messages_dict
 
 
+def sse_chunk(chunk_id: str, created: int, model_name: str, delta: Dict[str, str], finish_reason: Optional[str] = None) -> str:
+    chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model_name,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+class Generation(StoppingCriteria):
+    # 在后台线程中运行 model.generate: 出错时记录异常, 无论如何都结束 streamer; cancel() 在下一个 token 处停止解码
+    def __init__(self, streamer: TextIteratorStreamer, gen_kwargs: Dict[str, Any]):
+        self.streamer = streamer
+        self.gen_kwargs = dict(gen_kwargs, streamer=streamer, stopping_criteria=StoppingCriteriaList([self]))
+        self.error = None
+        self.cancelled = Event()
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        try:
+            model.generate(**self.gen_kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.streamer.end()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def stream_chat(gen: Generation, chunk_id: str, created: int, model_name: str):
+    # TextIteratorStreamer 只在完整字符/单词处输出, 不会切断 UTF-8 多字节序列
+    try:
+        yield sse_chunk(chunk_id, created, model_name, {"role": "assistant", "content": ""})
+        for piece in gen.streamer:
+            if piece:
+                yield sse_chunk(chunk_id, created, model_name, {"content": piece})
+        if gen.error is not None:
+            yield f"data: {json.dumps({'error': {'message': str(gen.error)}}, ensure_ascii=False)}\n\n"
+        else:
+            yield sse_chunk(chunk_id, created, model_name, {}, "stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        gen.cancel() # 客户端断开时停止解码
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 async def chat_completions(request: ChatCompletionRequest):
     global current_state, first_question
@@ -153,7 +208,7 @@ async def chat_completions(request: ChatCompletionRequest):
         text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
         images = [[image]]#processor.process_images(messages)
         inputs = processor(text=text, images=images).to('cuda')
-        generated_ids = model.generate(
+        gen_kwargs = dict(
             **inputs,
             max_new_tokens=512,
             do_sample=True,
@@ -161,6 +216,13 @@ async def chat_completions(request: ChatCompletionRequest):
             top_p=0.3,
             repetition_penalty=1.2
         )
+        if request.stream:
+            streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=False)
+            gen = Generation(streamer, gen_kwargs).start()
+            return StreamingResponse(stream_chat(gen, f"chatcmpl-{int(time.time())}", int(time.time()), request.model),
+                                     media_type="text/event-stream")
+
+        generated_ids = model.generate(**gen_kwargs)
         generated_ids = [
             output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, generated_ids)
         ]
@@ -171,7 +233,6 @@ async def chat_completions(request: ChatCompletionRequest):
 
         final_response = bot_response
 
-        import time
         response = ChatCompletionResponse(
             id=f"chatcmpl-{int(time.time())}",
             created=int(time.time()),
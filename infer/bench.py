@@ -0,0 +1,729 @@
+########################################################################################################
+# CPU benchmarks / parity checks for the inference engine, on a tiny random RWKV-7 checkpoint
+#
+#   RWKV_CUDA_ON=0 python -m infer.bench batch
+#   RWKV_CUDA_ON=0 python -m infer.bench engine
+#   RWKV_CUDA_ON=0 python -m infer.bench prefix
+#   RWKV_CUDA_ON=0 python -m infer.bench state_io
+#   RWKV_CUDA_ON=0 python -m infer.bench state_quant
+#   RWKV_CUDA_ON=0 python -m infer.bench wkv
+#   RWKV_CUDA_ON=0 python -m infer.bench quant    (RWKV_CUDA_ON=1 on a GPU for the mmq_one kernel)
+#   RWKV_CUDA_ON=0 python -m infer.bench fused
+#   RWKV_CUDA_ON=0 python -m infer.bench profile
+#   RWKV_CUDA_ON=0 python -m infer.bench sample
+#   RWKV_CUDA_ON=0 python -m infer.bench penalty
+#   RWKV_CUDA_ON=0 python -m infer.bench detok
+#   RWKV_CUDA_ON=0 python -m infer.bench tokenizer
+#   RWKV_CUDA_ON=0 python -m infer.bench vocab_cache
+#   RWKV_CUDA_ON=0 python -m infer.bench prompt
+#   RWKV_CUDA_ON=0 python -m infer.bench chunked
+#   RWKV_CUDA_ON=0 python -m infer.bench encoder_batch
+#   RWKV_CUDA_ON=0 python -m infer.bench preprocess
+########################################################################################################
+
+import os, time, argparse
+os.environ.setdefault("RWKV_CUDA_ON", '0')
+import torch
+
+def tiny_rwkv7_weights(n_layer=2, n_embd=128, vocab_size=65536, head_size=64, seed=0):
+    """
+    Random RWKV-7 state dict in the training `.pth` layout (what `RWKV(model=...)` expects).
+    """
+    g = torch.Generator().manual_seed(seed)
+    def rnd(*shape, scale=0.1):
+        return torch.randn(*shape, generator=g) * scale
+    C, H, D = n_embd, n_embd // head_size, 32
+    z = {
+        'emb.weight': rnd(vocab_size, C, scale=1.0),
+        'blocks.0.ln0.weight': 1 + rnd(C), 'blocks.0.ln0.bias': rnd(C),
+        'ln_out.weight': 1 + rnd(C), 'ln_out.bias': rnd(C),
+        'head.weight': rnd(vocab_size, C),
+    }
+    for i in range(n_layer):
+        att, ffn = f'blocks.{i}.att.', f'blocks.{i}.ffn.'
+        z.update({
+            f'blocks.{i}.ln1.weight': 1 + rnd(C), f'blocks.{i}.ln1.bias': rnd(C),
+            f'blocks.{i}.ln2.weight': 1 + rnd(C), f'blocks.{i}.ln2.bias': rnd(C),
+            att+'w0': rnd(1, 1, C) - 0.5, att+'w1': rnd(C, D), att+'w2': rnd(D, C),
+            att+'a0': rnd(1, 1, C), att+'a1': rnd(C, D), att+'a2': rnd(D, C),
+            att+'g1': rnd(C, D), att+'g2': rnd(D, C),
+            att+'k_k': 1 + rnd(1, 1, C), att+'k_a': 1 + rnd(1, 1, C), att+'r_k': rnd(H, head_size),
+            att+'receptance.weight': rnd(C, C), att+'key.weight': rnd(C, C),
+            att+'value.weight': rnd(C, C), att+'output.weight': rnd(C, C),
+            att+'ln_x.weight': 1 + rnd(C), att+'ln_x.bias': rnd(C),
+            ffn+'x_k': rnd(1, 1, C), ffn+'key.weight': rnd(4 * C, C), ffn+'value.weight': rnd(C, 4 * C),
+        })
+        for m in 'rwkvag':
+            z[att+f'x_{m}'] = rnd(1, 1, C)
+        if i > 0:
+            z.update({att+'v0': rnd(1, 1, C), att+'v1': rnd(C, D), att+'v2': rnd(D, C)})
+    return z
+
+def tiny_rwkv7(strategy='cpu fp32', **kwargs):
+    from infer.rwkv.model import RWKV
+    return RWKV(model=tiny_rwkv7_weights(**kwargs), strategy=strategy)
+
+def timeit(fn, n=10):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
+
+def bench_batch(args):
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    g = torch.Generator().manual_seed(1)
+    prompts = [torch.randint(0, 65536, (int(n),), generator=g).tolist() for n in torch.randint(1, 24, (args.batch,), generator=g)]
+
+    # parity: ragged batched prefill + one decode step vs. one sequence at a time
+    out_b, state_b = model.forward_batch(prompts, None)
+    out_b2, state_b = model.forward_batch([[1]] * len(prompts), state_b)
+    for b, p in enumerate(prompts):
+        out, state = model.forward(p, None)
+        out2, state = model.forward([1], state)
+        assert torch.allclose(out, out_b[b], atol=1e-4), f'prefill logits mismatch in row {b}'
+        assert torch.allclose(out2, out_b2[b], atol=1e-4), f'decode logits mismatch in row {b}'
+        for j in range(len(state)):
+            assert torch.allclose(state[j], state_b[j][b], atol=1e-4), f'state {j} mismatch in row {b}'
+    print(f'parity ok for {len(prompts)} ragged rows')
+
+    # decode throughput: B single steps vs. one batched step
+    states = [model.forward(p, None)[1] for p in prompts]
+    def single():
+        for s in states:
+            model.forward([1], [t.clone() for t in s])
+    batched_state = model.stack_state(states)
+    def batched():
+        model.forward_batch([[1]] * len(states), [t.clone() for t in batched_state])
+    # the same step on pool slots, updated in place
+    from infer.state_pool import StatePool
+    pool = StatePool(model, len(states))
+    for s in states:
+        pool.load(pool.alloc(zero=False), s)
+    def pooled():
+        model.forward_batch([[1]] * len(states), pool.batch(len(states)))
+    t_single, t_batched, t_pooled = timeit(single), timeit(batched), timeit(pooled)
+    print(f'decode B={len(states)}: sequential {len(states)/t_single:.1f} tok/s, batched {len(states)/t_batched:.1f} tok/s ({t_single/t_batched:.2f}x), '
+          f'state pool {len(states)/t_pooled:.1f} tok/s ({t_single/t_pooled:.2f}x)')
+
+def bench_engine(args):
+    from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS
+    from infer.engine import Engine
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    pipeline = PIPELINE(model, "wr_vocab_v20230424")
+    gen_args = PIPELINE_ARGS(temperature=1.0, top_p=0.0, token_ban=[0], token_stop=[])
+    prompts = [f'\x16User: question {i} ' + 'lorem ipsum ' * (i % 7 * 8) + '\x17\x16Assistant:' for i in range(args.requests)]
+
+    t0 = time.perf_counter()
+    for p in prompts:
+        pipeline.generate(p, token_count=args.max_tokens, args=gen_args)
+    t_seq = time.perf_counter() - t0
+
+    engine = Engine(pipeline, args=gen_args, max_batch=args.batch, prefill_tokens=args.prefill_tokens)
+    t0 = time.perf_counter()
+    reqs = [engine.submit(p, max_tokens=args.max_tokens) for p in prompts]
+    while engine.step():
+        pass
+    t_engine = time.perf_counter() - t0
+    assert all(r.done() and r.error is None for r in reqs)
+
+    n_tokens = sum(len(r.all_tokens) for r in reqs)
+    ttft = sorted(r.first_token_time - r.submit_time for r in reqs)
+    print(f'{args.requests} requests x {args.max_tokens} tokens')
+    print(f'sequential generate: {n_tokens/t_seq:.1f} tok/s')
+    print(f'engine (max_batch={args.batch}): {n_tokens/t_engine:.1f} tok/s ({t_seq/t_engine:.2f}x), TTFT p50 {ttft[len(ttft)//2]*1000:.0f} ms, p max {ttft[-1]*1000:.0f} ms')
+
+def bench_prefix(args):
+    from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS
+    from infer.prefix_cache import PrefixCache
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    pipeline = PIPELINE(model, "wr_vocab_v20230424")
+    gen_args = PIPELINE_ARGS(chunk_len=256)
+    images = [torch.randn(1, 576, args.n_embd) for _ in range(args.images)]
+    prompts = [(f'\x16User:<|vision_start|>' + '<|image_pad|>' * 576 + f'<|vision_end|>question {q}?\x17\x16Assistant:', images[q % args.images])
+               for q in range(args.requests)]
+
+    def run():
+        outs = []
+        t0 = time.perf_counter()
+        for text, sign in prompts:
+            outs.append(pipeline.forward_prompt(pipeline.encode(text), None, gen_args, sign=sign)[0])
+        return time.perf_counter() - t0, outs
+
+    t_plain, ref = run()
+    pipeline.prefix_cache = PrefixCache(max_bytes=args.cache_mb << 20)
+    t_cached, outs = run()
+    for a, b in zip(ref, outs):
+        assert torch.allclose(a, b, atol=1e-4), 'cached prefill changed the logits'
+    print(f'{args.requests} prompts over {args.images} images: prefill {t_plain:.2f}s -> {t_cached:.2f}s with cache ({t_plain/t_cached:.2f}x)')
+    print(pipeline.prefix_cache.stats())
+
+def bench_state_io(args):
+    import tempfile
+    from infer.state_io import save_state, load_state
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    _, state = model.forward(list(range(1, 65)), None)
+    with tempfile.TemporaryDirectory() as d:
+        for kv_dtype in (None, torch.float16, torch.bfloat16):
+            path = os.path.join(d, 'state.rwkv')
+            t0 = time.perf_counter()
+            save_state(path, state, kv_dtype=kv_dtype)
+            t_save = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            loaded, _ = load_state(path)
+            t_load = time.perf_counter() - t0
+            err = max((a.float() - b.float()).abs().max().item() for a, b in zip(state, loaded))
+            print(f'kv {str(kv_dtype):15s} {os.path.getsize(path)/1024:8.1f} KB  save {t_save*1000:6.1f} ms  load {t_load*1000:6.1f} ms  max abs err {err:.2e}')
+
+def bench_state_quant(args):
+    from infer.state_quant import QuantizedState
+    from infer.prefix_cache import state_nbytes
+    if args.model:
+        from infer.rwkv.model import RWKV
+        model = RWKV(model=args.model, strategy=args.strategy)
+    else:
+        model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    g = torch.Generator().manual_seed(2)
+    prompt = torch.randint(0, 65536, (args.prompt_len,), generator=g).tolist()
+    out, state = model.forward(prompt, None)
+
+    # reference: greedy decode from the full-precision state; the same tokens are teacher-forced below
+    tokens, ref, s = [], [], [t.clone() for t in state]
+    for _ in range(args.steps):
+        tokens.append(int(out.argmax()))
+        out, s = model.forward([tokens[-1]], s)
+        ref.append(out.float())
+    print(f'{args.steps} decode steps after a {args.prompt_len}-token prompt, fp32 state {state_nbytes(state)/1024:.1f} KB')
+
+    for mode in ('int8', 'fp8'):
+        for granularity in ('head', 'row'):
+            try:
+                q = QuantizedState.from_state(state, mode, granularity)
+            except ValueError as e:
+                print(f'{mode:4s} {granularity:4s}: skipped ({e})')
+                continue
+            s = q.dequantize(state[0].device)
+            max_diff, kl, agree = 0.0, 0.0, 0
+            for t, r in zip(tokens, ref):
+                out, s = model.forward([t], s)
+                out = out.float()
+                max_diff = max(max_diff, (out - r).abs().max().item())
+                kl += torch.nn.functional.kl_div(out.log_softmax(-1), r.log_softmax(-1), log_target=True, reduction='sum').item()
+                agree += int(out.argmax() == r.argmax())
+            print(f'{mode:4s} {granularity:4s}: {q.nbytes/1024:8.1f} KB ({state_nbytes(state)/q.nbytes:.2f}x smaller)  '
+                  f'max |dlogit| {max_diff:.3e}  mean KL {kl/len(tokens):.3e}  top-1 agree {agree}/{len(tokens)}')
+
+def bench_wkv(args):
+    from infer.rwkv.model import RWKV_x070_WKV_loop, RWKV_x070_WKV_chunk
+    H, N, T = args.n_embd // 64, 64, args.T
+    g = torch.Generator().manual_seed(3)
+    def rnd(*shape):
+        return torch.randn(*shape, generator=g)
+    r, k, v = rnd(1, T, H*N), rnd(1, T, H*N), rnd(1, T, H*N)
+    kk = torch.nn.functional.normalize(rnd(1, T, H, N), dim=-1).view(1, T, H*N)
+    a = torch.sigmoid(rnd(1, T, H*N))
+    w = torch.exp(-0.606531 * torch.sigmoid(rnd(1, T, H*N)))
+    state = rnd(1, H, N, N) * 0.1
+
+    y_ref, s_ref = RWKV_x070_WKV_loop(H, N, state.clone(), r, w, k, v, -kk, kk*a)
+    t_loop = timeit(lambda: RWKV_x070_WKV_loop(H, N, state.clone(), r, w, k, v, -kk, kk*a), n=3)
+    print(f'T={T} H={H}: per-token loop {t_loop*1000:.1f} ms')
+    for L in args.chunks:
+        y, s = RWKV_x070_WKV_chunk(H, N, L, state.clone(), r, w, k, v, -kk, kk*a)
+        err_y = ((y - y_ref).abs().max() / y_ref.abs().max()).item()
+        err_s = ((s - s_ref).abs().max() / s_ref.abs().max()).item()
+        assert err_y < 1e-4 and err_s < 1e-4, f'chunk {L}: mismatch vs. per-token loop (y {err_y:.2e}, state {err_s:.2e})'
+        t = timeit(lambda: RWKV_x070_WKV_chunk(H, N, L, state.clone(), r, w, k, v, -kk, kk*a), n=3)
+        print(f'chunk {L:3d}: {t*1000:8.1f} ms ({t_loop/t:.2f}x)  rel err y {err_y:.1e} state {err_s:.1e}')
+
+def bench_quant(args):
+    from infer.rwkv.model import RWKV
+    # decode is bound by weight reads, so i8 / i4 must beat the full-precision baseline; the model is wide
+    # enough (--embd) that its weights do not sit in cache
+    device = 'cuda' if torch.cuda.is_available() and os.environ.get('RWKV_CUDA_ON') == '1' else 'cpu'
+    prec = 'fp16' if device == 'cuda' else 'fp32'
+    prompt = list(range(1, 33))
+    ref, base = None, None
+    for strategy in (f'{device} {prec}', f'{device} {prec}i8', f'{device} {prec}i4'):
+        model = RWKV(model={k: v.to(device) for k, v in tiny_rwkv7_weights(n_layer=args.n_layer, n_embd=args.embd).items()}, strategy=strategy)
+        weight_bytes = sum(v.numel() * v.element_size() for k, v in model.z.items() if k.endswith('.weight') or k.endswith('.qs'))
+        out, state = model.forward(prompt, None)
+        out = out.float()
+        if ref is None:
+            ref = out
+        err = ((out - ref).abs().max() / ref.abs().max()).item()
+        agree = (out.topk(10).indices == ref.topk(10).indices).float().mean().item()
+        def step():
+            model.forward([1], [s.clone() for s in state])
+            if device == 'cuda':
+                torch.cuda.synchronize()
+        t = timeit(step, n=20)
+        print(f'{strategy:12s} weights {weight_bytes/2**20:7.1f} MB  decode {t*1000:6.2f} ms/token  rel logit err {err:.2e}  top-10 overlap {agree:.2f}')
+        if base is None:
+            base = t
+        else:
+            assert t < base, f'{strategy} decode ({t*1000:.2f} ms/token) is not faster than {prec} ({base*1000:.2f} ms/token)'
+        del model
+
+def bench_fused(args):
+    from infer.rwkv import model as M
+    plain = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    fused = M.RWKV(model=tiny_rwkv7_weights(n_layer=args.n_layer, n_embd=args.n_embd), strategy='cpu fp32', fused=True)
+    prompt = list(range(1, 33))
+    out_p, state_p = plain.forward(prompt, None)
+    out_f, state_f = fused.forward(prompt, None)
+    # not bit-exact: ln0 is folded into the embedding table and the stacked projections go through bmm,
+    # which rounds differently from three separate matmuls; fp32 agreement to FUSED_RTOL is required instead
+    FUSED_RTOL = 1e-4
+    def rel(a, b):
+        return ((a - b).abs().max() / b.abs().max().clamp_min(1e-12)).item()
+    diff, exact = rel(out_f, out_p), torch.equal(out_p, out_f)
+    for _ in range(args.steps):
+        token = int(out_p.argmax())
+        out_p, state_p = plain.forward([token], state_p)
+        out_f, state_f = fused.forward([token], state_f)
+        diff = max(diff, rel(out_f, out_p), max(rel(a, b) for a, b in zip(state_f, state_p)))
+        exact = exact and torch.equal(out_p, out_f) and all(torch.equal(a, b) for a, b in zip(state_p, state_f))
+    print(f'{args.steps} decode steps: max rel diff {diff:.3e}, bit-exact {exact}')
+    assert diff < FUSED_RTOL, f'fused layout diverges from the plain one (max rel diff {diff:.2e} >= {FUSED_RTOL:.0e})'
+
+    # per-layer TMix step
+    i, z, zf, H, N = 1, plain.z, fused.z, plain.n_head, plain.head_size
+    att = f'blocks.{i}.att.'
+    x, x_prev, v_first = torch.randn(plain.n_embd), torch.randn(plain.n_embd), torch.randn(plain.n_embd)
+    s = torch.zeros(H, N, N)
+    def layer_plain():
+        M.RWKV_x070_TMix_one(i, H, N, x, x_prev, v_first, s,
+            z[att+'x_r'], z[att+'x_w'], z[att+'x_k'], z[att+'x_v'], z[att+'x_a'], z[att+'x_g'],
+            z[att+'w0'], z[att+'w1'], z[att+'w2'], z[att+'a0'], z[att+'a1'], z[att+'a2'], z[att+'v0'], z[att+'v1'], z[att+'v2'],
+            z[att+'g1'], z[att+'g2'], z[att+'k_k'], z[att+'k_a'], z[att+'r_k'],
+            z[att+'receptance.weight'], z[att+'key.weight'], z[att+'value.weight'], z[att+'output.weight'],
+            z[att+'receptance.weight.qs'], z[att+'key.weight.qs'], z[att+'value.weight.qs'], z[att+'output.weight.qs'],
+            z[att+'ln_x.weight'], z[att+'ln_x.bias'])
+    def layer_fused():
+        M.RWKV_x070_TMix_one_fused(i, H, N, x, x_prev, v_first, s,
+            zf[att+'maa'], zf[att+'lora1'], zf[att+'lora2'], zf[att+'w0'], zf[att+'a0'], zf[att+'v0'], zf[att+'k_k'], zf[att+'k_a'], zf[att+'r_k'],
+            zf[att+'rkv'], zf[att+'output.weight'], zf[att+'output.weight.qs'], zf[att+'ln_x.weight'], zf[att+'ln_x.bias'])
+    t_p, t_f = timeit(layer_plain, n=200), timeit(layer_fused, n=200)
+    print(f'TMix step: {t_p*1e6:.1f} us -> {t_f*1e6:.1f} us fused ({t_p/t_f:.2f}x)')
+    t_p = timeit(lambda: plain.forward([1], [t.clone() for t in state_p]), n=50)
+    t_f = timeit(lambda: fused.forward([1], [t.clone() for t in state_f]), n=50)
+    print(f'token: {t_p*1000:.2f} ms -> {t_f*1000:.2f} ms fused ({t_p/t_f:.2f}x)')
+
+def bench_profile(args):
+    from torch.profiler import profile, ProfilerActivity
+    from infer.rwkv.model import LAYER_KEYS
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    out, state = model.forward(list(range(1, 33)), None)
+    for _ in range(3):
+        out, state = model.forward([1], state)
+    t0 = time.perf_counter()
+    with profile(activities=[ProfilerActivity.CPU]) as prof:
+        for _ in range(args.steps):
+            out, state = model.forward([1], state)
+    wall = (time.perf_counter() - t0) / args.steps
+    ops = sum(e.self_cpu_time_total for e in prof.key_averages() if e.key.startswith('aten::')) / 1e6 / args.steps
+    print(f'decode: {wall*1000:.3f} ms/token wall, {ops*1000:.3f} ms in aten ops, host overhead {max(wall-ops, 0)*1000:.3f} ms ({max(wall-ops, 0)/wall:.0%})')
+    print(prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=args.rows))
+
+    # what the per-layer tables replace: f-string keys + dict lookups vs. iterating prebuilt tuples
+    z, n = model.z, model.n_layer
+    def lookup():
+        for i in range(n):
+            for k in LAYER_KEYS:
+                z[f'blocks.{i}.{k}']
+    def table():
+        for layer in model.layers:
+            (*_,) = layer
+    t_l, t_t = timeit(lookup, n=200), timeit(table, n=200)
+    print(f'weight access per token ({n} layers): {t_l*1e6:.1f} us dict lookups -> {t_t*1e6:.1f} us tables')
+
+def legacy_sample_logits(logits, temperature=1.0, top_p=0.85, top_k=0):
+    # the full-sort sampler PIPELINE.sample_logits used to be (torch branch), kept as the reference
+    import numpy as np
+    if temperature == 0:
+        temperature, top_p = 1.0, 0
+    probs = torch.softmax(logits.float(), dim=-1)
+    sorted_ids = torch.argsort(probs)
+    sorted_probs = torch.flip(probs[sorted_ids], dims=(0,))
+    cumulative_probs = torch.cumsum(sorted_probs, dim=-1).cpu().numpy()
+    cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
+    probs[probs < cutoff] = 0
+    if 0 < top_k < len(probs):
+        probs[sorted_ids[:-top_k]] = 0
+    if temperature != 1.0:
+        probs = probs ** (1.0 / temperature)
+    return int(torch.multinomial(probs, num_samples=1)[0])
+
+def bench_sample(args):
+    from infer.rwkv.utils import PIPELINE, sample_tokens
+    sample_logits = PIPELINE.sample_logits.__get__(object.__new__(PIPELINE)) # no tokenizer needed
+    g = torch.Generator().manual_seed(4)
+    V = args.vocab
+    logits = torch.randn(V, generator=g) * 3
+    settings = [(1.0, 0.85, 0), (0.7, 0.5, 0), (1.0, 0.0, 0), (1.0, 1.0, 40), (0.0, 0.85, 0)]
+
+    # distribution parity: total variation between sample histograms of the two samplers
+    for t, p, k in settings:
+        n = args.samples
+        a = torch.bincount(torch.tensor([legacy_sample_logits(logits, t, p, k) for _ in range(n)]), minlength=V).float() / n
+        b = torch.bincount(sample_tokens(logits.expand(n, V), t, p, k)[0], minlength=V).float() / n
+        print(f'T={t} top_p={p} top_k={k}: support {int((a > 0).sum())} / {int((b > 0).sum())} tokens, TV distance {0.5 * (a - b).abs().sum():.3f}')
+
+    t_old = timeit(lambda: legacy_sample_logits(logits, 1.0, 0.85, 0), n=50)
+    t_new = timeit(lambda: sample_logits(logits, 1.0, 0.85, 0), n=50)
+    print(f'one row, V={V}: {t_old*1000:.3f} ms -> {t_new*1000:.3f} ms ({t_old/t_new:.2f}x)')
+    for B in args.batch:
+        x = torch.randn(B, V, generator=g) * 3
+        temps, top_ps = [0.5 + (b % 4) / 4 for b in range(B)], [0.3 + (b % 7) / 10 for b in range(B)]
+        t_loop = timeit(lambda: [legacy_sample_logits(x[b], temps[b], top_ps[b]) for b in range(B)], n=5)
+        t_batch = timeit(lambda: sample_tokens(x, temps, top_ps, 0)[0].tolist(), n=5)
+        print(f'B={B}: per-row loop {t_loop*1000:.2f} ms -> batched {t_batch*1000:.2f} ms ({t_loop/t_batch:.2f}x)')
+
+def legacy_apply_penalty(out, occurrence, args):
+    # PIPELINE.apply_penalty / update_occurrence before PenaltyState, kept as the reference
+    for n in args.token_ban:
+        out[n] = -float('inf')
+    for n in occurrence:
+        out[n] -= (args.alpha_presence + occurrence[n] * args.alpha_frequency)
+    return out
+
+def legacy_update_occurrence(pipeline, occurrence, token, args):
+    for xxx in occurrence:
+        occurrence[xxx] *= args.alpha_decay
+    www = 0 if pipeline.decode([token]) in ' \t0123456789' else 1
+    occurrence[token] = occurrence.get(token, 0) + www
+    return occurrence
+
+def bench_penalty(args):
+    from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS
+    pipeline = PIPELINE(None, "wr_vocab_v20230424")
+    gen_args = PIPELINE_ARGS(token_ban=[0], token_stop=[24])
+    V = 65536
+    t0 = time.perf_counter()
+    penalty = pipeline.penalty_state(1, V, 'cpu')
+    print(f'whitespace bitmap: {time.perf_counter()-t0:.2f}s, {int((penalty.weight == 0).sum())} zero-weight tokens')
+    penalty.reset(0, gen_args)
+
+    # parity with the dict-based legacy_apply_penalty / legacy_update_occurrence, then per-step cost as the history grows
+    g = torch.Generator().manual_seed(5)
+    tokens = torch.randint(0, V, (args.steps,), generator=g).tolist()
+    occurrence, logits = {}, torch.randn(V, generator=g)
+    t_dict, t_tensor = {}, {}
+    for i, token in enumerate(tokens):
+        t0 = time.perf_counter()
+        a = legacy_apply_penalty(logits.clone(), occurrence, gen_args)
+        legacy_update_occurrence(pipeline, occurrence, token, gen_args)
+        t1 = time.perf_counter()
+        b = penalty.apply(logits.clone().view(1, V))[0]
+        penalty.update(torch.tensor([token]))
+        t2 = time.perf_counter()
+        if (i + 1) in args.report:
+            t_dict[i + 1], t_tensor[i + 1] = t1 - t0, t2 - t1
+            assert torch.allclose(a, b, atol=1e-4), f'penalized logits differ at step {i}'
+    print(f'parity ok over {args.steps} steps')
+    for n in args.report:
+        if n in t_dict:
+            print(f'step {n:5d}: dict {t_dict[n]*1e6:8.1f} us, tensor {t_tensor[n]*1e6:8.1f} us')
+
+def bench_detok(args):
+    from infer.rwkv.utils import PIPELINE, RedecodeStream
+    pipeline = PIPELINE(None, "wr_vocab_v20230424")
+    text = ('The quick brown fox 跳过了懒狗。 Ünïcödé ✓ 🦊🐕 数学: ∑∫√ — ' * args.repeat)
+    tokens = pipeline.encode(text)
+
+    def redecode():
+        # what generate() did before: re-decode everything since the last complete piece, check for U+FFFD
+        out, out_last = '', 0
+        for i in range(len(tokens)):
+            tmp = pipeline.decode(tokens[out_last:i + 1])
+            if '\ufffd' not in tmp:
+                out += tmp
+                out_last = i + 1
+        return out
+    def stream(make):
+        s = make()
+        return ''.join(s.push(t) for t in tokens)
+    ref = redecode()
+    assert ref == text and stream(pipeline.stream_decoder) == text and stream(lambda: RedecodeStream(pipeline.decode)) == text
+    t_old, t_new = timeit(redecode, n=5), timeit(lambda: stream(pipeline.stream_decoder), n=5)
+    print(f'{len(tokens)} tokens: re-decode {len(tokens)/t_old/1e3:.0f}k tok/s, incremental {len(tokens)/t_new/1e3:.0f}k tok/s ({t_old/t_new:.2f}x)')
+
+    streams = [pipeline.stream_decoder() for _ in range(args.batch)]
+    def batched():
+        for t in tokens:
+            pipeline.decode_many(streams, [t] * len(streams))
+    t_b = timeit(batched, n=3)
+    print(f'{args.batch} streams: {len(tokens)*args.batch/t_b/1e3:.0f}k tok/s')
+
+def bench_tokenizer(args):
+    import random, tracemalloc
+    from infer.rwkv.rwkv_tokenizer import TRIE, TRIE_TOKENIZER
+    vocab = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rwkv', 'wr_vocab_v20230424.txt')
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    tok = TRIE_TOKENIZER(vocab)
+    t_build = time.perf_counter() - t0
+    mem = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    root = TRIE() # the per-node object trie TRIE_TOKENIZER used to build
+    for t, i in tok.token2idx.items():
+        root.add(t, val=(t, i))
+    t_ref = time.perf_counter() - t0
+    mem_ref = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'build: object trie {t_ref:.2f}s / {mem_ref/2**20:.0f} MB peak, double array {t_build:.2f}s / {mem/2**20:.0f} MB peak '
+          f'({(tok.base.nbytes + tok.check.nbytes + tok.value.nbytes)/2**20:.1f} MB kept)')
+
+    def ref_encode(src):
+        idx, tokens = 0, []
+        while idx < len(src):
+            idx, _, values = root.find_longest(src, idx)
+            tokens.append(next(iter(values))[1])
+        return tokens
+    for t, i in tok.token2idx.items():
+        assert tok.encodeBytes(t) == ref_encode(t), f'token {i} {t!r} encodes differently'
+    rng = random.Random(6)
+    ids = list(tok.idx2token)
+    for _ in range(args.samples):
+        src = b''.join(tok.idx2token[rng.choice(ids)] for _ in range(rng.randint(1, 64)))
+        assert tok.encodeBytes(src) == ref_encode(src), f'{src!r} encodes differently'
+    print(f'parity ok: {len(tok.token2idx)} vocab entries, {args.samples} random token concatenations')
+
+    texts = [f'\x16User: question {i} 这是第{i}个问题。 ' + 'lorem ipsum dolor sit amet, 敏捷的棕色狐狸 ' * (i % 13 + 1) + '\x17' for i in range(args.texts)]
+    data = [x.encode('utf-8') for x in texts]
+    n = sum(len(ref_encode(x)) for x in data)
+    t_old = timeit(lambda: [ref_encode(x) for x in data], n=3)
+    t_new = timeit(lambda: tok.encode_many(texts), n=3)
+    assert tok.encode_many(texts) == [ref_encode(x) for x in data]
+    print(f'encode {args.texts} texts: object trie {n/t_old/1e3:.0f}k tok/s, double array {n/t_new/1e3:.0f}k tok/s ({t_old/t_new:.2f}x)')
+
+def bench_vocab_cache(args):
+    import tempfile
+    import numpy as np
+    from infer.rwkv.rwkv_tokenizer import TRIE_TOKENIZER
+    vocab = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rwkv', 'wr_vocab_v20230424.txt')
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'vocab.bin')
+        t0 = time.perf_counter()
+        plain = TRIE_TOKENIZER(vocab, cache_file=False)
+        t1 = time.perf_counter()
+        TRIE_TOKENIZER(vocab, cache_file=path)
+        t2 = time.perf_counter()
+        cached = TRIE_TOKENIZER(vocab, cache_file=path)
+        t3 = time.perf_counter()
+        assert cached.idx2token == plain.idx2token
+        assert all(np.array_equal(getattr(cached, k), getattr(plain, k)) for k in ('base', 'check', 'value'))
+        text = 'The quick brown fox 跳过了懒狗。 🦊 ' * 100
+        assert cached.encode(text) == plain.encode(text)
+        print(f'startup: parse + build {(t1-t0)*1000:.0f} ms, + write cache {(t2-t1)*1000:.0f} ms, '
+              f'mapped cache {(t3-t2)*1000:.1f} ms ({os.path.getsize(path)/2**20:.1f} MB file)')
+
+def bench_prompt(args):
+    from infer.rwkv.utils import PIPELINE, build_prompt
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    pipeline = PIPELINE(model, "wr_vocab_v20230424")
+    n = args.images
+    def old():
+        return pipeline.encode('\x16User:' + ('<|vision_start|>' + '<|image_pad|>' * 576 + '<|vision_end|>') * n + 'what is in the picture?\x17\x16Assistant:')
+    def new():
+        return build_prompt(pipeline.encode, ['\x16User:', *[576] * n, 'what is in the picture?\x17\x16Assistant:'])
+    prompt = new()
+    assert list(prompt) == old(), 'token ids differ from tokenizing the placeholder string'
+    t_old, t_new = timeit(old, n=20), timeit(new, n=20)
+    print(f'{n} image(s): tokenize pads {t_old*1000:.2f} ms -> build_prompt {t_new*1000:.3f} ms ({t_old/t_new:.0f}x)')
+
+    # splice: index_copy_ at the spans vs. the boolean-mask masked_scatter the model used to do
+    sign = torch.randn(n, 576, model.n_embd)
+    x = model.z['emb.weight'][list(prompt)]
+    def masked():
+        mask = (torch.tensor(prompt) == 65532).unsqueeze(-1).expand_as(x)
+        return x.masked_scatter(mask, sign.view(-1, model.n_embd))
+    def spliced():
+        pos = model.placeholder_index(prompt, prompt.spans, n * 576, x.device)
+        return x.clone().index_copy_(0, pos, sign.view(-1, model.n_embd))
+    assert torch.equal(masked(), spliced())
+    t_mask, t_copy = timeit(masked, n=50), timeit(spliced, n=50)
+    print(f'splice {n*576} rows: masked_scatter {t_mask*1000:.3f} ms -> index_copy_ {t_copy*1000:.3f} ms (incl. clone)')
+    out_a, _ = model.forward(list(prompt), None, sign=sign) # placeholders found by scanning
+    out_b, _ = model.forward(prompt, None, sign=sign, spans=prompt.spans)
+    assert torch.equal(out_a, out_b)
+    print('forward parity ok')
+
+def bench_chunked(args):
+    from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS, build_prompt
+    model = tiny_rwkv7(n_layer=args.n_layer, n_embd=args.n_embd)
+    pipeline = PIPELINE(model, "wr_vocab_v20230424")
+    parts = ['\x16User: compare these.']
+    for i in range(args.images):
+        parts += [576, f' picture {i}']
+    parts.append('\x17\x16Assistant:')
+    prompt = build_prompt(pipeline.encode, parts)
+    sign = torch.randn(args.images, 576, model.n_embd) * 0.1
+    ref, ref_state = pipeline.forward_prompt(prompt, None, PIPELINE_ARGS(chunk_len=len(prompt)), sign=sign)
+    for chunk_len in args.chunks:
+        t0 = time.perf_counter()
+        out, state = pipeline.forward_prompt(prompt, None, PIPELINE_ARGS(chunk_len=chunk_len), sign=sign)
+        t = time.perf_counter() - t0
+        err = max((out - ref).abs().max().item(), max((a - b).abs().max().item() for a, b in zip(state, ref_state)))
+        assert err < 1e-3, f'chunk_len={chunk_len} diverges from a single-call prefill ({err:.2e})'
+        print(f'{len(prompt)} tokens, {args.images} image(s), chunk_len {chunk_len:5d}: {t*1000:7.1f} ms, max |diff| {err:.1e}')
+    # plain ids (no spans recorded) take the same path, the placeholders are found by scanning
+    out, _ = pipeline.forward_prompt(list(prompt), None, PIPELINE_ARGS(chunk_len=args.chunks[0]), sign=sign)
+    assert (out - ref).abs().max().item() < 1e-3
+
+def bench_encoder_batch(args):
+    import threading
+    from infer.encoder_batcher import EncoderBatcher
+    torch.manual_seed(0)
+    C = args.n_embd
+    encoder = torch.nn.Sequential( # stand-in for SigLIP + VisualAdapter: patchify, MLP blocks, project
+        torch.nn.Conv2d(3, 256, 16, 16), torch.nn.Flatten(2),
+        *[torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.GELU(), torch.nn.Linear(64, 16)) for _ in range(4)],
+    )
+    proj = torch.nn.Linear(256, C)
+    @torch.inference_mode()
+    def encode(images): # [n, 3, 64, 64] -> [n, 16, C]
+        return proj(encoder(images).transpose(1, 2))
+    def encode_batch(items):
+        groups = [m if m.dim() == 4 else m.unsqueeze(0) for m in items]
+        return list(encode(torch.cat(groups)).split([len(g) for g in groups]))
+    images = [torch.randn(3, 64, 64) for _ in range(args.requests)]
+
+    t0 = time.perf_counter()
+    ref = [encode(x.unsqueeze(0)) for x in images]
+    t_seq = time.perf_counter() - t0
+
+    batcher = EncoderBatcher(encode_batch, max_items=args.batch, window=args.window_ms / 1000).start()
+    out = [None] * len(images)
+    def client(i):
+        out[i] = batcher(images[i])
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(images))]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    t_batch = time.perf_counter() - t0
+    batcher.stop()
+    err = max((a - b).abs().max().item() for a, b in zip(out, ref))
+    assert err < 1e-4, f'batched features differ from per-request encoding ({err:.2e})'
+    stats = batcher.stats()
+    print(f'{args.requests} concurrent single-image requests')
+    print(f'per request: {args.requests/t_seq:.0f} images/s')
+    print(f'micro-batched (max {args.batch}, window {args.window_ms} ms): {args.requests/t_batch:.0f} images/s ({t_seq/t_batch:.2f}x), '
+          f'{stats["items_per_batch"]:.1f} images/batch, max |diff| {err:.1e}')
+
+def bench_preprocess(args):
+    import numpy as np
+    from PIL import Image
+    from transformers import SiglipImageProcessor, CLIPImageProcessor
+    from world.encoder.preprocess import ImagePreprocessor
+    g = torch.Generator().manual_seed(0)
+    def photo(h, w): # smooth random content, closer to a photo than noise
+        x = torch.rand(1, 3, h // 16 + 1, w // 16 + 1, generator=g) * 255
+        x = torch.nn.functional.interpolate(x, size=(h, w), mode='bilinear', align_corners=False)
+        return Image.fromarray(x[0].permute(1, 2, 0).round().clamp(0, 255).byte().numpy())
+    sizes = [(480, 640), (720, 1280), (1024, 768)]
+    images = [photo(*sizes[i % len(sizes)]) for i in range(max(args.batch))]
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for name, hf in [('siglip', SiglipImageProcessor(size={'height': 384, 'width': 384})), ('clip', CLIPImageProcessor())]:
+        pre = ImagePreprocessor.from_hf(hf)
+        level = max(pre.scale.flatten().tolist()) # one uint8 step after normalization
+        for n in args.batch:
+            batch = images[:n]
+            ref = hf(batch, return_tensors='pt')['pixel_values']
+            t_hf = timeit(lambda: hf(batch, return_tensors='pt'), n=args.repeat)
+            line = f'{name:6s} batch {n:3d}: HF {n/t_hf:7.1f} img/s'
+            for device in devices:
+                out = pre(batch, device=device)
+                diff = (out.cpu() - ref).abs()
+                assert diff.mean().item() < level and diff.max().item() < 4 * level, \
+                    f'{name} on {device} differs from the HF processor (mean {diff.mean().item():.2e}, max {diff.max().item():.2e})'
+                def run():
+                    pre(batch, device=device)
+                    if device == 'cuda':
+                        torch.cuda.synchronize()
+                t = timeit(run, n=args.repeat)
+                line += f' | {device} {n/t:7.1f} img/s ({t_hf/t:5.2f}x), mean |diff| {diff.mean().item()/level:.2f} lvl, max {diff.max().item()/level:.1f} lvl'
+            print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WorldRWKV inference benchmarks")
+    parser.add_argument("--n_layer", type=int, default=2)
+    parser.add_argument("--n_embd", type=int, default=128)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("batch", help="batched forward parity + decode throughput")
+    p.add_argument("--batch", type=int, default=16)
+    p.set_defaults(fn=bench_batch)
+    p = sub.add_parser("engine", help="continuous-batching engine vs. sequential PIPELINE.generate")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--batch", type=int, default=16)
+    p.add_argument("--max_tokens", type=int, default=32)
+    p.add_argument("--prefill_tokens", type=int, default=256)
+    p.set_defaults(fn=bench_engine)
+    p = sub.add_parser("prefix", help="prefix-state cache on prompts sharing an image block")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--images", type=int, default=4)
+    p.add_argument("--cache_mb", type=int, default=64)
+    p.set_defaults(fn=bench_prefix)
+    p = sub.add_parser("state_io", help="state file size / save / load round trip")
+    p.set_defaults(fn=bench_state_io)
+    p = sub.add_parser("state_quant", help="logit drift of int8 / fp8 parked states vs. fp32")
+    p.add_argument("--model", type=str, default=None, help="real checkpoint (default: tiny random model)")
+    p.add_argument("--strategy", type=str, default="cpu fp32")
+    p.add_argument("--prompt_len", type=int, default=256)
+    p.add_argument("--steps", type=int, default=64)
+    p.set_defaults(fn=bench_state_quant)
+    p = sub.add_parser("wkv", help="chunked wkv7 prefill vs. the per-token loop (parity + chunk sizes)")
+    p.add_argument("--T", type=int, default=600)
+    p.add_argument("--chunks", type=int, nargs="+", default=[8, 16, 32, 64])
+    p.set_defaults(fn=bench_wkv)
+    p = sub.add_parser("quant", help="i8 / i4 weight quantization: size, decode latency, logit error")
+    p.add_argument("--embd", type=int, default=1024)
+    p.set_defaults(fn=bench_quant)
+    p = sub.add_parser("fused", help="fused projection layout: parity + per-layer / per-token decode latency")
+    p.add_argument("--steps", type=int, default=16)
+    p.set_defaults(fn=bench_fused)
+    p = sub.add_parser("profile", help="per-token decode host overhead (torch.profiler) + weight table access")
+    p.add_argument("--steps", type=int, default=50)
+    p.add_argument("--rows", type=int, default=15)
+    p.set_defaults(fn=bench_profile)
+    p = sub.add_parser("sample", help="partial top-k sampler vs. the full-sort one (distribution + latency)")
+    p.add_argument("--vocab", type=int, default=65536)
+    p.add_argument("--samples", type=int, default=4000)
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 16, 64])
+    p.set_defaults(fn=bench_sample)
+    p = sub.add_parser("penalty", help="dense penalty / ban tensors vs. the occurrence dict (parity + per-step cost)")
+    p.add_argument("--steps", type=int, default=4000)
+    p.add_argument("--report", type=int, nargs="+", default=[10, 100, 1000, 4000])
+    p.set_defaults(fn=bench_penalty)
+    p = sub.add_parser("detok", help="incremental UTF-8 detokenizer vs. re-decoding (parity + throughput)")
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--batch", type=int, default=64)
+    p.set_defaults(fn=bench_detok)
+    p = sub.add_parser("tokenizer", help="double-array trie vs. the object trie (build, memory, parity, encode throughput)")
+    p.add_argument("--samples", type=int, default=5000)
+    p.add_argument("--texts", type=int, default=1000)
+    p.set_defaults(fn=bench_tokenizer)
+    p = sub.add_parser("vocab_cache", help="tokenizer startup: vocab file vs. compiled cache (parity + time)")
+    p.set_defaults(fn=bench_vocab_cache)
+    p = sub.add_parser("prompt", help="multimodal prompt ids without tokenizing pads + index_copy_ splice")
+    p.add_argument("--images", type=int, default=1)
+    p.set_defaults(fn=bench_prompt)
+    p = sub.add_parser("chunked", help="chunked prefill with image spans straddling chunk boundaries (parity)")
+    p.add_argument("--images", type=int, default=2)
+    p.add_argument("--chunks", type=int, nargs="+", default=[100, 256, 1000])
+    p.set_defaults(fn=bench_chunked)
+    p = sub.add_parser("encoder_batch", help="encoder micro-batching of concurrent requests vs. one encoder call each (parity + images/s)")
+    p.add_argument("--requests", type=int, default=256)
+    p.add_argument("--batch", type=int, default=32)
+    p.add_argument("--window_ms", type=float, default=5.0)
+    p.set_defaults(fn=bench_encoder_batch)
+    p = sub.add_parser("preprocess", help="torch image preprocessing vs. the HF Siglip / CLIP processors (parity + images/s)")
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_preprocess)
+    args = parser.parse_args()
+    args.fn(args)
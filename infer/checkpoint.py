@@ -0,0 +1,147 @@
+########################################################################################################
+# Pre-converted inference checkpoints
+#
+# `convert` turns a training `.pth` (llm.* / proj.* keys) into one safetensors-compatible file that is
+# already in inference layout: matrices transposed, cast to the target dtype and optionally quantized
+# (see convert_rwkv7_weights), so loading is a memory map plus, on GPU, one host->device copy per tensor.
+# Tensors are ordered by element size and the data section starts 64-byte aligned, so every tensor is
+# naturally aligned inside the map.
+#
+#   python -m infer.checkpoint convert /path/model.pth /path/model.safetensors --strategy "cuda bf16"
+#   python -m infer.checkpoint load /path/model.safetensors --strategy "cuda bf16"   # load time / peak RSS
+########################################################################################################
+
+import os, json, struct, time, resource, mmap as _mmap
+import torch
+
+FORMAT = 'worldrwkv-infer'
+FORMAT_VERSION = 1
+ALIGN = 64
+
+_DTYPES = {
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+}
+
+def _dtype_name(dtype):
+    for k, v in _DTYPES.items():
+        if v == dtype:
+            return k
+    raise ValueError(f"unsupported checkpoint dtype {dtype}")
+
+def parse_strategy(strategy):
+    """
+    'cuda bf16i4' -> ('cuda', torch.bfloat16, 4)
+    """
+    device, prec = strategy.split(' ')
+    dtype = {'fp16': torch.half, 'fp32': torch.float32, 'bf16': torch.bfloat16}[prec[:4]]
+    return device, dtype, {'': 0, 'i8': 8, 'i4': 4}[prec[4:]]
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on linux
+
+def save_checkpoint(path, sections, meta=None):
+    """
+    Writes {section: {name: tensor}} as '<section>.<name>' entries of a safetensors file, atomically.
+    """
+    items = [(f'{sec}.{name}', t) for sec, tensors in sections.items() for name, t in tensors.items()]
+    items.sort(key=lambda it: -it[1].element_size()) # keeps every offset aligned to its element size
+    header, offset = {}, 0
+    for name, t in items:
+        n = t.numel() * t.element_size()
+        header[name] = {'dtype': _dtype_name(t.dtype), 'shape': list(t.shape), 'data_offsets': [offset, offset + n]}
+        offset += n
+    header['__metadata__'] = {k: str(v) for k, v in {'format': FORMAT, 'version': FORMAT_VERSION, **(meta or {})}.items()}
+    h = json.dumps(header).encode('utf-8')
+    h += b' ' * ((-(8 + len(h))) % ALIGN) # safetensors allows trailing spaces in the header
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(h)))
+        f.write(h)
+        for _, t in items:
+            t = t.detach().contiguous().cpu()
+            if t.numel() > 0:
+                f.write(t.view(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp, path)
+
+def load_checkpoint(path, device='cpu'):
+    """
+    Maps a checkpoint written by `save_checkpoint`. Returns ({section: {name: tensor}}, metadata).
+    On cpu the tensors point into a copy-on-write map of the file (nothing is read up front); on another
+    device each tensor is copied over on its own, so at most one tensor is staged in host memory.
+    """
+    with open(path, 'rb') as f:
+        buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY)
+    (n,) = struct.unpack('<Q', buf[:8])
+    header = json.loads(bytes(buf[8:8 + n]).decode('utf-8'))
+    meta = header.pop('__metadata__', {})
+    if meta.get('format') != FORMAT:
+        raise ValueError(f"{path} is not a converted WorldRWKV checkpoint (run `python -m infer.checkpoint convert`)")
+    if int(meta['version']) > FORMAT_VERSION:
+        raise ValueError(f"checkpoint version {meta['version']} is newer than supported ({FORMAT_VERSION})")
+    start = 8 + n
+    sections = {}
+    for name, e in header.items():
+        sec, key = name.split('.', 1)
+        begin, end = e['data_offsets']
+        dtype = _DTYPES[e['dtype']]
+        if end > begin:
+            t = torch.frombuffer(buf, dtype=dtype, count=(end - begin) // torch.empty(0, dtype=dtype).element_size(), offset=start + begin)
+        else:
+            t = torch.empty(0, dtype=dtype)
+        t = t.view(e['shape'])
+        if device != 'cpu':
+            t = t.to(device)
+        sections.setdefault(sec, {})[key] = t
+    return sections, meta
+
+def convert(src, dst, strategy='cuda bf16'):
+    """
+    Converts a training checkpoint (`.pth` with llm.* / proj.* keys) for `strategy` (e.g. 'cuda bf16i8').
+    """
+    from infer.rwkv.model import convert_rwkv7_weights
+    _, dtype, quant_bits = parse_strategy(strategy)
+    weights = torch.load(src, map_location='cpu', mmap=True, weights_only=True)
+    llm, proj = {}, {}
+    for key in list(weights.keys()):
+        if key.startswith('proj.'):
+            proj[key[5:]] = weights.pop(key).to(dtype)
+        elif key.startswith('llm.'):
+            llm[key[4:]] = weights.pop(key)
+    del weights
+    convert_rwkv7_weights(llm, dtype, quant_bits)
+    save_checkpoint(dst, {'llm': llm, 'proj': proj}, meta={'strategy': strategy, 'source': os.path.basename(src)})
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="WorldRWKV checkpoint converter")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("convert", help="write an inference-ready checkpoint")
+    p.add_argument("src", type=str)
+    p.add_argument("dst", type=str)
+    p.add_argument("--strategy", type=str, default="cuda bf16")
+    p = sub.add_parser("load", help="load a checkpoint into RWKV, report load time and peak RSS")
+    p.add_argument("path", type=str, help=".safetensors from `convert`, or a training .pth for comparison")
+    p.add_argument("--strategy", type=str, default="cuda bf16")
+    args = parser.parse_args()
+
+    if args.cmd == "convert":
+        t0 = time.perf_counter()
+        convert(args.src, args.dst, args.strategy)
+        print(f'wrote {args.dst} ({os.path.getsize(args.dst)/2**20:.1f} MB) in {time.perf_counter()-t0:.1f}s')
+    else:
+        from infer.rwkv.model import RWKV
+        device = parse_strategy(args.strategy)[0]
+        t0 = time.perf_counter()
+        if args.path.endswith('.pth'):
+            weights = torch.load(args.path, map_location=device)
+            llm = {k[4:]: v for k, v in weights.items() if k.startswith('llm.')}
+        else:
+            llm = load_checkpoint(args.path, device)[0]['llm']
+        model = RWKV(model=llm, strategy=args.strategy)
+        print(f'{args.path}: loaded in {time.perf_counter()-t0:.2f}s, peak RSS {peak_rss_mb():.0f} MB')
@@ -0,0 +1,94 @@
+########################################################################################################
+# Encoder micro-batching across concurrent requests
+#
+# Requests submit their images / audio and get a future back. A worker thread waits up to `window`
+# seconds after the first pending item for more to arrive, runs them through the encoder as one batch
+# (Worldinfer.encode_batch: inference mode, no hidden states kept) and routes each request's projected
+# features back to its future. At batch 1 the vision encoder leaves most of the GPU idle, so images/s
+# grows with the batch.
+########################################################################################################
+
+import threading, queue, time
+from concurrent.futures import Future
+
+def media_count(media):
+    return len(media) if isinstance(media, (list, tuple)) else 1
+
+class EncoderBatcher():
+    def __init__(self, encode_batch, max_items=32, window=0.005):
+        self.encode_batch = encode_batch # list of modality inputs -> list of projected features, one per input
+        self.max_items = max_items # images (or clips) per encoder batch
+        self.window = window # seconds to wait for more requests once one is pending
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def submit(self, media):
+        """
+        Queues `media` for the next batch; the returned future resolves to its projected features.
+        """
+        fut = Future()
+        self.pending.put((media, fut))
+        if self._thread is None:
+            self.start()
+        return fut
+
+    def __call__(self, media):
+        return self.submit(media).result()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='encoder-batcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self.pending.get(timeout=0.05)]
+            except queue.Empty:
+                continue
+            n = media_count(batch[0][0])
+            deadline = time.perf_counter() + self.window
+            while n < self.max_items:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n += media_count(item[0])
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        batch = [(m, f) for m, f in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            out = self.encode_batch([m for m, _ in batch])
+        except Exception as e:
+            for _, f in batch:
+                f.set_exception(e)
+            return
+        self.batches += 1
+        self.items += sum(media_count(m) for m, _ in batch)
+        for (_, f), x in zip(batch, out):
+            f.set_result(x)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'items_per_batch': self.items / self.batches if self.batches else 0.0,
+            'pending': self.pending.qsize(),
+        }
@@ -0,0 +1,152 @@
+########################################################################################################
+# Encoder output cache: media content hash -> projected embeddings
+#
+# The same image / audio clip often comes back (multi-question eval sets, retries, chat UIs that re-send
+# the image every turn). Entries are keyed by the encoder identity plus a hash of the decoded pixels or
+# waveform, so they are independent of file names and encodings. Recently used embeddings stay in memory
+# (on the device they were produced on), older ones spill to an optional disk tier, both LRU with a byte
+# budget.
+########################################################################################################
+
+import os, threading, hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+def media_hash(media):
+    """
+    Content hash of a decoded modality input: PIL image(s), numpy / torch arrays (waveforms, pixels) or
+    nested lists of them. Returns a hex string.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _update(h, media)
+    return h.hexdigest()
+
+def _update(h, media):
+    if isinstance(media, (list, tuple)):
+        h.update(f'list{len(media)}'.encode())
+        for m in media:
+            _update(h, m)
+    elif isinstance(media, torch.Tensor):
+        t = media.detach().contiguous().cpu()
+        h.update(f'tensor{t.dtype}{tuple(t.shape)}'.encode())
+        h.update(t.view(-1).view(torch.uint8).numpy())
+    elif isinstance(media, np.ndarray):
+        a = np.ascontiguousarray(media)
+        h.update(f'array{a.dtype}{a.shape}'.encode())
+        h.update(a.view(np.uint8))
+    elif hasattr(media, 'tobytes') and hasattr(media, 'mode'): # PIL.Image
+        h.update(f'image{media.mode}{media.size}'.encode())
+        h.update(media.tobytes())
+    elif isinstance(media, (str, bytes)):
+        h.update(media.encode() if isinstance(media, str) else media)
+    else:
+        raise TypeError(f"cannot hash modality input of type {type(media).__name__}")
+
+class EncoderCache():
+    def __init__(self, max_bytes=1 << 30, disk_dir=None, disk_bytes=8 << 30):
+        self.max_bytes = max_bytes # budget for embeddings kept in memory
+        self.disk_dir = disk_dir # spill directory, None disables the disk tier
+        self.disk_bytes = disk_bytes
+        self.mem = OrderedDict() # key -> tensor, least recently used first
+        self.disk = OrderedDict() # key -> file size
+        self.mem_used = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(encoder_id, media):
+        return f'{hashlib.blake2b(encoder_id.encode(), digest_size=8).hexdigest()}-{media_hash(media)}'
+
+    def get(self, key):
+        with self.lock:
+            x = self.mem.get(key)
+            if x is not None:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                return x
+            if key in self.disk:
+                x = torch.load(self._path(key), map_location='cpu')
+                device = x.pop('device')
+                x = x['x'].to(device)
+                self._drop_disk(key)
+                self._put_mem(key, x)
+                self.hits += 1
+                self.disk_hits += 1
+                return x
+            self.misses += 1
+            return None
+
+    def put(self, key, x):
+        with self.lock:
+            if key in self.mem:
+                self.mem_used -= _nbytes(self.mem.pop(key))
+            if key in self.disk:
+                self._drop_disk(key)
+            self._put_mem(key, x.detach())
+
+    def get_or_compute(self, key, fn):
+        x = self.get(key)
+        if x is None:
+            x = fn()
+            self.put(key, x)
+        return x
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'mem_entries': len(self.mem),
+            'mem_bytes': self.mem_used,
+            'disk_entries': len(self.disk),
+            'disk_bytes': self.disk_used,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.disk):
+                self._drop_disk(key)
+            self.mem.clear()
+            self.mem_used = 0
+
+    ####################################################################################################
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.pt')
+
+    def _put_mem(self, key, x):
+        self.mem[key] = x
+        self.mem_used += _nbytes(x)
+        while self.mem_used > self.max_bytes and len(self.mem) > 1:
+            old, y = self.mem.popitem(last=False)
+            self.mem_used -= _nbytes(y)
+            self._put_disk(old, y)
+
+    def _put_disk(self, key, x):
+        if self.disk_dir is None or _nbytes(x) > self.disk_bytes:
+            return
+        path = self._path(key)
+        torch.save({'x': x.cpu(), 'device': str(x.device)}, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        self.disk[key] = os.path.getsize(path)
+        self.disk_used += self.disk[key]
+        while self.disk_used > self.disk_bytes:
+            self._drop_disk(next(iter(self.disk)))
+
+    def _drop_disk(self, key):
+        self.disk_used -= self.disk.pop(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+def _nbytes(x):
+    return x.numel() * x.element_size()
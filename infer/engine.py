@@ -0,0 +1,295 @@
+########################################################################################################
+# Continuous-batching generation engine for the RWKV-7 inference path
+#
+# One scheduler thread owns the model. Every step it admits waiting requests, spends a bounded
+# prompt-token budget on encoder + prefill work, then runs one batched decode step for all running
+# requests and retires the finished ones (stop token / max_tokens).
+########################################################################################################
+
+import threading, queue, time, itertools
+from concurrent.futures import wait, FIRST_COMPLETED
+import torch
+
+from infer.rwkv.utils import PIPELINE_ARGS, Prompt, modality_features, chunk_modality
+from infer.state_pool import StatePool
+
+class Request():
+    _ids = itertools.count()
+
+    def __init__(self, prompt, modality=None, max_tokens=500, args=None, callback=None, state=None, on_finish=None, media_key=None):
+        self.id = next(Request._ids)
+        self.prompt = prompt # text, or a list of token ids (a Prompt carries its modality spans)
+        self.modality = modality
+        self.media_key = media_key # content hash of the raw modality, keys its placeholders in the prefix cache
+        self.max_tokens = max_tokens
+        self.args = args
+        self.callback = callback # called with each decoded text piece, from the engine thread
+        self.on_finish = on_finish # called with the request once it is done, from the engine thread
+        self.state = state # initial state, prefilled in place; holds the final state once finished
+
+        self.tokens = None # prompt tokens
+        self.pos = 0 # prompt tokens prefilled so far
+        self.spans = [] # modality placeholder runs in `tokens`
+        self.key = None # prefix cache key
+        self.sign = None
+        self.encoding = None # pending encoder future, when the encoder batches across requests
+        self.out = None
+        self.prompt_tokens = 0
+        self.all_tokens = []
+        self.detok = None # incremental detokenizer of the output, PIPELINE.stream_decoder
+        self.out_str = ''
+        self.last_token = None # the final sampled token, which is not in the final state
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+        self._done = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the request finishes, returns (text, state).
+        """
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.out_str, self.state
+
+class Engine():
+    def __init__(self, pipeline, args=None, encoder=None, max_batch=16, prefill_tokens=1024, media_key=None):
+        self.pipeline = pipeline
+        self.model = pipeline.model
+        self.args = args if args is not None else PIPELINE_ARGS()
+        self.encoder = encoder # modality -> projected embeddings, e.g. Worldinfer.encode_modality or an EncoderBatcher
+        self.media_key = media_key # modality -> content hash on the host, e.g. Worldinfer.media_key
+        self.max_batch = max_batch
+        self.prefill_tokens = prefill_tokens # prompt tokens prefilled per step, bounds the decode stall
+
+        self.waiting = queue.Queue()
+        self.prefilling = []
+        self.running = [] # rows of the decode batch, row b lives in pool slot b
+        self.pool = StatePool(self.model, max_batch)
+        self.penalty = pipeline.penalty_state(max_batch, self.model.args.vocab_size, self.pool.device) # row b = slot b
+        self.logits = None # next-token logits of `running`, [B, vocab]
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def submit(self, prompt, modality=None, max_tokens=500, args=None, callback=None, state=None, on_finish=None, media_key=None):
+        """
+        Queues a request. The engine takes ownership of `state` and prefills into it, so pass a copy
+        (SessionStore.match already returns one) if the caller keeps using it.
+        """
+        if len(prompt) == 0:
+            raise ValueError("empty prompt: the first token is sampled from the logits of the last prompt token")
+        req = Request(prompt, modality, max_tokens, args if args is not None else self.args, callback, state, on_finish, media_key)
+        self.waiting.put(req)
+        return req
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='rwkv-engine', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while not self._stop.is_set():
+            if not self.step():
+                try:
+                    self._enqueue(self.waiting.get(timeout=0.05))
+                except queue.Empty:
+                    pass
+            elif not self.running and all(self._encoding(req) for req in self.prefilling): # only encoder work left
+                wait([req.encoding for req in self.prefilling], timeout=0.05, return_when=FIRST_COMPLETED)
+
+    def step(self):
+        """
+        One scheduler iteration. Returns False when there is nothing to do.
+        """
+        self._admit()
+        budget = self.prefill_tokens
+        for req in list(self.prefilling):
+            if budget <= 0:
+                break
+            budget -= self._prefill(req, budget)
+        if self.running:
+            self._decode()
+        return len(self.prefilling) + len(self.running) > 0
+
+    def _admit(self):
+        while len(self.prefilling) + len(self.running) < self.max_batch:
+            try:
+                self._enqueue(self.waiting.get_nowait())
+            except queue.Empty:
+                break
+
+    def _enqueue(self, req):
+        if req.modality is not None and hasattr(self.encoder, 'submit'): # encoded in the background, batched with other requests
+            req.encoding = self.encoder.submit(req.modality)
+        self.prefilling.append(req)
+
+    def _encoding(self, req):
+        return req.tokens is None and req.encoding is not None and not req.encoding.done()
+
+    @torch.no_grad()
+    def _prefill(self, req, budget):
+        if req.cancelled:
+            if req.encoding is not None:
+                req.encoding.cancel() # skipped by the batcher if it has not started
+            self.prefilling.remove(req)
+            self._finish(req, 'cancelled')
+            return 0
+        if self._encoding(req):
+            return 0
+        try:
+            if req.tokens is None:
+                self._start(req)
+            cache = self.pipeline.prefix_cache
+            end = min(len(req.tokens), req.pos + min(budget, req.args.chunk_len))
+            snap = req.spans[-1][1] if req.spans else len(req.tokens) # snapshot right after the last modality span
+            if req.pos < snap < end:
+                end = snap
+            n = end - req.pos
+            if n > 0:
+                rows, local = chunk_modality(req.spans, req.sign, req.pos, end) # the feature rows this chunk covers
+                req.out, req.state = self.model.forward(req.tokens[req.pos:end], req.state, sign=rows, spans=local)
+                req.pos = end
+                if req.key is not None and end in (snap, len(req.tokens)):
+                    cache.insert(req.key[:end], req.state, req.out)
+        except Exception as e:
+            self.prefilling.remove(req)
+            self._finish(req, 'error', e)
+            return 0
+        if req.pos == len(req.tokens):
+            self.prefilling.remove(req)
+            self._join(req, req.out)
+        return n
+
+    def _start(self, req):
+        if req.encoding is not None:
+            req.sign, req.encoding = req.encoding.result(), None
+        elif req.modality is not None and self.encoder is not None:
+            req.sign = self.encoder(req.modality)
+        req.detok = self.pipeline.stream_decoder()
+        if isinstance(req.prompt, Prompt):
+            req.tokens = req.prompt
+        else:
+            req.tokens = list(req.prompt) if isinstance(req.prompt, (list, tuple)) else self.pipeline.encode(req.prompt)
+        req.prompt_tokens = len(req.tokens)
+        if req.sign is not None:
+            req.spans, req.sign = modality_features(req.tokens, req.sign) # raises if the pads and features disagree
+        cache = self.pipeline.prefix_cache
+        if req.state is None and cache is not None:
+            if req.sign is not None and req.media_key is None and self.media_key is not None:
+                req.media_key = self.media_key(req.modality) # hashing the features instead would copy them to the host
+            req.key = cache.make_key(req.tokens, req.sign, req.media_key)
+            req.pos, req.state, req.out = cache.match(req.key) # chunks can start inside a span, any prefix will do
+            if req.out is None and req.pos > 0: # a snapshot without logits cannot end the prompt, prefill it all
+                req.pos, req.state = 0, None
+
+    def _join(self, req, out):
+        req.sign, req.out, req.key = None, None, None
+        slot = self.pool.alloc(zero=False) # loaded right below
+        assert slot == len(self.running)
+        self.pool.load(slot, req.state)
+        self.penalty.reset(slot, req.args)
+        self.running.append(req)
+        if self.logits is None:
+            self.logits = out.unsqueeze(0)
+        else:
+            self.logits = torch.cat([self.logits, out.unsqueeze(0)])
+        req.state = None
+
+    @torch.no_grad()
+    def _decode(self):
+        pipeline = self.pipeline
+        keep, tokens, live = [], [], []
+        running = self.running
+        self.penalty.apply(self.logits)
+        ids = pipeline.sample_logits_batch(self.logits, temperature=[req.args.temperature for req in running],
+            top_p=[req.args.top_p for req in running], top_k=[req.args.top_k for req in running])
+        stop = self.penalty.update(ids)
+        sampled, stop = torch.stack([ids, stop.long()]).tolist() # one host sync per step
+        for b, req in enumerate(running):
+            token = sampled[b]
+            if req.cancelled:
+                self._retire(req, b, 'cancelled')
+                continue
+            if req.first_token_time is None:
+                req.first_token_time = time.perf_counter()
+            req.last_token = token
+            if stop[b]:
+                self._retire(req, b, 'stop')
+                continue
+            req.all_tokens += [token]
+            live.append(b)
+
+        # complete characters only, so a callback never sees half of a multi-byte sequence
+        pieces = pipeline.decode_many([running[b].detok for b in live], [sampled[b] for b in live])
+        for b, tmp in zip(live, pieces):
+            req = running[b]
+            if tmp:
+                if req.callback:
+                    try:
+                        req.callback(tmp)
+                    except Exception:
+                        req.cancel() # e.g. the client went away
+                req.out_str += tmp
+
+            if len(req.all_tokens) >= req.max_tokens:
+                self._retire(req, b, 'length')
+                continue
+            keep.append(b)
+            tokens.append([sampled[b]])
+
+        if len(keep) < len(self.running):
+            # free the retired slots and pack the remaining rows into slots [0:B]
+            kept = set(keep)
+            for b in range(len(self.running)):
+                if b not in kept:
+                    self.pool.free(b)
+            for j, b in enumerate(keep):
+                if b != j:
+                    self.pool.move(b, j)
+                    self.penalty.move(b, j)
+            self.running = [self.running[b] for b in keep]
+            if len(keep) == 0:
+                self.logits = None
+                return
+        self.logits, _ = self.model.forward_batch(tokens, self.pool.batch(len(self.running)))
+
+    def _retire(self, req, b, reason):
+        req.state = self.pool.read(b)
+        self._finish(req, reason)
+
+    def _finish(self, req, reason, error=None):
+        if req.detok is not None and error is None:
+            tail = req.detok.flush() # bytes held back for a character the output stopped in the middle of
+            if tail:
+                if req.callback and not req.cancelled:
+                    try:
+                        req.callback(tail)
+                    except Exception:
+                        pass
+                req.out_str += tail
+        req.finish_reason = reason
+        req.error = error
+        req._done.set()
+        if req.on_finish:
+            try:
+                req.on_finish(req)
+            except Exception:
+                pass
@@ -0,0 +1,206 @@
+########################################################################################################
+# Prefix-state cache: radix tree of token prefixes -> RWKV state snapshots
+#
+# An RWKV state has a constant size, so the state reached after a prompt prefix (system prompt, chat
+# template, image block) can be stored once and reused by every prompt that starts with it.
+# Placeholder tokens of a modality span are keyed by a hash of the span content, so the same pads with
+# a different image never match.
+########################################################################################################
+
+import threading, hashlib
+from collections import OrderedDict
+import torch
+
+from infer.rwkv.utils import IMAGE_PAD_ID
+
+def state_nbytes(state):
+    return sum(s.numel() * s.element_size() for s in state)
+
+class _Node():
+    __slots__ = ('key', 'parent', 'children', 'state', 'logits', 'nbytes', 'device')
+
+    def __init__(self, key=(), parent=None):
+        self.key = key # edge label from the parent
+        self.parent = parent
+        self.children = {}
+        self.state = None
+        self.logits = None
+        self.nbytes = 0
+        self.device = None # device of the snapshot before offload
+
+class PrefixCache():
+    def __init__(self, max_bytes=2 << 30, host_bytes=8 << 30):
+        self.max_bytes = max_bytes # budget for snapshots kept on the model device
+        self.host_bytes = host_bytes # budget for snapshots offloaded to host memory
+        self.root = _Node()
+        self.lru = OrderedDict() # node -> None, least recently used first
+        self.device_used = 0
+        self.host_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(tokens, sign=None, media_key=None, pad_id=IMAGE_PAD_ID):
+        """
+        Cache key for a prompt: token ids, with each placeholder replaced by (content hash, index).
+        `media_key` is a precomputed hash of the media (e.g. Worldinfer.media_key, a hash of the decoded
+        pixels on the host). Without it the projected embeddings in `sign` are hashed, which copies all of
+        them to the host and syncs the device on every call: a fallback, not for the serving path.
+        """
+        if not isinstance(sign, torch.Tensor):
+            return tuple(tokens)
+        if media_key is None:
+            media_key = hashlib.blake2b(sign.detach().contiguous().view(-1).view(torch.uint8).cpu().numpy(), digest_size=16).hexdigest()
+        key, j = [], 0
+        for t in tokens:
+            if t == pad_id:
+                key.append((media_key, j))
+                j += 1
+            else:
+                key.append(t)
+        return tuple(key)
+
+    def match(self, key):
+        """
+        Longest cached prefix of `key`.
+        Returns (n, state, logits) with copies on the snapshot's original device, or (0, None, None).
+        """
+        with self.lock:
+            node, i = self.root, 0
+            best, best_n = None, 0
+            while i < len(key):
+                child = node.children.get(key[i])
+                if child is None or tuple(key[i:i+len(child.key)]) != child.key:
+                    break
+                node, i = child, i + len(child.key)
+                if node.state is not None:
+                    best, best_n = node, i
+            if best is None:
+                self.misses += 1
+                return 0, None, None
+            self.lru.move_to_end(best)
+            if self._on_host(best): # hot again, bring it back to the device
+                self._account(best, -1)
+                best.state = [s.to(best.device) for s in best.state]
+                best.logits = best.logits.to(best.device)
+                self._account(best, +1)
+                self._evict()
+            if best.state is None: # did not fit back on the device
+                self.misses += 1
+                return 0, None, None
+            self.hits += 1
+            self.hit_tokens += best_n
+            state = [s.to(best.device, copy=True) for s in best.state]
+            logits = best.logits.to(best.device, copy=True)
+            return best_n, state, logits
+
+    def insert(self, key, state, logits):
+        """
+        Snapshots `state` and the next-token `logits` as the state reached after `key`. Every snapshot
+        carries its logits, so a hit covering a whole prompt can start sampling without a forward.
+        """
+        key = tuple(key)
+        if len(key) == 0:
+            return
+        if logits is None:
+            raise ValueError("a prefix snapshot needs the logits of its last token")
+        with self.lock:
+            node = self._find_or_create(key)
+            if node.state is not None:
+                self._account(node, -1)
+            node.state = [s.clone() for s in state]
+            node.logits = logits.clone()
+            node.device = state[0].device
+            node.nbytes = state_nbytes(node.state) + node.logits.numel() * node.logits.element_size()
+            self.lru[node] = None
+            self._account(node, +1)
+            self._evict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.lru),
+            'device_bytes': self.device_used,
+            'host_bytes': self.host_used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'hit_tokens': self.hit_tokens,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.root = _Node()
+            self.lru.clear()
+            self.device_used = self.host_used = 0
+
+    ####################################################################################################
+
+    def _find_or_create(self, key):
+        node, i = self.root, 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None:
+                child = _Node(key[i:], node)
+                node.children[key[i]] = child
+                return child
+            n = 0
+            while n < len(child.key) and i + n < len(key) and child.key[n] == key[i + n]:
+                n += 1
+            if n < len(child.key): # split the edge
+                mid = _Node(child.key[:n], node)
+                node.children[key[i]] = mid
+                child.key = child.key[n:]
+                child.parent = mid
+                mid.children[child.key[0]] = child
+                child = mid
+            node, i = child, i + n
+        return node
+
+    def _on_host(self, node):
+        return node.state[0].device.type == 'cpu' and node.device.type != 'cpu'
+
+    def _account(self, node, sign):
+        if self._on_host(node):
+            self.host_used += sign * node.nbytes
+        else:
+            self.device_used += sign * node.nbytes
+
+    def _release(self, node):
+        self._account(node, -1)
+        self.lru.pop(node, None)
+        node.state = node.logits = None
+        node.nbytes = 0
+        # drop empty leaves, merge single-child chains left behind
+        while node is not self.root and node.state is None and len(node.children) <= 1:
+            parent = node.parent
+            if len(node.children) == 0:
+                del parent.children[node.key[0]]
+            else:
+                (child,) = node.children.values()
+                child.key = node.key + child.key
+                child.parent = parent
+                parent.children[node.key[0]] = child
+            node = parent
+
+    def _evict(self):
+        # least recently used snapshots leave the device first (offloaded to host memory), then host memory
+        for node in list(self.lru):
+            if self.device_used <= self.max_bytes:
+                break
+            if self._on_host(node):
+                continue
+            if node.device.type != 'cpu' and node.nbytes <= self.host_bytes:
+                self._account(node, -1)
+                node.state = [s.to('cpu') for s in node.state]
+                node.logits = node.logits.to('cpu')
+                self._account(node, +1)
+            else:
+                self._release(node)
+        for node in list(self.lru):
+            if self.host_used <= self.host_bytes:
+                break
+            if self._on_host(node):
+                self._release(node)
@@ -244,3 +244,64 @@ void cuda_mm8_one<fp16>(int N, int M,
         N, M, cast(x), w, w_stride,
         cast(mx), cast(rx), cast(my), cast(ry), y);
 }
+
+// grouped int8 / int4 weights (infer/rwkv/model.py quantize_weight) times 1..MMQ_MAX_B rows of x:
+// w is int8 [I,O] or two int4 rows per byte [I/2,O] (row 2i in the low nibble, stored +8), s is [I/G,O].
+// Each thread owns one output column and a slice of the groups; the weights are dequantized in registers
+// and each group's partial sums are scaled once.
+#define MMQ_JSPLIT 16
+#define MMQ_TILE 256
+#define MMQ_MAX_B 4
+
+template <int BITS>
+__global__ void kernel_mmq_one(
+    const int B, const int I, const int O, const int G,
+    const float *__restrict__ const x,
+    const uint8_t *__restrict__ const w,
+    const float *__restrict__ const s,
+    float *__restrict__ const y) {
+
+    const int k = blockIdx.y * blockDim.y + threadIdx.y;
+    const int ng = I / G;
+    const int per = (ng + gridDim.x - 1) / gridDim.x;
+    const int g0 = min(ng, blockIdx.x * per);
+    const int g1 = min(ng, (blockIdx.x + 1) * per);
+
+    if (k < O) {
+        float acc[MMQ_MAX_B] = {0};
+        for (int g = g0; g < g1; ++g) {
+            float part[MMQ_MAX_B] = {0};
+            if (BITS == 8) {
+                for (int j = g * G; j < (g + 1) * G; ++j) {
+                    const float q = float((int8_t)w[j * O + k]);
+                    for (int b = 0; b < B; ++b)
+                        part[b] += x[b * I + j] * q;
+                }
+            } else {
+                for (int j = g * G; j < (g + 1) * G; j += 2) {
+                    const uint8_t p = w[(j >> 1) * O + k];
+                    const float q0 = float(int(p & 15) - 8);
+                    const float q1 = float(int(p >> 4) - 8);
+                    for (int b = 0; b < B; ++b)
+                        part[b] += x[b * I + j] * q0 + x[b * I + j + 1] * q1;
+                }
+            }
+            const float sc = s[g * O + k];
+            for (int b = 0; b < B; ++b)
+                acc[b] += part[b] * sc;
+        }
+        for (int b = 0; b < B; ++b)
+            atomicAdd(&y[b * O + k], acc[b]);
+    }
+}
+
+void cuda_mmq_one(int B, int I, int O, int G, int bits,
+                  float *x, uint8_t *w, float *s, float *y) {
+    assert(B <= MMQ_MAX_B);
+    dim3 blockSize(1, MMQ_TILE);
+    dim3 gridSize(min(MMQ_JSPLIT, I / G), (O + blockSize.y - 1) / blockSize.y);
+    if (bits == 8)
+        kernel_mmq_one<8><<<gridSize, blockSize>>>(B, I, O, G, x, w, s, y);
+    else
+        kernel_mmq_one<4><<<gridSize, blockSize>>>(B, I, O, G, x, w, s, y);
+}
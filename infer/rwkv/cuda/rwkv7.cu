@@ -14,7 +14,7 @@ __global__ void kernel_forward(const int B, const int T, const int C, const int
     const int e = blockIdx.x / H;
     const int h = blockIdx.x % H;
     const int i = threadIdx.x;
-    _state += h*_N_*_N_ + i*_N_; // wrong if B > 1 !!!
+    _state += e*H*_N_*_N_ + h*_N_*_N_ + i*_N_;
 
     float state[_N_];
     #pragma unroll
@@ -60,18 +60,15 @@ __global__ void kernel_forward(const int B, const int T, const int C, const int
 void cuda_forward_bf16(int B, int T, int C, int H, float *state, bf16 *r, bf16* w, bf16 *k, bf16 *v, bf16 *a, bf16 *b, bf16 *y)
 {
     assert(H*_N_ == C);
-    assert(B == 1); // only for B=1
     kernel_forward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, state, r, w, k, v, a, b, y);
 }
 void cuda_forward_fp16(int B, int T, int C, int H, float *state, fp16 *r, fp16* w, fp16 *k, fp16 *v, fp16 *a, fp16 *b, fp16 *y)
 {
     assert(H*_N_ == C);
-    assert(B == 1); // only for B=1
     kernel_forward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, state, r, w, k, v, a, b, y);
 }
 void cuda_forward_fp32(int B, int T, int C, int H, float *state, fp32 *r, fp32* w, fp32 *k, fp32 *v, fp32 *a, fp32 *b, fp32 *y)
 {
     assert(H*_N_ == C);
-    assert(B == 1); // only for B=1
     kernel_forward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, state, r, w, k, v, a, b, y);
 }
@@ -23,6 +23,8 @@ void cuda_mm8_one(int N, int M,
                   F *mx, F *rx,
                   F *my, F *ry,
                   float *y);
+void cuda_mmq_one(int B, int I, int O, int G, int bits,
+                  float *x, uint8_t *w, float *s, float *y);
 
 void wkv_forward(int64_t B, int64_t T, int64_t C,
                  torch::Tensor &w, torch::Tensor &u,
@@ -116,6 +118,18 @@ void mm8_one(int64_t N, int64_t M,
     }
 }
 
+void mmq_one(int64_t B, int64_t I, int64_t O, int64_t G, int64_t bits,
+             torch::Tensor &x, torch::Tensor &w,
+             torch::Tensor &s, torch::Tensor &y) {
+    assert(x.is_contiguous() && w.is_contiguous() && s.is_contiguous() && y.is_contiguous());
+    assert(x.scalar_type() == c10::ScalarType::Float && s.scalar_type() == c10::ScalarType::Float);
+    assert(y.scalar_type() == c10::ScalarType::Float);
+    const at::cuda::OptionalCUDAGuard device_guard(device_of(w));
+    cuda_mmq_one(B, I, O, G, bits,
+                 x.data_ptr<float>(), reinterpret_cast<uint8_t *>(w.data_ptr()),
+                 s.data_ptr<float>(), y.data_ptr<float>());
+}
+
 using torch::Tensor;
 
 #ifndef DISABLE_CUBLAS_GEMM
@@ -126,6 +140,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("wkv_forward", &wkv_forward, "wkv forward");
     m.def("mm8_seq", &mm8_seq, "mm8 seq");
     m.def("mm8_one", &mm8_one, "mm8 one");
+    m.def("mmq_one", &mmq_one, "grouped int8 / int4 weights, 1-4 rows");
 #ifndef DISABLE_CUBLAS_GEMM
     m.def("gemm_fp16_cublas", &gemm_fp16_cublas, "gemv fp16 cublas");
 #endif
@@ -135,6 +150,7 @@ TORCH_LIBRARY(rwkv, m) {
     m.def("wkv_forward", wkv_forward);
     m.def("mm8_seq", mm8_seq);
     m.def("mm8_one", mm8_one);
+    m.def("mmq_one", mmq_one);
 #ifndef DISABLE_CUBLAS_GEMM
     m.def("gemm_fp16_cublas", gemm_fp16_cublas);
 #endif
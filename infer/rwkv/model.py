@@ -209,6 +209,20 @@ from typing import List
 DTYPE = None
 DEVICE = None
 HEAD_SIZE = 64
+CPU_CHUNK_LEN = int(os.environ.get('RWKV_CPU_CHUNK', '0')) # opt-in chunked wkv prefill without the CUDA kernel (e.g. 16, parity: bench wkv), 0 = per-token loop
+QUANT_GROUP = 128 # input rows sharing one scale in i8/i4 weights
+QUANT_TILE = 1 << 20 # i8/i4 weights dequantized at a time without the CUDA kernel
+
+# per-layer tensors in RWKV.layers / RWKV.fused_layers, in the order the forward loops unpack them
+LAYER_KEYS = ('ln1.weight', 'ln1.bias', 'ln2.weight', 'ln2.bias',
+    'att.x_r', 'att.x_w', 'att.x_k', 'att.x_v', 'att.x_a', 'att.x_g',
+    'att.w0', 'att.w1', 'att.w2', 'att.a0', 'att.a1', 'att.a2', 'att.v0', 'att.v1', 'att.v2',
+    'att.g1', 'att.g2', 'att.k_k', 'att.k_a', 'att.r_k',
+    'att.receptance.weight', 'att.key.weight', 'att.value.weight', 'att.output.weight',
+    'att.receptance.weight.qs', 'att.key.weight.qs', 'att.value.weight.qs', 'att.output.weight.qs',
+    'att.ln_x.weight', 'att.ln_x.bias',
+    'ffn.x_k', 'ffn.key.weight', 'ffn.value.weight', 'ffn.key.weight.qs', 'ffn.value.weight.qs')
+FUSED_LAYER_KEYS = ('att.maa', 'att.lora1', 'att.lora2', 'att.rkv')
 
 if os.environ.get('RWKV_CUDA_ON') == '1':
     from torch.utils.cpp_extension import load
@@ -241,10 +255,136 @@ if os.environ.get('RWKV_CUDA_ON') == '1':
     def RWKV7_OP(state, r, w, k, v, a, b):
         return WKV_7.apply(state, r, w, k, v, a, b)
 
+    def RWKV7_BATCH_OP(state, r, w, k, v, a, b):
+        B, T, C = r.size()
+        H = C // HEAD_SIZE
+        y = torch.empty((B, T, C), device=r.device, dtype=r.dtype, memory_format=torch.contiguous_format)
+        if r.dtype == torch.float16:
+            torch.ops.wkv7s.forward_fp16(B, T, C, H, state, r, w, k, v, a, b, y)
+        elif r.dtype == torch.bfloat16:
+            torch.ops.wkv7s.forward_bf16(B, T, C, H, state, r, w, k, v, a, b, y)
+        else:
+            torch.ops.wkv7s.forward_fp32(B, T, C, H, state, r, w, k, v, a, b, y)
+        return y
+
+########################################################################################################
+
 ########################################################################################################
+# Weight-only quantization (strategy "cpu fp32i8", "cuda bf16i4", ...)
+# A [I,O] matrix is stored as int8 [I,O] (i8) or as int4 packed two rows per byte into uint8 [I/2,O] (i4),
+# with one float32 scale per group of QUANT_GROUP input rows and output column: scales [I/G,O].
+# Plain weights carry an empty scale tensor, so every matmul goes through matmul_q. Decode on CUDA runs the
+# mmq_one kernel, which dequantizes in registers; elsewhere the matrix is dequantized one cache-sized tile
+# at a time.
+########################################################################################################
+
+def quantize_weight(w, bits):
+    I, O = w.shape
+    G = QUANT_GROUP if I % QUANT_GROUP == 0 else I
+    qmax = 127 if bits == 8 else 7
+    wf = w.float().reshape(I // G, G, O)
+    s = (wf.abs().amax(dim=1) / qmax).clamp_min(1e-12) # [I/G,O]
+    q = (wf / s.unsqueeze(1)).round().clamp(-qmax, qmax).view(I, O).to(torch.int8)
+    if bits == 4:
+        q = (q + 8).to(torch.uint8)
+        q = q[0::2] | (q[1::2] << 4)
+    return q.contiguous(), s.contiguous()
+
+@MyStatic
+def matmul_q_tiled(x, w, s, G: int):
+    # dequantizes QUANT_TILE weights at a time (whole groups, or a slice of one group) into a float tile
+    # that stays in cache, and accumulates x_tile @ tile into y: the full float matrix never exists
+    I, O = x.shape[1], s.shape[1]
+    if G * O <= QUANT_TILE:
+        R = G * min(max(QUANT_TILE // (G * O), 1), I // G)
+    else:
+        R = max(QUANT_TILE // O, 2)
+        while G % R != 0 or (w.dtype == torch.uint8 and R % 2 != 0):
+            R -= 1
+    y = torch.zeros((x.shape[0], O), device=x.device, dtype=x.dtype)
+    for r0 in range(0, I, R):
+        r1 = min(r0 + R, I)
+        if w.dtype == torch.uint8: # int4, row 2i in the low nibble and row 2i+1 in the high one
+            wt = w[r0 // 2:r1 // 2]
+            q = torch.stack([(wt & 15).to(torch.int8) - 8, (wt >> 4).to(torch.int8) - 8], dim=1).view(r1 - r0, O)
+        else:
+            q = w[r0:r1]
+        g0 = r0 // G
+        ng = max((r1 - r0) // G, 1)
+        tile = (q.to(x.dtype).view(ng, -1, O) * s[g0:g0 + ng].unsqueeze(1).to(x.dtype)).view(r1 - r0, O)
+        y.addmm_(x[:, r0:r1], tile)
+    return y
+
+if os.environ.get('RWKV_CUDA_ON') == '1':
+    @MyStatic
+    def matmul_q_rows(x, w, s, G: int):
+        if w.device.type == 'cuda' and x.shape[0] <= 4:
+            # decode: the kernel reads the int8 / int4 weights once and applies the group scales to its
+            # per-group partial sums, nothing is dequantized to memory
+            B, I, O = x.shape[0], x.shape[1], s.shape[1]
+            y = torch.zeros((B, O), device=w.device, dtype=torch.float32)
+            torch.ops.rwkv.mmq_one(B, I, O, G, 4 if w.dtype == torch.uint8 else 8, x.float().contiguous(), w, s, y)
+            return y.to(x.dtype)
+        return matmul_q_tiled(x, w, s, G)
+else:
+    @MyStatic
+    def matmul_q_rows(x, w, s, G: int):
+        return matmul_q_tiled(x, w, s, G)
+
+@MyStatic
+def matmul_q(x, w, s):
+    if s.numel() == 0:
+        return x @ w
+    I = x.shape[-1]
+    out_shape = x.shape[:-1] + [s.shape[1]]
+    y = matmul_q_rows(x.reshape(-1, I), w, s, I // s.shape[0])
+    return y.view(out_shape)
+
+def convert_rwkv7_weights(z, dtype, quant_bits=0):
+    """
+    Puts a training-layout RWKV-7 state dict into inference layout, in place: matrices transposed to [in,out],
+    everything squeezed and cast to `dtype`, r_k flattened, and the large matrices quantized when quant_bits
+    is 8 or 4 (each gets a '<name>.qs' scale entry, empty for plain weights).
+    """
+    for k in list(z.keys()):
+        if 'key.weight' in k or 'value.weight' in k or 'receptance.weight' in k or 'output.weight' in k or 'head.weight' in k:
+            z[k] = z[k].t()
+            z[k] = z[k].squeeze().to(dtype=dtype)
+            if quant_bits > 0:
+                z[k], z[k+'.qs'] = quantize_weight(z[k], quant_bits)
+            else:
+                z[k+'.qs'] = torch.empty(0, device=z[k].device)
+            continue
+        z[k] = z[k].squeeze().to(dtype=dtype)
+        if k.endswith('att.r_k'): z[k] = z[k].flatten()
+    return z
+
+def weight_quant_bits(z):
+    w = z['head.weight']
+    return 8 if w.dtype == torch.int8 else 4 if w.dtype == torch.uint8 else 0
+
+def fuse_rwkv7_weights(z, n_layer):
+    """
+    Load-time layout for the fused decode path (RWKV(..., fused=True)), in place:
+    ln0 is folded into the embedding table; per layer, the six token-shift mix vectors are stacked as
+    att.maa [6,C] (order r k v w a g), receptance/key/value as att.rkv [3,C,C], and the LoRA pairs
+    (order v w a g) as att.lora1 [4,C,D] / att.lora2 [4,D,C], zero-padded to the largest rank D.
+    The separate matrices become views of the stacked ones, so nothing is stored twice.
+    """
+    C = z['emb.weight'].shape[1]
+    z['emb.weight'] = F.layer_norm(z['emb.weight'], (C,), weight=z['blocks.0.ln0.weight'], bias=z['blocks.0.ln0.bias'])
+    for i in range(n_layer):
+        att = f'blocks.{i}.att.'
+        z[att+'maa'] = torch.stack([z[att+'x_r'], z[att+'x_k'], z[att+'x_v'], z[att+'x_w'], z[att+'x_a'], z[att+'x_g']])
+        z[att+'rkv'] = torch.stack([z[att+'receptance.weight'], z[att+'key.weight'], z[att+'value.weight']])
+        z[att+'receptance.weight'], z[att+'key.weight'], z[att+'value.weight'] = z[att+'rkv'].unbind(0)
+        D = max(z[att+m+'1'].shape[1] for m in 'vwag')
+        z[att+'lora1'] = torch.stack([F.pad(z[att+m+'1'], (0, D - z[att+m+'1'].shape[1])) for m in 'vwag'])
+        z[att+'lora2'] = torch.stack([F.pad(z[att+m+'2'], (0, 0, 0, D - z[att+m+'2'].shape[0])) for m in 'vwag'])
+    return z
 
 class RWKV(MyModule):
-    def __init__(self, model, strategy):
+    def __init__(self, model, strategy, fused=False):
         global DTYPE, DEVICE
         super().__init__()
         self.eval()
@@ -256,14 +396,17 @@ class RWKV(MyModule):
 
         ss = strategy.split(' ')
         DEVICE = ss[0]
-        if ss[1] == 'fp16':
+        prec, quant = ss[1][:4], ss[1][4:]
+        if prec == 'fp16':
             DTYPE = torch.half
-        elif ss[1] == 'fp32':
+        elif prec == 'fp32':
             DTYPE = torch.float32
-        elif ss[1] == 'bf16':
+        elif prec == 'bf16':
             DTYPE = torch.bfloat16
         else:
-            assert False, "currently rwkv7 strategy must be: cuda/cpu fp16/fp32/bf16"
+            assert False, "currently rwkv7 strategy must be: cuda/cpu fp16/fp32/bf16, optionally weight-quantized with i8/i4 (e.g. cpu fp32i8)"
+        assert quant in ('', 'i8', 'i4'), "weight quantization must be i8 or i4 (e.g. cuda bf16i4)"
+        self.quant_bits = {'': 0, 'i8': 8, 'i4': 4}[quant]
         
         # self.z = torch.load(args.MODEL_NAME + '.pth', map_location=DEVICE)
         self.z = model
@@ -272,68 +415,94 @@ class RWKV(MyModule):
         #     print(k, v.shape)
         z = self.z
 
-        self.n_head, self.head_size = z['blocks.0.att.r_k'].shape
+        if 'head.weight.qs' in z: # pre-converted by infer/checkpoint.py, already in inference layout
+            if z['emb.weight'].dtype != DTYPE or weight_quant_bits(z) != self.quant_bits:
+                raise ValueError(f"checkpoint was converted for another strategy than '{strategy}', convert it again")
+            self.n_head, self.head_size = z['emb.weight'].shape[1] // HEAD_SIZE, HEAD_SIZE
+        else:
+            self.n_head, self.head_size = z['blocks.0.att.r_k'].shape
+            convert_rwkv7_weights(z, DTYPE, self.quant_bits)
         args.head_size = self.head_size
         args.vocab_size, args.n_embd = z['emb.weight'].shape
 
         args.n_layer = 0
-        keys = list(z.keys())
-        for k in keys:
+        for k in z.keys():
             layer_id = int(k.split('.')[1]) if ('blocks.' in k) else 0
             args.n_layer = max(args.n_layer, layer_id+1)
-            if 'key.weight' in k or 'value.weight' in k or 'receptance.weight' in k or 'output.weight' in k or 'head.weight' in k:
-                z[k] = z[k].t()
-            z[k] = z[k].squeeze().to(dtype=DTYPE)
-            if k.endswith('att.r_k'): z[k] = z[k].flatten()
 
         self.n_embd = args.n_embd
         self.n_layer = args.n_layer
 
-        # z['emb.weight'] = F.layer_norm(z['emb.weight'], (args.n_embd,), weight=z['blocks.0.ln0.weight'], bias=z['blocks.0.ln0.bias'])
         z['blocks.0.att.v0'] = z['blocks.0.att.a0'] # actually ignored
         z['blocks.0.att.v1'] = z['blocks.0.att.a1'] # actually ignored
         z['blocks.0.att.v2'] = z['blocks.0.att.a2'] # actually ignored
 
-    def get_placeholder_mask(
-        self, input_ids: torch.LongTensor, inputs_embeds: torch.FloatTensor, image_features: torch.FloatTensor
-    ):
+        self.fused = fused # stacked projections for decode, see fuse_rwkv7_weights
+        if fused:
+            if self.quant_bits > 0:
+                raise ValueError("the fused projection layout needs unquantized weights")
+            fuse_rwkv7_weights(z, self.n_layer)
+
+        # per-layer weight tables for the hot loops, so they do not build f-string keys and look up ~40 dict
+        # entries per layer per token
+        self.layers = [tuple(z[f'blocks.{i}.{k}'] for k in LAYER_KEYS) for i in range(self.n_layer)]
+        empty = torch.empty(0)
+        self.fused_layers = [tuple(z[f'blocks.{i}.{k}'] if fused else empty for k in FUSED_LAYER_KEYS) for i in range(self.n_layer)]
+
+    def init_state(self, batch_size=None):
+        # state: 0=att_x_prev 1=att_kv 2=ffn_x_prev, with a leading batch dim when batch_size is given
+        B = () if batch_size is None else (batch_size,)
+        state = [None for _ in range(self.args.n_layer * 3)]
+        for i in range(self.args.n_layer):
+            state[i*3+0] = torch.zeros(B + (self.args.n_embd,), dtype=DTYPE, requires_grad=False, device=DEVICE)
+            state[i*3+1] = torch.zeros(B + (self.args.n_embd // self.args.head_size, self.args.head_size, self.args.head_size), dtype=torch.float, requires_grad=False, device=DEVICE)
+            state[i*3+2] = torch.zeros(B + (self.args.n_embd,), dtype=DTYPE, requires_grad=False, device=DEVICE)
+        return state
+
+    @staticmethod
+    def stack_state(states):
         """
-        Obtains multimodal placeholder mask from `input_ids` or `inputs_embeds`, and checks that the placeholder token count is
-        equal to the length of multimodal features. If the lengths are different, an error is raised.
+        Joins single-sequence states (or batched states) into one batched state along dim 0.
         """
-        if input_ids is None:
-            special_image_mask = inputs_embeds == self.get_input_embeddings()(
-                torch.tensor(65532, dtype=torch.long, device=inputs_embeds.device)
-            )
-            special_image_mask = special_image_mask.all(-1)
-        else:
-            special_image_mask = input_ids == 65532
-        n_image_tokens = special_image_mask.sum()
-        special_image_mask = special_image_mask.unsqueeze(-1).expand_as(inputs_embeds).to(inputs_embeds.device)
-        if inputs_embeds[special_image_mask].numel() != image_features.numel():
-            n_image_features = image_features.shape[0] * image_features.shape[1]
-            raise ValueError(
-                f"Image features and image tokens do not match: tokens: {n_image_tokens}, features {n_image_features}"
-            )
-        return special_image_mask
-
-    def forward(self, idx, state, full_output=False, sign=None):
+        out = []
+        for j in range(len(states[0])):
+            batched_dim = 4 if j % 3 == 1 else 2
+            out.append(torch.cat([s[j] if s[j].dim() == batched_dim else s[j].unsqueeze(0) for s in states]))
+        return out
+
+    def placeholder_index(self, idx, spans, n_features, device):
+        """
+        Positions of the modality placeholders in `idx`, from `spans` ([start, end) offsets, e.g. a Prompt's)
+        or else by scanning idx for the <|image_pad|> id. Raises if they do not match the feature rows.
+        """
+        if spans is None:
+            spans = []
+            for i, t in enumerate(idx):
+                if t == 65532:
+                    if spans and spans[-1][1] == i:
+                        spans[-1] = (spans[-1][0], i + 1)
+                    else:
+                        spans.append((i, i + 1))
+        n_image_tokens = sum(e - s for s, e in spans)
+        if n_image_tokens != n_features:
+            raise ValueError(f"Image features and image tokens do not match: tokens: {n_image_tokens}, features {n_features}")
+        return torch.cat([torch.arange(s, e, device=device) for s, e in spans])
+
+    def forward(self, idx, state, full_output=False, sign=None, spans=None):
         if state == None:
-            state = [None for _ in range(self.args.n_layer * 3)]
-            for i in range(self.args.n_layer): # state: 0=att_x_prev 1=att_kv 2=ffn_x_prev
-                state[i*3+0] = torch.zeros(self.args.n_embd, dtype=DTYPE, requires_grad=False, device=DEVICE)
-                state[i*3+1] = torch.zeros((self.args.n_embd // self.args.head_size, self.args.head_size, self.args.head_size), dtype=torch.float, requires_grad=False, device=DEVICE)
-                state[i*3+2] = torch.zeros(self.args.n_embd, dtype=DTYPE, requires_grad=False, device=DEVICE)
+            state = self.init_state()
 
         x = self.z['emb.weight'][idx]
         if isinstance(sign, torch.Tensor):
-            image_mask = self.get_placeholder_mask(input_ids=torch.tensor(idx), inputs_embeds=x, image_features=sign)
-            sign = sign.view(-1, sign.shape[-1])
-            # sign = F.layer_norm(sign, (self.args.n_embd,), weight=self.z['blocks.0.ln0.weight'], bias=self.z['blocks.0.ln0.bias'])
+            sign = sign.reshape(-1, sign.shape[-1])
+            pos = self.placeholder_index(idx, spans, sign.shape[0], x.device)
+            if self.fused: # the embedding table has ln0 applied already, the spliced rows do not
+                sign = F.layer_norm(sign, (self.args.n_embd,), weight=self.z['blocks.0.ln0.weight'], bias=self.z['blocks.0.ln0.bias'])
 
-            x = x.masked_scatter(image_mask, sign)
+            x.index_copy_(0, pos, sign.to(x.dtype)) # x is a fresh gather from the embedding table
 
-        x = F.layer_norm(x, (self.args.n_embd,), weight=self.z['blocks.0.ln0.weight'], bias=self.z['blocks.0.ln0.bias'])
+        if not self.fused:
+            x = F.layer_norm(x, (self.args.n_embd,), weight=self.z['blocks.0.ln0.weight'], bias=self.z['blocks.0.ln0.bias'])
         # if isinstance(sign, torch.Tensor):
         #     print(x)
 
@@ -347,80 +516,159 @@ class RWKV(MyModule):
 
     @MyFunction
     def forward_one(self, x, state:List[torch.Tensor]):
-        with torch.no_grad(): 
+        with torch.no_grad():
             z = self.z
-            #x = z['emb.weight'][idx]
 
             v_first = torch.empty_like(x)
-            for i in range(self.n_layer):
-                bbb = f'blocks.{i}.'
-                att = f'blocks.{i}.att.'
-                ffn = f'blocks.{i}.ffn.'
-
-                xx = F.layer_norm(x, (self.n_embd,), weight=z[bbb+'ln1.weight'], bias=z[bbb+'ln1.bias'])
-
-                xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_one(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
-                    z[att+'x_r'], z[att+'x_w'], z[att+'x_k'], z[att+'x_v'], z[att+'x_a'], z[att+'x_g'],
-                    z[att+'w0'], z[att+'w1'], z[att+'w2'], z[att+'a0'], z[att+'a1'], z[att+'a2'], z[att+'v0'], z[att+'v1'], z[att+'v2'],
-                    z[att+'g1'], z[att+'g2'], z[att+'k_k'], z[att+'k_a'], z[att+'r_k'],
-                    z[att+'receptance.weight'], z[att+'key.weight'], z[att+'value.weight'], z[att+'output.weight'],
-                    z[att+'ln_x.weight'], z[att+'ln_x.bias'])
+            for i, layer in enumerate(self.layers):
+                (ln1_w, ln1_b, ln2_w, ln2_b, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b, ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s) = layer
+
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln1_w, bias=ln1_b)
+
+                if self.fused:
+                    maa, L1, L2, RKV = self.fused_layers[i]
+                    xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_one_fused(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
+                        maa, L1, L2, w0, a0, v0, k_k, k_a, r_k, RKV, O_, O_s, ln_w, ln_b)
+                else:
+                    xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_one(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
+                        x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                        R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b)
                 x = x + xx
 
-                xx = F.layer_norm(x, (self.n_embd,), weight=z[bbb+'ln2.weight'], bias=z[bbb+'ln2.bias'])
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln2_w, bias=ln2_b)
 
-                xx, state[i*3+2] = RWKV_x070_CMix_one(xx, state[i*3+2], z[ffn+'x_k'], z[ffn+'key.weight'], z[ffn+'value.weight'])
+                xx, state[i*3+2] = RWKV_x070_CMix_one(xx, state[i*3+2], ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s)
                 x = x + xx
-            
-                # if math.isnan(torch.min(x).item()): print(idx, i)
 
             x = F.layer_norm(x, (self.n_embd,), weight=z['ln_out.weight'], bias=z['ln_out.bias'])
-            x = x @ z['head.weight']
+            x = matmul_q(x, z['head.weight'], z['head.weight.qs'])
             return x, state
-        
+
     @MyFunction
     def forward_seq(self, x, state:List[torch.Tensor], full_output:bool=False):
-        with torch.no_grad(): 
+        with torch.no_grad():
             z = self.z
-            #x = z['emb.weight'][idx]
 
             v_first = torch.empty_like(x)
-            for i in range(self.n_layer):
-                bbb = f'blocks.{i}.'
-                att = f'blocks.{i}.att.'
-                ffn = f'blocks.{i}.ffn.'
+            for i, layer in enumerate(self.layers):
+                (ln1_w, ln1_b, ln2_w, ln2_b, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b, ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s) = layer
 
-                xx = F.layer_norm(x, (self.n_embd,), weight=z[bbb+'ln1.weight'], bias=z[bbb+'ln1.bias'])
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln1_w, bias=ln1_b)
 
                 xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_seq(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
-                    z[att+'x_r'], z[att+'x_w'], z[att+'x_k'], z[att+'x_v'], z[att+'x_a'], z[att+'x_g'],
-                    z[att+'w0'], z[att+'w1'], z[att+'w2'], z[att+'a0'], z[att+'a1'], z[att+'a2'], z[att+'v0'], z[att+'v1'], z[att+'v2'],
-                    z[att+'g1'], z[att+'g2'], z[att+'k_k'], z[att+'k_a'], z[att+'r_k'],
-                    z[att+'receptance.weight'], z[att+'key.weight'], z[att+'value.weight'], z[att+'output.weight'],
-                    z[att+'ln_x.weight'], z[att+'ln_x.bias'])
+                    x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b)
                 x = x + xx
 
-                xx = F.layer_norm(x, (self.n_embd,), weight=z[bbb+'ln2.weight'], bias=z[bbb+'ln2.bias'])
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln2_w, bias=ln2_b)
 
-                xx, state[i*3+2] = RWKV_x070_CMix_seq(xx, state[i*3+2], z[ffn+'x_k'], z[ffn+'key.weight'], z[ffn+'value.weight'])
+                xx, state[i*3+2] = RWKV_x070_CMix_seq(xx, state[i*3+2], ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s)
                 x = x + xx
-            
+
             if not full_output: x = x[-1,:]
             x = F.layer_norm(x, (self.n_embd,), weight=z['ln_out.weight'], bias=z['ln_out.bias'])
-            x = x @ z['head.weight']
+            x = matmul_q(x, z['head.weight'], z['head.weight.qs'])
+            return x, state
+
+    def forward_batch(self, idx, state=None):
+        """
+        Runs B token sequences through the model at once.
+
+        idx is a list of B token lists (ragged lengths allowed, each non-empty), state is a batched state from
+        `init_state(B)` / `stack_state` or None. Shorter rows are left-padded; padded steps leave their row's state
+        untouched. Returns the logits of the last token of each row ([B, vocab]) and the batched state, which is
+        updated in place (it may be a view of `StatePool` slots).
+        """
+        B = len(idx)
+        if state == None:
+            state = self.init_state(B)
+        lengths = [len(t) for t in idx]
+        assert min(lengths) > 0, "every row needs at least one token"
+        T = max(lengths)
+        tokens = torch.zeros((B, T), dtype=torch.long)
+        pad = torch.zeros((B, T), dtype=torch.bool)
+        for b in range(B):
+            tokens[b, T-lengths[b]:] = torch.tensor(idx[b], dtype=torch.long)
+            pad[b, :T-lengths[b]] = True
+
+        x = self.z['emb.weight'][tokens.to(self.z['emb.weight'].device)]
+        if not self.fused:
+            x = F.layer_norm(x, (self.args.n_embd,), weight=self.z['blocks.0.ln0.weight'], bias=self.z['blocks.0.ln0.bias'])
+        if T == 1:
+            return self.forward_batch_one(x[:,0,:], state)
+        return self.forward_batch_seq(x, pad.to(x.device), state)
+
+    @MyFunction
+    def forward_batch_one(self, x, state:List[torch.Tensor]):
+        with torch.no_grad():
+            z = self.z
+
+            v_first = torch.empty_like(x)
+            for i, layer in enumerate(self.layers):
+                (ln1_w, ln1_b, ln2_w, ln2_b, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b, ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s) = layer
+
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln1_w, bias=ln1_b)
+
+                if self.fused:
+                    maa, L1, L2, RKV = self.fused_layers[i]
+                    xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_batch_one_fused(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
+                        maa, L1, L2, w0, a0, v0, k_k, k_a, r_k, RKV, O_, O_s, ln_w, ln_b)
+                else:
+                    xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_batch_one(i, self.n_head, self.head_size, xx, state[i*3+0], v_first, state[i*3+1],
+                        x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                        R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b)
+                x = x + xx
+
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln2_w, bias=ln2_b)
+
+                xx, state[i*3+2] = RWKV_x070_CMix_batch_one(xx, state[i*3+2], ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s)
+                x = x + xx
+
+            x = F.layer_norm(x, (self.n_embd,), weight=z['ln_out.weight'], bias=z['ln_out.bias'])
+            x = matmul_q(x, z['head.weight'], z['head.weight.qs'])
+            return x, state
+
+    @MyFunction
+    def forward_batch_seq(self, x, pad, state:List[torch.Tensor]):
+        with torch.no_grad():
+            z = self.z
+
+            v_first = torch.empty_like(x)
+            for i, layer in enumerate(self.layers):
+                (ln1_w, ln1_b, ln2_w, ln2_b, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b, ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s) = layer
+
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln1_w, bias=ln1_b)
+
+                xx, state[i*3+0], state[i*3+1], v_first = RWKV_x070_TMix_batch_seq(i, self.n_head, self.head_size, xx, pad, state[i*3+0], v_first, state[i*3+1],
+                    x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k,
+                    R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b)
+                x = x + xx
+
+                xx = F.layer_norm(x, (self.n_embd,), weight=ln2_w, bias=ln2_b)
+
+                xx, state[i*3+2] = RWKV_x070_CMix_batch_seq(xx, pad, state[i*3+2], ffn_x_k, ffn_K, ffn_V, ffn_K_s, ffn_V_s)
+                x = x + xx
+
+            x = x[:,-1,:]
+            x = F.layer_norm(x, (self.n_embd,), weight=z['ln_out.weight'], bias=z['ln_out.bias'])
+            x = matmul_q(x, z['head.weight'], z['head.weight.qs'])
             return x, state
 
 ########################################################################################################
 
 @MyStatic
-def RWKV_x070_TMix_one(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, ln_w, ln_b):
+def RWKV_x070_TMix_one(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
     xx = x_prev - x
     xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
 
-    r = xr @ R_
+    r = matmul_q(xr, R_, R_s)
     w = torch.tanh(xw @ w1) @ w2
-    k = xk @ K_
-    v = xv @ V_
+    k = matmul_q(xk, K_, K_s)
+    v = matmul_q(xv, V_, V_s)
     a = torch.sigmoid(a0 + (xa @ a1) @ a2)
     g = torch.sigmoid(xg @ g1) @ g2
 
@@ -437,19 +685,144 @@ def RWKV_x070_TMix_one(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x
 
     xx = torch.nn.functional.group_norm(xx.view(1,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(H*N)    
     xx = xx + ((r * k * r_k).view(H,N).sum(dim=-1, keepdim=True) * v.view(H,N)).view(H*N)
-    return (xx * g) @ O_, x, state, v_first
+    return matmul_q(xx * g, O_, O_s), x, state, v_first
+
+########################################################################################################
+# Fused decode projections (RWKV(..., fused=True), layout from fuse_rwkv7_weights): the six token-shift
+# mixes are one broadcast op, receptance/key/value one bmm, and the four LoRA down / up projections one
+# bmm each. x / xx are [B,C]; returns r, k, v, w, a, v-gate, g (the LoRA parts before w0/a0/v0 are added).
+########################################################################################################
+
+@MyStatic
+def RWKV_x070_proj_fused(x, xx, maa, L1, L2, RKV):
+    xm = x.unsqueeze(0) + xx.unsqueeze(0) * maa.unsqueeze(1) # [6,B,C]: r k v w a g
+    rkv = torch.bmm(xm[0:3], RKV)
+    h = torch.bmm(xm[2:6], L1) # [4,B,D]: v w a g
+    h = torch.cat((h[0:1], torch.tanh(h[1:2]), h[2:3], torch.sigmoid(h[3:4])))
+    lo = torch.bmm(h, L2)
+    return rkv[0], rkv[1], rkv[2], lo[1], lo[2], lo[0], lo[3]
+
+@MyStatic
+def RWKV_x070_TMix_one_fused(layer_id: int, H:int, N:int, x, x_prev, v_first, state, maa, L1, L2, w0, a0, v0, k_k, k_a, r_k, RKV, O_, O_s, ln_w, ln_b):
+    xx = x_prev - x
+    r, k, v, w, a, vg, g = RWKV_x070_proj_fused(x.unsqueeze(0), xx.unsqueeze(0), maa, L1, L2, RKV)
+    r, k, v, w, g = r[0], k[0], v[0], w[0], g[0]
+    a = torch.sigmoid(a0 + a[0])
+
+    kk = torch.nn.functional.normalize((k * k_k).view(H,N), dim=-1, p=2.0).view(H*N)
+    k = k * (1 + (a-1) * k_a)
+    if layer_id == 0: v_first = v
+    else: v = v + (v_first - v) * torch.sigmoid(v0 + vg[0])
+    w = torch.exp(-0.606531 * torch.sigmoid((w0 + w).float())) # 0.606531 = exp(-0.5)
+
+    vk = v.view(H,N,1) @ k.view(H,1,N)
+    ab = (-kk).view(H,N,1) @ (kk*a).view(H,1,N)
+    state = state * w.view(H,1,N) + state @ ab.float() + vk.float()
+    xx = (state.to(dtype=x.dtype) @ r.view(H,N,1))
+
+    xx = torch.nn.functional.group_norm(xx.view(1,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(H*N)
+    xx = xx + ((r * k * r_k).view(H,N).sum(dim=-1, keepdim=True) * v.view(H,N)).view(H*N)
+    return matmul_q(xx * g, O_, O_s), x, state, v_first
+
+@MyStatic
+def RWKV_x070_TMix_batch_one_fused(layer_id: int, H:int, N:int, x, x_prev, v_first, state, maa, L1, L2, w0, a0, v0, k_k, k_a, r_k, RKV, O_, O_s, ln_w, ln_b):
+    B = x.shape[0]
+    xx = x_prev - x
+    r, k, v, w, a, vg, g = RWKV_x070_proj_fused(x, xx, maa, L1, L2, RKV)
+    a = torch.sigmoid(a0 + a)
+
+    kk = torch.nn.functional.normalize((k * k_k).view(B,H,N), dim=-1, p=2.0).view(B,H*N)
+    k = k * (1 + (a-1) * k_a)
+    if layer_id == 0: v_first = v
+    else: v = v + (v_first - v) * torch.sigmoid(v0 + vg)
+    w = torch.exp(-0.606531 * torch.sigmoid((w0 + w).float())) # 0.606531 = exp(-0.5)
+
+    vk = v.view(B,H,N,1) @ k.view(B,H,1,N)
+    ab = (-kk).view(B,H,N,1) @ (kk*a).view(B,H,1,N)
+    sab = state @ ab.float()
+    state.mul_(w.view(B,H,1,N)).add_(sab).add_(vk.float())
+    xx = (state.to(dtype=x.dtype) @ r.view(B,H,N,1))
+
+    xx = torch.nn.functional.group_norm(xx.view(B,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(B,H*N)
+    xx = xx + ((r * k * r_k).view(B,H,N).sum(dim=-1, keepdim=True) * v.view(B,H,N)).view(B,H*N)
+    x_prev.copy_(x)
+    return matmul_q(xx * g, O_, O_s), x_prev, state, v_first
+
+########################################################################################################
+# WKV7 over a sequence without the CUDA kernel. state is [B,H,N,N] float32, r/w/k/v/a/b are [B,T,H*N] with
+# w the decay in (0,1]; returns (y [B,T,H*N] float32, new state). Per head the recurrence is
+#   S_t = S_{t-1} diag(w_t) + (S_{t-1} a_t) b_t^T + v_t k_t^T,   y_t = S_t r_t
+#
+# RWKV_x070_WKV_chunk processes L tokens at a time: with u_t = S_{t-1} a_t and G_t the cumulative decay
+# inside the chunk, every u_t, y_t and the chunk-end state are linear in S_0, u and v:
+#   u = (I - M_ab)^-1 (a~ S_0^T + M_ak v),  y = r~ S_0^T + Q_rb u + Q_rk v
+# where M (strictly lower) / Q (lower) hold the decayed dot products a_t.b_s, a_t.k_s, r_t.b_s, r_t.k_s.
+# Decays always appear as G_t/G_s with s <= t (computed in log space), so long chunks do not overflow.
+########################################################################################################
+
+@MyStatic
+def RWKV_x070_WKV_loop(H:int, N:int, state, r, w, k, v, a, b):
+    B, T = r.shape[0], r.shape[1]
+    y = torch.empty((B, T, H*N), dtype=torch.float, device=r.device)
+    for t in range(T):
+        vk = v[:,t].view(B,H,N,1) @ k[:,t].view(B,H,1,N)
+        ab = a[:,t].view(B,H,N,1) @ b[:,t].view(B,H,1,N)
+        state = state * w[:,t].view(B,H,1,N) + state @ ab.float() + vk.float()
+        y[:,t] = (state @ r[:,t].float().view(B,H,N,1)).view(B,H*N)
+    return y, state
+
+@MyStatic
+def RWKV_x070_WKV_chunk(H:int, N:int, L:int, state, r, w, k, v, a, b):
+    B, T = r.shape[0], r.shape[1]
+    y = torch.empty((B, T, H*N), dtype=torch.float, device=r.device)
+    for t0 in range(0, T, L):
+        t1 = min(t0 + L, T)
+        l = t1 - t0
+        r_ = r[:,t0:t1].float().view(B,l,H,N).transpose(1,2) # [B,H,l,N]
+        k_ = k[:,t0:t1].float().view(B,l,H,N).transpose(1,2)
+        v_ = v[:,t0:t1].float().view(B,l,H,N).transpose(1,2)
+        a_ = a[:,t0:t1].float().view(B,l,H,N).transpose(1,2)
+        b_ = b[:,t0:t1].float().view(B,l,H,N).transpose(1,2)
+        lw = torch.log(w[:,t0:t1].float()).view(B,l,H,N).transpose(1,2)
+        cs = torch.cumsum(lw, dim=2) # log G_t
+        cp = cs - lw # log G_{t-1}
+
+        strict = torch.tril(torch.ones((l, l), dtype=torch.bool, device=r.device), diagonal=-1).view(1,1,l,l,1)
+        lower = torch.tril(torch.ones((l, l), dtype=torch.bool, device=r.device)).view(1,1,l,l,1)
+        d_a = torch.exp((cp.unsqueeze(3) - cs.unsqueeze(2)).masked_fill(~strict, -float('inf'))) # G_{t-1}/G_s, s < t
+        d_r = torch.exp((cs.unsqueeze(3) - cs.unsqueeze(2)).masked_fill(~lower, -float('inf'))) # G_t/G_s, s <= t
+        m_ab = (a_.unsqueeze(3) * b_.unsqueeze(2) * d_a).sum(-1) # [B,H,l,l]
+        m_ak = (a_.unsqueeze(3) * k_.unsqueeze(2) * d_a).sum(-1)
+        q_rb = (r_.unsqueeze(3) * b_.unsqueeze(2) * d_r).sum(-1)
+        q_rk = (r_.unsqueeze(3) * k_.unsqueeze(2) * d_r).sum(-1)
+
+        sT = state.transpose(-1, -2)
+        eye = torch.eye(l, dtype=torch.float, device=r.device)
+        u = torch.linalg.solve_triangular(eye - m_ab, (a_ * torch.exp(cp)) @ sT + m_ak @ v_, upper=False, unitriangular=True)
+        y_ = (r_ * torch.exp(cs)) @ sT + q_rb @ u + q_rk @ v_
+        y[:,t0:t1] = y_.transpose(1,2).reshape(B,l,H*N)
+
+        dl = torch.exp(cs[:,:,-1:] - cs) # G_L/G_s
+        state = state * torch.exp(cs[:,:,-1]).unsqueeze(2) + u.transpose(-1,-2) @ (b_ * dl) + v_.transpose(-1,-2) @ (k_ * dl)
+    return y, state
+
+@MyStatic
+def RWKV_x070_WKV_seq(H:int, N:int, state, r, w, k, v, a, b):
+    if CPU_CHUNK_LEN > 0:
+        return RWKV_x070_WKV_chunk(H, N, CPU_CHUNK_LEN, state, r, w, k, v, a, b)
+    return RWKV_x070_WKV_loop(H, N, state, r, w, k, v, a, b)
 
 if os.environ.get('RWKV_CUDA_ON') == '1':
     @MyStatic
-    def RWKV_x070_TMix_seq(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, ln_w, ln_b):
+    def RWKV_x070_TMix_seq(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
         T = x.shape[0]
         xx = torch.cat((x_prev.unsqueeze(0), x[:-1,:])) - x
         xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
 
-        r = xr @ R_
+        r = matmul_q(xr, R_, R_s)
         w = torch.tanh(xw @ w1) @ w2
-        k = xk @ K_
-        v = xv @ V_
+        k = matmul_q(xk, K_, K_s)
+        v = matmul_q(xv, V_, V_s)
         a = torch.sigmoid(a0 + (xa @ a1) @ a2)
         g = torch.sigmoid(xg @ g1) @ g2
 
@@ -463,18 +836,18 @@ if os.environ.get('RWKV_CUDA_ON') == '1':
 
         xx = torch.nn.functional.group_norm(xx.view(T,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(T,H*N)
         xx = xx + ((r * k * r_k).view(T,H,N).sum(dim=-1, keepdim=True) * v.view(T,H,N)).view(T,H*N)
-        return (xx * g) @ O_, x[-1,:], state, v_first
+        return matmul_q(xx * g, O_, O_s), x[-1,:], state, v_first
 else:
     @MyStatic
-    def RWKV_x070_TMix_seq(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, ln_w, ln_b):
+    def RWKV_x070_TMix_seq(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
         T = x.shape[0]
         xx = torch.cat((x_prev.unsqueeze(0), x[:-1,:])) - x
         xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
 
-        r = xr @ R_
+        r = matmul_q(xr, R_, R_s)
         w = torch.tanh(xw @ w1) @ w2
-        k = xk @ K_
-        v = xv @ V_
+        k = matmul_q(xk, K_, K_s)
+        v = matmul_q(xv, V_, V_s)
         a = torch.sigmoid(a0 + (xa @ a1) @ a2)
         g = torch.sigmoid(xg @ g1) @ g2
 
@@ -484,32 +857,147 @@ else:
         else: v = v + (v_first - v) * torch.sigmoid(v0 + (xv @ v1) @ v2)
 
         w = torch.exp(-0.606531 * torch.sigmoid((w0 + w).float())) # 0.606531 = exp(-0.5)
-        for t in range(T):
-            r_, w_, k_, v_, kk_, a_ = r[t], w[t], k[t], v[t], kk[t], a[t]
-            vk = v_.view(H,N,1) @ k_.view(H,1,N)
-            ab = (-kk_).view(H,N,1) @ (kk_*a_).view(H,1,N)
-            state = state * w_.view(H,1,N) + state @ ab.float() + vk.float()
-            xx[t] = (state.to(dtype=x.dtype) @ r_.view(H,N,1)).view(H*N)
+        y, s = RWKV_x070_WKV_seq(H, N, state.unsqueeze(0), r.unsqueeze(0), w.unsqueeze(0), k.unsqueeze(0), v.unsqueeze(0), (-kk).unsqueeze(0), (kk*a).unsqueeze(0))
+        xx, state = y[0].to(dtype=x.dtype), s[0]
 
         xx = torch.nn.functional.group_norm(xx.view(T,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(T,H*N)
         xx = xx + ((r * k * r_k).view(T,H,N).sum(dim=-1, keepdim=True) * v.view(T,H,N)).view(T,H*N)
-        return (xx * g) @ O_, x[-1,:], state, v_first
+        return matmul_q(xx * g, O_, O_s), x[-1,:], state, v_first
 
 ########################################################################################################
 
 @MyStatic
-def RWKV_x070_CMix_one(x, x_prev, x_k, K_, V_):
+def RWKV_x070_CMix_one(x, x_prev, x_k, K_, V_, K_s, V_s):
     xx = x_prev - x
     k = x + xx * x_k
-    k = torch.relu(k @ K_) ** 2
-    return k @ V_, x
+    k = torch.relu(matmul_q(k, K_, K_s)) ** 2
+    return matmul_q(k, V_, V_s), x
 
 @MyStatic
-def RWKV_x070_CMix_seq(x, x_prev, x_k, K_, V_):
+def RWKV_x070_CMix_seq(x, x_prev, x_k, K_, V_, K_s, V_s):
     xx = torch.cat((x_prev.unsqueeze(0), x[:-1,:])) - x
     k = x + xx * x_k
-    k = torch.relu(k @ K_) ** 2
-    return k @ V_, x[-1,:]
+    k = torch.relu(matmul_q(k, K_, K_s)) ** 2
+    return matmul_q(k, V_, V_s), x[-1,:]
+
+########################################################################################################
+# Batched variants: x is [B,C] (one) or [B,T,C] (seq), state is [B,H,N,N].
+# For seq, `pad` [B,T] marks left padding; padded steps repeat the previous token for the token shift and
+# use decay 1 with zero k/kk, so they leave the wkv state of their row bit-exactly unchanged.
+# state / x_prev are updated in place, so they can be views into a StatePool.
+########################################################################################################
+
+@MyStatic
+def RWKV_x070_TMix_batch_one(layer_id: int, H:int, N:int, x, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
+    B = x.shape[0]
+    xx = x_prev - x
+    xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
+
+    r = matmul_q(xr, R_, R_s)
+    w = torch.tanh(xw @ w1) @ w2
+    k = matmul_q(xk, K_, K_s)
+    v = matmul_q(xv, V_, V_s)
+    a = torch.sigmoid(a0 + (xa @ a1) @ a2)
+    g = torch.sigmoid(xg @ g1) @ g2
+
+    kk = torch.nn.functional.normalize((k * k_k).view(B,H,N), dim=-1, p=2.0).view(B,H*N)
+    k = k * (1 + (a-1) * k_a)
+    if layer_id == 0: v_first = v
+    else: v = v + (v_first - v) * torch.sigmoid(v0 + (xv @ v1) @ v2)
+    w = torch.exp(-0.606531 * torch.sigmoid((w0 + w).float())) # 0.606531 = exp(-0.5)
+
+    vk = v.view(B,H,N,1) @ k.view(B,H,1,N)
+    ab = (-kk).view(B,H,N,1) @ (kk*a).view(B,H,1,N)
+    sab = state @ ab.float()
+    state.mul_(w.view(B,H,1,N)).add_(sab).add_(vk.float())
+    xx = (state.to(dtype=x.dtype) @ r.view(B,H,N,1))
+
+    xx = torch.nn.functional.group_norm(xx.view(B,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(B,H*N)
+    xx = xx + ((r * k * r_k).view(B,H,N).sum(dim=-1, keepdim=True) * v.view(B,H,N)).view(B,H*N)
+    x_prev.copy_(x)
+    return matmul_q(xx * g, O_, O_s), x_prev, state, v_first
+
+if os.environ.get('RWKV_CUDA_ON') == '1':
+    @MyStatic
+    def RWKV_x070_TMix_batch_seq(layer_id: int, H:int, N:int, x, pad, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
+        B, T = x.shape[0], x.shape[1]
+        mask = pad.unsqueeze(-1)
+        x = torch.where(mask, x_prev.unsqueeze(1), x)
+        xx = torch.cat((x_prev.unsqueeze(1), x[:,:-1,:]), dim=1) - x
+        xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
+
+        r = matmul_q(xr, R_, R_s)
+        w = torch.tanh(xw @ w1) @ w2
+        k = matmul_q(xk, K_, K_s)
+        v = matmul_q(xv, V_, V_s)
+        a = torch.sigmoid(a0 + (xa @ a1) @ a2)
+        g = torch.sigmoid(xg @ g1) @ g2
+
+        kk = torch.nn.functional.normalize((k * k_k).view(B,T,H,N), dim=-1, p=2.0).view(B,T,H*N)
+        k = k * (1 + (a-1) * k_a)
+        if layer_id == 0: v_first = v
+        else: v = v + (v_first - v) * torch.sigmoid(v0 + (xv @ v1) @ v2)
+
+        w = -torch.nn.functional.softplus(-(w0 + w)) - 0.5
+        w = w.masked_fill(mask, -float('inf')) # exp(-exp(-inf)) = 1
+        k = k.masked_fill(mask, 0.0)
+        kk = kk.masked_fill(mask, 0.0)
+        xx = RWKV7_BATCH_OP(state, r, w, k, v, -kk, kk*a)
+
+        xx = torch.nn.functional.group_norm(xx.view(B*T,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(B,T,H*N)
+        xx = xx + ((r * k * r_k).view(B,T,H,N).sum(dim=-1, keepdim=True) * v.view(B,T,H,N)).view(B,T,H*N)
+        x_prev.copy_(x[:,-1,:])
+        return matmul_q(xx * g, O_, O_s), x_prev, state, v_first
+else:
+    @MyStatic
+    def RWKV_x070_TMix_batch_seq(layer_id: int, H:int, N:int, x, pad, x_prev, v_first, state, x_r, x_w, x_k, x_v, x_a, x_g, w0, w1, w2, a0, a1, a2, v0, v1, v2, g1, g2, k_k, k_a, r_k, R_, K_, V_, O_, R_s, K_s, V_s, O_s, ln_w, ln_b):
+        B, T = x.shape[0], x.shape[1]
+        mask = pad.unsqueeze(-1)
+        x = torch.where(mask, x_prev.unsqueeze(1), x)
+        xx = torch.cat((x_prev.unsqueeze(1), x[:,:-1,:]), dim=1) - x
+        xr, xw, xk, xv, xa, xg = x+xx*x_r, x+xx*x_w, x+xx*x_k, x+xx*x_v, x+xx*x_a, x+xx*x_g
+
+        r = matmul_q(xr, R_, R_s)
+        w = torch.tanh(xw @ w1) @ w2
+        k = matmul_q(xk, K_, K_s)
+        v = matmul_q(xv, V_, V_s)
+        a = torch.sigmoid(a0 + (xa @ a1) @ a2)
+        g = torch.sigmoid(xg @ g1) @ g2
+
+        kk = torch.nn.functional.normalize((k * k_k).view(B,T,H,N), dim=-1, p=2.0).view(B,T,H*N)
+        k = k * (1 + (a-1) * k_a)
+        if layer_id == 0: v_first = v
+        else: v = v + (v_first - v) * torch.sigmoid(v0 + (xv @ v1) @ v2)
+
+        w = torch.exp(-0.606531 * torch.sigmoid((w0 + w).float())) # 0.606531 = exp(-0.5)
+        w = w.masked_fill(mask, 1.0)
+        k = k.masked_fill(mask, 0.0)
+        kk = kk.masked_fill(mask, 0.0)
+        y, s = RWKV_x070_WKV_seq(H, N, state, r, w, k, v, -kk, kk*a)
+        xx = y.to(dtype=x.dtype)
+        state.copy_(s)
+
+        xx = torch.nn.functional.group_norm(xx.view(B*T,H*N), num_groups=H, weight=ln_w, bias=ln_b, eps = 64e-5).view(B,T,H*N)
+        xx = xx + ((r * k * r_k).view(B,T,H,N).sum(dim=-1, keepdim=True) * v.view(B,T,H,N)).view(B,T,H*N)
+        x_prev.copy_(x[:,-1,:])
+        return matmul_q(xx * g, O_, O_s), x_prev, state, v_first
+
+@MyStatic
+def RWKV_x070_CMix_batch_one(x, x_prev, x_k, K_, V_, K_s, V_s):
+    xx = x_prev - x
+    k = x + xx * x_k
+    k = torch.relu(matmul_q(k, K_, K_s)) ** 2
+    x_prev.copy_(x)
+    return matmul_q(k, V_, V_s), x_prev
+
+@MyStatic
+def RWKV_x070_CMix_batch_seq(x, pad, x_prev, x_k, K_, V_, K_s, V_s):
+    x = torch.where(pad.unsqueeze(-1), x_prev.unsqueeze(1), x)
+    xx = torch.cat((x_prev.unsqueeze(1), x[:,:-1,:]), dim=1) - x
+    k = x + xx * x_k
+    k = torch.relu(matmul_q(k, K_, K_s)) ** 2
+    x_prev.copy_(x[:,-1,:])
+    return matmul_q(k, V_, V_s), x_prev
 
 ########################################################################################################
 
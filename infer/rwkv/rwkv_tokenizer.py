@@ -2,6 +2,14 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
+import os, codecs, itertools, hashlib, json, struct, mmap
+import numpy as np
+
+# Compiled vocabulary cache: '<vocab>.bin' in $XDG_CACHE_HOME/rwkv or ~/.cache/rwkv (RWKV_VOCAB_CACHE=<dir> puts it
+# there instead, RWKV_VOCAB_CACHE=0 disables it). Layout: magic, u64 header length, JSON header, then 64-byte aligned arrays.
+VOCAB_CACHE_MAGIC = b'RWKVVOC1'
+VOCAB_CACHE_VERSION = 1
+
 class TRIE:
     __slots__ = tuple("ch,to,values,front".split(","))
     to:list
@@ -47,7 +55,28 @@ class TRIE:
         return ret
 
 class TRIE_TOKENIZER():
-    def __init__(self, file_name):
+    def __init__(self, file_name, cache_file=None):
+        """
+        cache_file: compiled vocab cache to load or (re)build, None for vocab_cache_path(file_name), False for none.
+        """
+        digest = vocab_hash(file_name)
+        if cache_file is None:
+            cache_file = vocab_cache_path(file_name)
+        cached = load_vocab_cache(cache_file, digest) if cache_file else None
+        if cached is not None:
+            self.idx2token, arrays = cached
+            self._token2idx = None
+        else:
+            self.read_vocab(file_name)
+            arrays = build_double_array(self.token2idx)
+            if cache_file:
+                try:
+                    save_vocab_cache(cache_file, digest, self.idx2token, arrays)
+                except OSError:
+                    pass # unwritable cache directory, the next start builds again
+        self.set_arrays(*arrays)
+
+    def read_vocab(self, file_name):
         self.idx2token = {}
         sorted = [] # must be already sorted
         with open(file_name, "r", encoding="utf-8") as f:
@@ -61,24 +90,33 @@ class TRIE_TOKENIZER():
             sorted += [x]
             self.idx2token[idx] = x
 
-        self.token2idx = {}
+        self._token2idx = {}
         for k,v in self.idx2token.items():
-            self.token2idx[v] = int(k)
+            self._token2idx[v] = int(k)
 
-        self.root = TRIE()
-        for t, i in self.token2idx.items():
-            _ = self.root.add(t, val=(t, i))
+    @property
+    def token2idx(self):
+        if self._token2idx is None:
+            self._token2idx = {v: k for k, v in self.idx2token.items()}
+        return self._token2idx
+
+    def set_arrays(self, base, check, value):
+        """
+        Installs the double-array trie (see build_double_array); the encode loop reads it through memoryviews,
+        which index as fast as lists without holding a Python int per slot.
+        """
+        self.base, self.check, self.value = base, check, value
+        self._da = (memoryview(base), memoryview(check), memoryview(value))
 
     def encodeBytes(self, src:bytes):
-        idx:int = 0
-        tokens = []
-        while (idx < len(src)):
-            _idx:int = idx
-            idx, _, values = self.root.find_longest(src, idx)
-            assert(idx != _idx)
-            _, token = next(iter(values))            
-            tokens.append(token)
-        return tokens
+        return _encode_longest(src, *self._da)
+
+    def encode_many(self, srcs):
+        """
+        Batched encode: a list of str (or bytes) -> a list of token lists.
+        """
+        base, check, value = self._da
+        return [_encode_longest(x.encode("utf-8") if isinstance(x, str) else x, base, check, value) for x in srcs]
 
     def decodeBytes(self, tokens):
         return b''.join(map(lambda i: self.idx2token[i], tokens))
@@ -92,6 +130,9 @@ class TRIE_TOKENIZER():
         except:
             return '\ufffd' # bad utf-8
 
+    def stream(self):
+        return UTF8Stream(self.idx2token)
+
     def printTokens(self, tokens):
         for i in tokens:
             s = self.idx2token[i]
@@ -101,3 +142,181 @@ class TRIE_TOKENIZER():
                 pass
             print(f'{repr(s)}{i}', end=' ')
         print()
+
+def build_double_array(token2idx):
+    """
+    Double-array trie over the token byte strings, as three int32 arrays indexed by node slot:
+    the child of slot s on byte c is t = base[s] + c, valid iff check[t] == s; value[t] is the token id
+    ending at t or -1. The root is slot 0. Arrays are padded so base[s] + 255 is always in range.
+    Nodes are placed breadth first, each at the first base whose child slots are all free.
+    """
+    prefixes = sorted({t[:k] for t in token2idx for k in range(1, len(t) + 1)}, key=lambda p: (len(p), p))
+    n = len(prefixes) + 512
+    base, check, value = [0] * n, [-1] * n, [-1] * n
+    nxt, prv = list(range(1, n + 1)), list(range(-1, n - 1)) # doubly linked list of free slots
+    check[0] = -2 # the root is nobody's child
+    head = 1 # where base searches start
+    fails = {}
+    slot = {b'': 0}
+    for parent, group in itertools.groupby(prefixes, key=lambda p: p[:-1]):
+        group = list(group)
+        labels = [p[-1] for p in group]
+        while fails.get(head, 0) > 16 and nxt[head] < len(check): # crowded region, start searches further on
+            head = nxt[head]
+        f = head
+        while True:
+            b = f - labels[0]
+            if b >= 1:
+                if b + 256 > len(check):
+                    grow = b + 256 - len(check) + len(check) // 2
+                    m = len(check)
+                    base += [0] * grow; check += [-1] * grow; value += [-1] * grow
+                    nxt += range(m + 1, m + grow + 1); prv += range(m - 1, m + grow - 1)
+                if all(check[b + c] == -1 for c in labels):
+                    break
+                fails[f] = fails.get(f, 0) + 1
+            f = nxt[f]
+        ps = slot[parent]
+        base[ps] = b
+        for p, c in zip(group, labels):
+            t = b + c
+            check[t] = ps
+            value[t] = token2idx.get(p, -1)
+            slot[p] = t
+            a, z = prv[t], nxt[t]
+            if t == head:
+                head = z
+            else:
+                nxt[a] = z
+            if z < len(prv):
+                prv[z] = a
+    size = max(base) + 256
+    return (np.array(base[:size], dtype=np.int32), np.array(check[:size], dtype=np.int32),
+            np.array(value[:size], dtype=np.int32))
+
+def vocab_hash(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def vocab_cache_path(file_name):
+    """
+    Where the compiled cache of `file_name` lives: $RWKV_VOCAB_CACHE (0 disables it), else the user cache
+    directory ($XDG_CACHE_HOME/rwkv or ~/.cache/rwkv), never next to the vocab inside the package.
+    """
+    d = os.environ.get('RWKV_VOCAB_CACHE')
+    if d == '0':
+        return None
+    if not d:
+        d = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'rwkv')
+    return os.path.join(d, os.path.basename(file_name) + '.bin')
+
+def save_vocab_cache(path, digest, idx2token, arrays):
+    """
+    Writes the id->bytes table and the trie arrays of a vocab whose file hashes to `digest`, atomically.
+    """
+    ids = np.array(sorted(idx2token), dtype=np.int32)
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(idx2token[i]) for i in ids.tolist()])
+    blob = np.frombuffer(b''.join(idx2token[i] for i in ids.tolist()), dtype=np.uint8)
+    items = [('ids', ids), ('offsets', offsets), ('base', arrays[0]), ('check', arrays[1]), ('value', arrays[2]), ('blob', blob)]
+    header, offset = {}, 0
+    for name, a in items:
+        offset += -offset % 64
+        header[name] = [a.dtype.str, offset, int(a.size)]
+        offset += a.nbytes
+    header['__metadata__'] = {'version': VOCAB_CACHE_VERSION, 'sha256': digest}
+    h = json.dumps(header).encode('utf-8')
+    h += b' ' * (-(len(VOCAB_CACHE_MAGIC) + 8 + len(h)) % 64)
+    start = len(VOCAB_CACHE_MAGIC) + 8 + len(h)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp' # concurrent first starts each write their own file
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(VOCAB_CACHE_MAGIC + struct.pack('<Q', len(h)) + h)
+            for name, a in items:
+                f.write(b'\0' * (start + header[name][1] - f.tell()))
+                f.write(a.tobytes())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def load_vocab_cache(path, digest):
+    """
+    Maps a cache written by save_vocab_cache. Returns (idx2token, (base, check, value)), or None when the
+    file is missing, unreadable or was built from a different vocab file. The trie arrays point into a
+    copy-on-write map, so processes forked after loading share their pages.
+    """
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        return None
+    m = len(VOCAB_CACHE_MAGIC)
+    if buf[:m] != VOCAB_CACHE_MAGIC:
+        return None
+    (n,) = struct.unpack('<Q', buf[m:m + 8])
+    try:
+        header = json.loads(bytes(buf[m + 8:m + 8 + n]).decode('utf-8'))
+    except ValueError:
+        return None
+    meta = header.pop('__metadata__', {})
+    if meta.get('version') != VOCAB_CACHE_VERSION or meta.get('sha256') != digest:
+        return None
+    start = m + 8 + n
+    a = {name: np.frombuffer(buf, dtype=np.dtype(dt), count=count, offset=start + off) for name, (dt, off, count) in header.items()}
+    blob = a['blob'].tobytes()
+    offsets = a['offsets'].tolist()
+    idx2token = {i: blob[offsets[k]:offsets[k + 1]] for k, i in enumerate(a['ids'].tolist())}
+    return idx2token, (a['base'], a['check'], a['value'])
+
+def _encode_longest(src, base, check, value):
+    # greedy longest match, the same tokens as TRIE.find_longest
+    tokens = []
+    idx, n = 0, len(src)
+    while idx < n:
+        s, j, token, end = 0, idx, -1, idx
+        while j < n:
+            t = base[s] + src[j]
+            if check[t] != s:
+                break
+            s = t
+            j += 1
+            if value[s] >= 0:
+                token, end = value[s], j
+        assert end != idx
+        tokens.append(token)
+        idx = end
+    return tokens
+
+class UTF8Stream():
+    """
+    Incremental detokenizer for one output stream: push() takes one token and returns the text of every
+    code point it completes. Bytes of an unfinished multi-byte character wait in the decoder (at most 3);
+    invalid bytes come out as U+FFFD instead of stalling the stream. Ids without bytes (specials) add nothing.
+    """
+    __slots__ = ('idx2token', 'decoder')
+
+    def __init__(self, idx2token):
+        self.idx2token = idx2token
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def push(self, token):
+        return self.decoder.decode(self.idx2token.get(token, b''))
+
+    def flush(self):
+        """
+        Text of the pending bytes at the end of the stream (U+FFFD if they never completed a character).
+        """
+        return self.decoder.decode(b'', final=True)
+
+    def reset(self):
+        self.decoder.reset()
+
+    @staticmethod
+    def push_many(streams, tokens):
+        """
+        Batched push: one token for each stream, returns one (possibly empty) string per stream.
+        """
+        return [s.decoder.decode(s.idx2token.get(t, b'')) for s, t in zip(streams, tokens)]
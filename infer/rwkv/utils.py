@@ -7,6 +7,126 @@ import numpy as np
 import torch
 from torch.nn import functional as F
 
+VISION_START_ID = 65530 # <|vision_start|>
+VISION_END_ID = 65531 # <|vision_end|>
+IMAGE_PAD_ID = 65532 # <|image_pad|>
+SAMPLE_CANDIDATES = 1024 # top-p is evaluated over this many most likely tokens, see sample_tokens
+
+class Prompt(list):
+    """
+    Prompt token ids plus `spans`, the [start, end) offsets of every modality placeholder run, so nothing
+    downstream has to search the ids for them. Slicing or concatenating gives a plain list.
+    """
+    def __init__(self, tokens=(), spans=()):
+        super().__init__(tokens)
+        self.spans = list(spans)
+
+def build_prompt(encode, parts, pad_id=IMAGE_PAD_ID):
+    """
+    parts: text pieces (str) and placeholder counts (int), in order. A count n becomes <|vision_start|>,
+    n pads and <|vision_end|> as ids; only the text goes through `encode`. Returns a Prompt.
+    """
+    tokens, spans = [], []
+    for p in parts:
+        if isinstance(p, str):
+            if p:
+                tokens += encode(p)
+        else:
+            tokens.append(VISION_START_ID)
+            spans.append((len(tokens), len(tokens) + p))
+            tokens += [pad_id] * p
+            tokens.append(VISION_END_ID)
+    return Prompt(tokens, spans)
+
+def modality_spans(tokens, pad_id=IMAGE_PAD_ID):
+    """
+    [start, end) of every run of placeholder tokens in `tokens`.
+    """
+    spans = []
+    for i, t in enumerate(tokens):
+        if t == pad_id:
+            if spans and spans[-1][1] == i:
+                spans[-1] = (spans[-1][0], i + 1)
+            else:
+                spans.append((i, i + 1))
+    return spans
+
+def prompt_spans(tokens):
+    return tokens.spans if isinstance(tokens, Prompt) else modality_spans(tokens)
+
+def modality_features(tokens, sign):
+    """
+    (spans, feats) for chunked prefill: the placeholder runs of `tokens`, and `sign` as one row per placeholder.
+    """
+    spans = prompt_spans(tokens)
+    feats = sign.reshape(-1, sign.shape[-1])
+    n = sum(e - s for s, e in spans)
+    if n != feats.shape[0]:
+        raise ValueError(f"Image features and image tokens do not match: tokens: {n}, features {feats.shape[0]}")
+    return spans, feats
+
+def chunk_modality(spans, feats, start, end):
+    """
+    What the chunk tokens[start:end] gets of a modality: (its feature rows, its spans relative to start),
+    or (None, None) when it has no placeholders. A span may straddle chunk boundaries.
+    """
+    local, lo, hi = [], 0, 0
+    for s, e in spans:
+        lo += max(0, min(e, start) - s)
+        hi += max(0, min(e, end) - s)
+        if max(s, start) < min(e, end):
+            local.append((max(s, start) - start, min(e, end) - start))
+    if not local:
+        return None, None
+    return feats[lo:hi], local
+
+def _per_row(v, B):
+    return [float(x) for x in v] if isinstance(v, (list, tuple)) else [float(v)] * B
+
+def _gumbel_argmax(scores):
+    # argmax(log p + Gumbel noise) is a sample from softmax(scores), with no host round trip
+    noise = torch.empty_like(scores).exponential_().clamp_(min=1e-30).log_()
+    return (scores - noise).argmax(dim=-1, keepdim=True)
+
+def sample_tokens(logits, temperature=1.0, top_p=0.85, top_k=0, candidates=SAMPLE_CANDIDATES):
+    """
+    Samples one token per row of `logits` [B, V] on their device, without host syncs.
+    temperature / top_p / top_k are scalars or per-row lists. As in the original sampler, top-p and top-k
+    are applied to the temperature-1 probabilities (ties at the cutoff are kept), then the temperature to
+    what is left; temperature 0 is greedy. Only the top max(candidates, top_k) tokens are selected
+    (torch.topk) instead of sorting the vocabulary, so a row with top_k == 0 whose nucleus needs more
+    candidates than that is cut at the candidates; those rows are reported in `covered`.
+    Returns (ids [B] int64, covered [B] bool).
+    """
+    B, V = logits.shape
+    device = logits.device
+    temperature, top_p, top_k = _per_row(temperature, B), _per_row(top_p, B), _per_row(top_k, B)
+    top_p = [0.0 if t <= 0 else p for t, p in zip(temperature, top_p)]
+    temperature = [1.0 if t <= 0 else t for t in temperature]
+    top_k = [int(k) if 0 < k < V else 0 for k in top_k]
+    K = min(V, max([candidates] + top_k))
+
+    logp = F.log_softmax(logits.float(), dim=-1)
+    inv_t = torch.tensor(temperature, device=device).reshape(B, 1).reciprocal_()
+    p = torch.tensor(top_p, device=device).reshape(B, 1)
+    k = torch.tensor([kk if kk > 0 else K for kk in top_k], device=device).reshape(B, 1)
+
+    top_logp, top_ids = torch.topk(logp, K, dim=-1) # sorted, most likely first
+    probs = top_logp.exp()
+    cum = probs.cumsum(dim=-1)
+    n_keep = ((cum - probs) < p).sum(dim=-1, keepdim=True).clamp_(min=1) # up to the first token reaching top_p
+    keep = top_logp >= top_logp.gather(-1, n_keep - 1)
+    keep &= torch.arange(K, device=device) < k
+    ids = top_ids.gather(-1, _gumbel_argmax((top_logp * inv_t).masked_fill_(~keep, -float('inf')))).squeeze(-1)
+    covered = (k < K).squeeze(-1) | (cum[:, -1] >= p.squeeze(-1)) | (K == V)
+
+    full = [kk == 0 and pp >= 1 for kk, pp in zip(top_k, top_p)] # no truncation: sample the whole vocabulary
+    if any(full):
+        full = torch.tensor(full, device=device)
+        ids = torch.where(full, _gumbel_argmax(logp * inv_t).squeeze(-1), ids)
+        covered |= full
+    return ids, covered
+
 class PIPELINE_ARGS():
     def __init__(self, temperature=1.0, top_p=0.85, top_k=0, alpha_frequency=0.2, alpha_presence=0.2, alpha_decay=0.996, token_ban=[], token_stop=[], chunk_len=1024):
         self.temperature = temperature
@@ -19,9 +139,105 @@ class PIPELINE_ARGS():
         self.token_stop = token_stop # stop generation whenever you see any token here
         self.chunk_len = chunk_len # split input into chunks to save VRAM (shorter -> slower)
 
+class PenaltyState():
+    """
+    Repetition penalties, bans and stop tokens of N sequences as dense [N, V] device tensors, so a step
+    costs the same however long the generation is. Row n belongs to one sequence (an engine slot, or row 0
+    in PIPELINE.generate). `weight` [V] is what a sampled token adds to its occurrence count
+    (PIPELINE.penalty_weight: 0 for whitespace / digit tokens, 1 otherwise).
+    """
+    def __init__(self, n, weight):
+        V, device = weight.shape[0], weight.device
+        self.weight = weight
+        self.occurrence = torch.zeros((n, V), device=device)
+        self.seen = torch.zeros((n, V), dtype=torch.bool, device=device) # presence penalty applies even at weight 0
+        self.ban = torch.zeros((n, V), device=device) # 0 or -inf, added to the logits
+        self.stop = torch.zeros((n, V), dtype=torch.bool, device=device)
+        self.alpha = torch.zeros((n, 3), device=device) # presence, frequency, decay
+        self.masks = {} # (token_ban, token_stop) -> (ban row, stop row), built once per distinct list
+
+    def reset(self, row, args):
+        key = (tuple(args.token_ban), tuple(args.token_stop))
+        if key not in self.masks:
+            ban = torch.zeros_like(self.ban[0])
+            stop = torch.zeros_like(self.stop[0])
+            if args.token_ban:
+                ban[list(args.token_ban)] = -float('inf')
+            if args.token_stop:
+                stop[list(args.token_stop)] = True
+            self.masks[key] = (ban, stop)
+        ban, stop = self.masks[key]
+        self.ban[row].copy_(ban)
+        self.stop[row].copy_(stop)
+        self.occurrence[row].zero_()
+        self.seen[row].zero_()
+        self.alpha[row] = torch.tensor([args.alpha_presence, args.alpha_frequency, args.alpha_decay])
+
+    def move(self, src, dst):
+        for t in (self.occurrence, self.seen, self.ban, self.stop, self.alpha):
+            t[dst].copy_(t[src])
+
+    def apply(self, logits):
+        """
+        Penalizes logits [B, V] of rows [0:B] in place.
+        """
+        B = logits.shape[0]
+        a = self.alpha[:B]
+        pen = torch.addcmul(self.seen[:B] * a[:, 0:1], self.occurrence[:B], a[:, 1:2])
+        return logits.sub_(pen.to(logits.dtype)).add_(self.ban[:B].to(logits.dtype))
+
+    def stops(self, tokens):
+        """
+        [B] bool tensor: which of the tokens [B] (a device tensor) of rows [0:B] are stop tokens.
+        """
+        B = tokens.shape[0]
+        return self.stop[:B].gather(1, tokens.reshape(B, 1)).squeeze(1)
+
+    def update(self, tokens):
+        """
+        Records the sampled tokens [B] (a device tensor) of rows [0:B]. Returns stops(tokens).
+        """
+        B = tokens.shape[0]
+        t = tokens.reshape(B, 1)
+        occ = self.occurrence[:B]
+        occ.mul_(self.alpha[:B, 2:3]).scatter_add_(1, t, self.weight[t])
+        self.seen[:B].scatter_(1, t, True)
+        return self.stops(tokens)
+
+class RedecodeStream():
+    """
+    UTF8Stream stand-in for tokenizers without per-token bytes: re-decodes the tokens since the last
+    complete piece until they form valid UTF-8.
+    """
+    def __init__(self, decode):
+        self.decode = decode
+        self.pending = []
+
+    def push(self, token):
+        self.pending.append(token)
+        tmp = self.decode(self.pending)
+        if '\ufffd' in tmp:
+            return ''
+        self.pending = []
+        return tmp
+
+    def flush(self):
+        tmp = self.decode(self.pending) if self.pending else ''
+        self.pending = []
+        return tmp
+
+    def reset(self):
+        self.pending = []
+
+    @staticmethod
+    def push_many(streams, tokens):
+        return [s.push(t) for s, t in zip(streams, tokens)]
+
 class PIPELINE():
-    def __init__(self, model, WORD_NAME):
+    def __init__(self, model, WORD_NAME, prefix_cache=None):
         self.model = model
+        self.prefix_cache = prefix_cache # optional infer.prefix_cache.PrefixCache
+        self._penalty_weight = None
         if WORD_NAME == 'cl100k_base':
             import tiktoken
             self.tokenizer = tiktoken.get_encoding(WORD_NAME)
@@ -56,89 +272,123 @@ class PIPELINE():
     def decode(self, x):
         return self.tokenizer.decode(x)
 
+    def stream_decoder(self):
+        """
+        Incremental detokenizer for one output stream (see rwkv_tokenizer.UTF8Stream).
+        """
+        if hasattr(self.tokenizer, 'stream'):
+            return self.tokenizer.stream()
+        return RedecodeStream(self.decode)
+
+    def decode_many(self, streams, tokens):
+        """
+        Pushes one token into each of `streams` (from stream_decoder), returns the new text of each.
+        """
+        return streams[0].push_many(streams, tokens) if streams else []
+
     def sample_logits(self, logits, temperature=1.0, top_p=0.85, top_k=0):
-        if temperature == 0:
-            temperature = 1.0
-            top_p = 0
-        probs = F.softmax(logits.float(), dim=-1)
-        top_k = int(top_k)
-        # 'privateuseone' is the type of custom devices like `torch_directml.device()`
-        if probs.device.type in ['cpu', 'privateuseone']:
-            probs = probs.cpu().numpy()
-            sorted_ids = np.argsort(probs)
-            sorted_probs = probs[sorted_ids][::-1]
-            cumulative_probs = np.cumsum(sorted_probs)
-            cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
-            probs[probs < cutoff] = 0
-            if top_k < len(probs) and top_k > 0:
-                probs[sorted_ids[:-top_k]] = 0
-            if temperature != 1.0:
-                probs = probs ** (1.0 / temperature)
-            probs = probs / np.sum(probs)
-            out = np.random.choice(a=len(probs), p=probs)
-            return int(out)
-        else:
-            sorted_ids = torch.argsort(probs)
-            sorted_probs = probs[sorted_ids]
-            sorted_probs = torch.flip(sorted_probs, dims=(0,))
-            cumulative_probs = torch.cumsum(sorted_probs, dim=-1).cpu().numpy()
-            cutoff = float(sorted_probs[np.argmax(cumulative_probs >= top_p)])
-            probs[probs < cutoff] = 0
-            if top_k < len(probs) and top_k > 0:
-                probs[sorted_ids[:-top_k]] = 0
-            if temperature != 1.0:
-                probs = probs ** (1.0 / temperature)
-            out = torch.multinomial(probs, num_samples=1)[0]
-            return int(out)
-    
-    def generate(self, ctx, token_count=100, args=PIPELINE_ARGS(), callback=None, state=None, sign=None):
+        ids, covered = sample_tokens(logits.reshape(1, -1), temperature, top_p, top_k)
+        token, covered = torch.stack([ids[0], covered[0].long()]).tolist() # the only host sync
+        if not covered: # rare: the nucleus is wider than SAMPLE_CANDIDATES tokens, redo it over the full vocabulary
+            token = int(sample_tokens(logits.reshape(1, -1), temperature, top_p, top_k, candidates=logits.numel())[0][0])
+        return token
+
+    def sample_logits_batch(self, logits, temperature=1.0, top_p=0.85, top_k=0):
+        """
+        Samples a token for each row of logits [B, V] with per-row (or shared) parameters.
+        Returns the ids as a [B] tensor on the logits' device; nothing is synced. See sample_tokens.
+        """
+        return sample_tokens(logits, temperature, top_p, top_k)[0]
+
+    def penalty_weight(self, vocab_size, device):
+        """
+        [V] occurrence increment per token for PenaltyState: 0 where the decoded token is a substring of
+        ' \\t0123456789' (whitespace and digits are not penalized), else 1. Decodes the vocabulary once.
+        """
+        w = self._penalty_weight
+        if w is None or w.shape[0] != vocab_size:
+            light = []
+            for i in range(vocab_size):
+                try:
+                    ttt = self.decode([i])
+                except Exception: # ids past the tokenizer's vocabulary
+                    continue
+                if ttt in ' \t0123456789':
+                    light.append(i)
+            w = torch.ones(vocab_size)
+            if light:
+                w[light] = 0
+            self._penalty_weight = w
+        return w.to(device)
+
+    def penalty_state(self, n, vocab_size, device):
+        return PenaltyState(n, self.penalty_weight(vocab_size, device))
+
+    def forward_prompt(self, tokens, state=None, args=PIPELINE_ARGS(), sign=None, media_key=None):
+        """
+        Prefills `tokens` in chunk_len pieces, each spliced with exactly the modality feature rows it covers,
+        reusing and filling the prefix cache when one is set and `state` is None.
+        Snapshots are taken after the last modality span and at the end of the prompt.
+        """
+        spans, feats = modality_features(tokens, sign) if isinstance(sign, torch.Tensor) else ([], None)
+        cache = self.prefix_cache if state is None else None
+        done, out, key = 0, None, None
+        if cache is not None:
+            key = cache.make_key(tokens, sign, media_key)
+            done, state, out = cache.match(key)
+        for end in ([spans[-1][1]] if spans else []) + [len(tokens)]:
+            if done >= end:
+                continue
+            for i in range(done, end, args.chunk_len):
+                j = min(i + args.chunk_len, end)
+                rows, local = chunk_modality(spans, feats, i, j)
+                out, state = self.model.forward(tokens[i:j], state, sign=rows, spans=local)
+            done = end
+            if cache is not None:
+                cache.insert(key[:end], state, out)
+        return out, state
+
+    def generate(self, ctx, token_count=100, args=PIPELINE_ARGS(), callback=None, state=None, sign=None, media_key=None):
         all_tokens = []
-        out_last = 0
         out_str = ''
-        occurrence = {}
+        penalty = None
+        stream = self.stream_decoder()
         for i in range(token_count):
 
             # forward & adjust prob.
-            tokens = self.encode(ctx) if i == 0 else [token]
-            while len(tokens) > 0:
-                out, state = self.model.forward(tokens[:args.chunk_len], state, sign=sign)
-                tokens = tokens[args.chunk_len:]
+            if i == 0:
+                tokens = ctx if isinstance(ctx, list) else self.encode(ctx) # text, or ids (e.g. a Prompt)
+                out, state = self.forward_prompt(tokens, state, args, sign=sign, media_key=media_key)
+                penalty = self.penalty_state(1, out.shape[-1], out.device)
+                penalty.reset(0, args)
+            else:
+                out, state = self.model.forward([token], state)
             
-            for n in args.token_ban:
-                out[n] = -float('inf')
-            for n in occurrence:
-                out[n] -= (args.alpha_presence + occurrence[n] * args.alpha_frequency)
+            logits = penalty.apply(out.view(1, -1))
             
-            # sampler
-            token = self.sample_logits(out, temperature=args.temperature, top_p=args.top_p, top_k=args.top_k)
+            # sampler; the stop check reads PenaltyState's stop row, like the engine, in the same sync
+            ids, covered = sample_tokens(logits, args.temperature, args.top_p, args.top_k)
+            token, covered, stop = torch.stack([ids[0], covered[0].long(), penalty.stops(ids)[0].long()]).tolist()
+            if not covered: # rare: the nucleus is wider than SAMPLE_CANDIDATES tokens, redo it over the full vocabulary
+                ids = sample_tokens(logits, args.temperature, args.top_p, args.top_k, candidates=logits.shape[-1])[0]
+                token, stop = torch.stack([ids[0], penalty.stops(ids)[0].long()]).tolist()
             
-            if token in args.token_stop:
+            if stop:
                 break
             all_tokens += [token]
-            for xxx in occurrence:
-                occurrence[xxx] *= args.alpha_decay
-            
-            ttt = self.decode([token])
-
-            www = 1
-            if ttt in ' \t0123456789':
-                www = 0
-            # elif ttt in '\r\n,.;?!"\':+-*/=#@$%^&_`~|<>\\()[]{}，。；“”：？！（）【】':
-            #     www = 0.5
-            if token not in occurrence:
-                occurrence[token] = www
-            else:
-                occurrence[token] += www
-            # print(occurrence) # debug
+            penalty.update(ids)
             
             # output
-            tmp = self.decode(all_tokens[out_last:])
-            if '\ufffd' not in tmp: # is valid utf-8 string?
+            tmp = stream.push(token) # only complete characters, so it never ends mid-sequence
+            if tmp:
                 if callback:
                     callback(tmp)
                 out_str += tmp
-                out_last = i + 1
-            sign =None
+        tmp = stream.flush() # bytes held back for a character the output stopped in the middle of
+        if tmp:
+            if callback:
+                callback(tmp)
+            out_str += tmp
         return out_str, state
     
     def prefill(self, ctx, token_count=100, args=PIPELINE_ARGS(), callback=None, state=None, sign=None):
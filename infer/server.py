@@ -1,13 +1,22 @@
 import base64
 import json
 import io
+import time
+import asyncio
 from typing import List, Optional, Dict, Any, Union
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from PIL import Image
 import uvicorn
 from infer.worldmodel import Worldinfer
+from infer.engine import Engine
+from infer.rwkv.utils import Prompt
+from infer.session import SessionStore, message_digests
+from infer.encoder_cache import EncoderCache
+from infer.prefix_cache import PrefixCache
+from infer.encoder_batcher import EncoderBatcher
 import argparse
 # llm_path = "/home/rwkv/models/0808test/step2/rwkv-0"
 # encoder_path = "/home/rwkv/models/siglip2"
@@ -18,12 +27,40 @@ parser.add_argument("--port", type=int, default=8000, help="监听端口")
 parser.add_argument("--llm_path", type=str, required=True, help="rwkv 模型路径")
 parser.add_argument("--encoder_path", type=str, required=True, help="视觉 encoder 路径")
 parser.add_argument("--encoder_type", type=str, default="siglip", help="encoder 类型")
+parser.add_argument("--strategy", type=str, default="cuda bf16", help="如 cuda bf16 / cuda bf16i8 / cpu fp32i4 (i8/i4 为权重量化)")
+parser.add_argument("--fused", action="store_true", help="加载时融合投影矩阵 (解码更快, 不支持 i8/i4)")
+parser.add_argument("--max_batch", type=int, default=16, help="最大并发解码请求数")
+parser.add_argument("--prefill_tokens", type=int, default=1024, help="每个调度步的预填充 token 预算")
+parser.add_argument("--session_mb", type=int, default=4096, help="显存中会话 state 的预算 (MB)")
+parser.add_argument("--session_host_mb", type=int, default=32768, help="内存中会话 state 的预算 (MB)")
+parser.add_argument("--session_ttl", type=int, default=3600, help="会话空闲过期时间 (秒)")
+parser.add_argument("--session_quant", type=str, default=None, choices=["int8", "fp8"], help="以 int8/fp8 存储空闲会话的 state")
+parser.add_argument("--encoder_cache_mb", type=int, default=1024, help="内存中 encoder 输出缓存的预算 (MB), 0 为关闭")
+parser.add_argument("--encoder_cache_dir", type=str, default=None, help="encoder 输出缓存的磁盘目录")
+parser.add_argument("--encoder_cache_disk_mb", type=int, default=8192, help="磁盘上 encoder 输出缓存的预算 (MB)")
+parser.add_argument("--prefix_cache_mb", type=int, default=2048, help="显存中前缀 state 缓存 (共享的系统提示/图片) 的预算 (MB), 0 为关闭")
+parser.add_argument("--prefix_cache_host_mb", type=int, default=8192, help="内存中前缀 state 缓存的预算 (MB)")
+parser.add_argument("--encoder_batch", type=int, default=32, help="并发请求的图像合并为一个 encoder batch 的上限, 0 为关闭")
+parser.add_argument("--encoder_window_ms", type=float, default=5.0, help="凑 encoder batch 的等待时间 (毫秒)")
 args = parser.parse_args()
 
 current_state = None
 first_question = False
 
-model = Worldinfer(model_path=args.llm_path, encoder_type=args.encoder_type, encoder_path=args.encoder_path)
+encoder_cache = None
+if args.encoder_cache_mb > 0:
+    encoder_cache = EncoderCache(max_bytes=args.encoder_cache_mb << 20, disk_dir=args.encoder_cache_dir, disk_bytes=args.encoder_cache_disk_mb << 20)
+prefix_cache = None
+if args.prefix_cache_mb > 0:
+    prefix_cache = PrefixCache(max_bytes=args.prefix_cache_mb << 20, host_bytes=args.prefix_cache_host_mb << 20)
+model = Worldinfer(model_path=args.llm_path, encoder_type=args.encoder_type, encoder_path=args.encoder_path, strategy=args.strategy,
+                   prefix_cache=prefix_cache, encoder_cache=encoder_cache, fused=args.fused)
+encoder = model.encode_modality
+if args.encoder_batch > 0:
+    encoder = EncoderBatcher(model.encode_batch, max_items=args.encoder_batch, window=args.encoder_window_ms / 1000).start()
+engine = Engine(model.pipeline, args=model.args, encoder=encoder, media_key=model.media_key,
+                max_batch=args.max_batch, prefill_tokens=args.prefill_tokens).start()
+sessions = SessionStore(max_bytes=args.session_mb << 20, host_bytes=args.session_host_mb << 20, ttl=args.session_ttl, quantize=args.session_quant)
 
 app = FastAPI(title="WorldRWKV API", version="1.0.0")
 
@@ -56,6 +93,7 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = 1000
     temperature: Optional[float] = 0.7
     stream: Optional[bool] = False
+    session_id: Optional[str] = None # 会话 id: 复用上一轮的 state, 只预填充新的用户消息
 
 class ChatCompletionResponse(BaseModel):
     id: str
@@ -107,6 +145,62 @@ def process_messages(messages: List[Message]) -> tuple[str, Optional[Image.Image
 
     return text_content, image
 
+def last_message_image(messages: List[Message]) -> Optional[Image.Image]:
+    # 最后一条用户消息附带的图片, 会话命中时它还不在 state 中
+    message = messages[-1] if messages else None
+    if message is None or message.role != "user" or isinstance(message.content, str):
+        return None
+    image = None
+    for content in message.content:
+        if isinstance(content, ImageContent) and content.image_url.url.startswith('data:image'):
+            image = base64_to_pil_image(content.image_url.url)
+    return image
+
+def message_pairs(messages: List[Message]) -> List[tuple]:
+    pairs = []
+    for message in messages:
+        if isinstance(message.content, str):
+            pairs.append((message.role, message.content))
+        else:
+            parts = [c.text if isinstance(c, TextContent) else c.image_url.url for c in message.content]
+            pairs.append((message.role, '\0'.join(parts)))
+    return pairs
+
+def remember_turn(request: ChatCompletionRequest, digests: Optional[List[str]], req):
+    if digests is None or req.finish_reason not in ("stop", "length"):
+        return
+    digest = message_digests([("assistant", req.out_str)], prev=digests[-1])[-1]
+    sessions.push(request.session_id, req.state, [req.last_token], len(request.messages) + 1, digest)
+
+def sse_chunk(chunk_id: str, created: int, model_name: str, delta: Dict[str, str], finish_reason: Optional[str] = None) -> str:
+    chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model_name,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+async def stream_chat(req, pieces: asyncio.Queue, chunk_id: str, created: int, model_name: str, on_done=None):
+    # engine 只在完整 UTF-8 字符处回调, 每个 piece 都是可直接发送的文本
+    try:
+        yield sse_chunk(chunk_id, created, model_name, {"role": "assistant", "content": ""})
+        while True:
+            piece = await pieces.get()
+            if piece is None:
+                break
+            yield sse_chunk(chunk_id, created, model_name, {"content": piece})
+        if on_done is not None:
+            on_done()
+        if req.error is not None:
+            yield f"data: {json.dumps({'error': {'message': str(req.error)}}, ensure_ascii=False)}\n\n"
+        else:
+            yield sse_chunk(chunk_id, created, model_name, {}, "length" if req.finish_reason == "length" else "stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        req.cancel() # 客户端断开时释放解码槽位
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 async def chat_completions(request: ChatCompletionRequest):
     global current_state, first_question
@@ -117,17 +211,42 @@ async def chat_completions(request: ChatCompletionRequest):
         if not user_input:
             raise HTTPException(status_code=400, detail="No text content found in messages")
 
-        if image is None:
-            raise HTTPException(status_code=400, detail="Image is required")
+        digests, turn, state = None, None, None
+        if request.session_id is not None:
+            digests = message_digests(message_pairs(request.messages))
+            turn, state = sessions.match(request.session_id, digests)
 
-        
-        result, state = model.generate(user_input, image, state=None)
+        if turn is not None:
+            # 历史 (包括之前的图片) 已在 state 中, 只预填充新的用户消息及其附带的图片
+            image = last_message_image(request.messages)
+            if image is not None:
+                tail, n = model.build_prompt(user_input, [image]), len(turn.tail)
+                prompt = Prompt(turn.tail + tail, [(s + n, e + n) for s, e in tail.spans])
+            else:
+                prompt = turn.tail + model.pipeline.encode(model.process_wr(user_input))
+        else:
+            if image is None:
+                raise HTTPException(status_code=400, detail="Image is required")
+            prompt = model.build_prompt(user_input, [image])
+
+        if request.stream:
+            loop = asyncio.get_running_loop()
+            pieces = asyncio.Queue()
+            req = engine.submit(prompt, modality=image, max_tokens=request.max_tokens, state=state,
+                                callback=lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text),
+                                on_finish=lambda _: loop.call_soon_threadsafe(pieces.put_nowait, None))
+            return StreamingResponse(stream_chat(req, pieces, f"chatcmpl-{int(time.time())}", int(time.time()), request.model,
+                                                 on_done=lambda: remember_turn(request, digests, req)),
+                                     media_type="text/event-stream")
+
+        req = engine.submit(prompt, modality=image, max_tokens=request.max_tokens, state=state)
+        result, state = await asyncio.to_thread(req.result)
+        remember_turn(request, digests, req)
         current_state = state
         bot_response = result
 
         final_response = bot_response
 
-        import time
         response = ChatCompletionResponse(
             id=f"chatcmpl-{int(time.time())}",
             created=int(time.time()),
@@ -138,12 +257,12 @@ async def chat_completions(request: ChatCompletionRequest):
                     "role": "assistant",
                     "content": final_response
                 },
-                "finish_reason": "stop"
+                "finish_reason": "length" if req.finish_reason == "length" else "stop"
             }],
             usage={
-                "prompt_tokens": len(user_input.split()),
-                "completion_tokens": len(final_response.split()),
-                "total_tokens": len(user_input.split()) + len(final_response.split())
+                "prompt_tokens": req.prompt_tokens,
+                "completion_tokens": len(req.all_tokens),
+                "total_tokens": req.prompt_tokens + len(req.all_tokens)
             }
         )
 
@@ -152,6 +271,20 @@ async def chat_completions(request: ChatCompletionRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str):
+    sessions.drop(session_id)
+    return {"id": session_id, "deleted": True}
+
+@app.get("/v1/stats")
+async def stats():
+    return {
+        "sessions": sessions.stats(),
+        "encoder_cache": encoder_cache.stats() if encoder_cache is not None else None,
+        "encoder_batch": encoder.stats() if isinstance(encoder, EncoderBatcher) else None,
+        "prefix_cache": prefix_cache.stats() if prefix_cache is not None else None,
+    }
+
 @app.get("/v1/models")
 async def list_models():
     return {
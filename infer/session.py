@@ -0,0 +1,186 @@
+########################################################################################################
+# Session-affine multi-turn state store
+#
+# Keeps, per conversation id, the RWKV state after each finished turn. A follow-up turn resumes from
+# the deepest snapshot whose message history still matches and only prefills the new user message;
+# "regenerate" / "edit last turn" match an earlier snapshot and roll back to it.
+########################################################################################################
+
+import threading, time, hashlib
+from collections import OrderedDict
+
+from infer.prefix_cache import state_nbytes
+from infer.state_quant import QuantizedState
+
+def message_digests(messages, prev=''):
+    """
+    Hash chain over (role, content) pairs: digests[n] identifies messages[:n] (continuing from `prev`).
+    """
+    digests = [prev]
+    for role, content in messages:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(digests[-1].encode())
+        h.update(role.encode())
+        h.update(b'\0')
+        h.update(content.encode())
+        digests.append(h.hexdigest())
+    return digests
+
+class Turn():
+    __slots__ = ('state', 'tail', 'n_messages', 'digest', 'device', 'nbytes')
+
+    def __init__(self, state, tail, n_messages, digest):
+        self.state = state # list of tensors, or a QuantizedState
+        self.tail = list(tail) # sampled tokens that are not in `state` yet (e.g. the stop token)
+        self.n_messages = n_messages # messages covered by this snapshot
+        self.digest = digest # message_digests(...)[n_messages]
+        self.device = self.state_device()
+        self.nbytes = state.nbytes if isinstance(state, QuantizedState) else state_nbytes(state)
+
+    def state_device(self):
+        return self.state.device if isinstance(self.state, QuantizedState) else self.state[0].device
+
+    def state_to(self, device):
+        if isinstance(self.state, QuantizedState):
+            self.state = self.state.to(device)
+        else:
+            self.state = [s.to(device) for s in self.state]
+
+    def restore(self):
+        if isinstance(self.state, QuantizedState):
+            return self.state.dequantize(self.device)
+        return [s.clone() for s in self.state]
+
+    def on_host(self):
+        return self.state_device().type == 'cpu' and self.device.type != 'cpu'
+
+class Session():
+    __slots__ = ('id', 'turns', 'last_access')
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.turns = []
+        self.last_access = time.monotonic()
+
+class SessionStore():
+    def __init__(self, max_bytes=4 << 30, host_bytes=32 << 30, ttl=3600, max_turns=4, quantize=None):
+        self.max_bytes = max_bytes # budget for snapshots kept on the model device
+        self.host_bytes = host_bytes # budget for snapshots spilled to host memory
+        self.ttl = ttl # seconds a session may stay idle
+        self.max_turns = max_turns # snapshots kept per session (how far back a regenerate / edit can resume)
+        self.quantize = quantize # None, 'int8' or 'fp8': how parked att_kv states are stored
+        self.sessions = OrderedDict() # id -> Session, least recently used first
+        self.device_used = 0
+        self.host_used = 0
+        self.lock = threading.Lock()
+
+    def match(self, session_id, digests):
+        """
+        Stored turn of `session_id` whose history equals the request's messages except the last one
+        (`digests` from `message_digests`), so only that message needs a prefill.
+        Turns after it are dropped (regenerate / edit). Returns (turn, state copy) or (None, None).
+        """
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None, None
+            self._touch(session)
+            for i in range(len(session.turns) - 1, -1, -1):
+                turn = session.turns[i]
+                if turn.n_messages == len(digests) - 2 and digests[turn.n_messages] == turn.digest:
+                    for dropped in session.turns[i+1:]:
+                        self._account(dropped, -1)
+                    del session.turns[i+1:]
+                    if turn.on_host(): # hot again, bring it back to the device
+                        self._account(turn, -1)
+                        turn.state_to(turn.device)
+                        self._account(turn, +1)
+                    return turn, turn.restore()
+            return None, None
+
+    def push(self, session_id, state, tail, n_messages, digest):
+        """
+        Stores the state after a finished turn covering `n_messages` messages.
+        """
+        if self.quantize is not None:
+            state = QuantizedState.from_state(state, self.quantize)
+        else:
+            state = [s.clone() for s in state]
+        turn = Turn(state, tail, n_messages, digest)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(session_id)
+            self._touch(session)
+            while session.turns and session.turns[-1].n_messages >= n_messages:
+                self._account(session.turns.pop(), -1)
+            session.turns.append(turn)
+            self._account(turn, +1)
+            while len(session.turns) > self.max_turns:
+                self._account(session.turns.pop(0), -1)
+            self._expire()
+            self._evict()
+
+    def drop(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                for turn in session.turns:
+                    self._account(turn, -1)
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'turns': sum(len(s.turns) for s in self.sessions.values()),
+            'device_bytes': self.device_used,
+            'host_bytes': self.host_used,
+        }
+
+    ####################################################################################################
+
+    def _touch(self, session):
+        session.last_access = time.monotonic()
+        self.sessions.move_to_end(session.id)
+
+    def _account(self, turn, sign):
+        if turn.on_host():
+            self.host_used += sign * turn.nbytes
+        else:
+            self.device_used += sign * turn.nbytes
+
+    def _drop(self, session):
+        del self.sessions[session.id]
+        for turn in session.turns:
+            self._account(turn, -1)
+
+    def _expire(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if now - session.last_access <= self.ttl:
+                break # ordered by last access
+            self._drop(session)
+
+    def _evict(self):
+        # idle sessions spill to host memory first, then the least recently used ones are dropped
+        for session in list(self.sessions.values()):
+            if self.device_used <= self.max_bytes:
+                break
+            for turn in session.turns:
+                if turn.on_host():
+                    continue
+                self._account(turn, -1)
+                if turn.device.type != 'cpu':
+                    turn.state_to('cpu')
+                    self._account(turn, +1)
+                else:
+                    turn.nbytes = 0 # state lives on the host already, nothing to spill to
+                    turn.state = None
+            session.turns = [t for t in session.turns if t.state is not None]
+            if len(session.turns) == 0:
+                self._drop(session)
+        for session in list(self.sessions.values()):
+            if self.host_used <= self.host_bytes:
+                break
+            if any(t.on_host() for t in session.turns):
+                self._drop(session)
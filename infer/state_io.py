@@ -0,0 +1,116 @@
+########################################################################################################
+# Versioned on-disk format for RWKV-7 states
+#
+#   magic b'RWKVSTAT' | u32 version | u32 header_len | JSON header | pad to 64 | tensor payload
+#
+# The header lists, per layer, att_x_prev / att_kv / ffn_x_prev with dtype, shape and payload offset
+# (64-byte aligned), plus a CRC32 of the payload. att_kv may be stored downcast to fp16/bf16; loading
+# upcasts it back to float32. Files can be loaded through a copy-on-write mmap without reading them.
+########################################################################################################
+
+import os, json, struct, zlib, mmap as _mmap
+import torch
+
+MAGIC = b'RWKVSTAT'
+FORMAT_VERSION = 1
+ALIGN = 64
+
+_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+_NAMES = ('att_x_prev', 'att_kv', 'ffn_x_prev') # state: 0=att_x_prev 1=att_kv 2=ffn_x_prev
+
+def _dtype_name(dtype):
+    for k, v in _DTYPES.items():
+        if v == dtype:
+            return k
+    raise ValueError(f"unsupported state dtype {dtype}")
+
+def _pad(n):
+    return (-n) % ALIGN
+
+def save_state(path, state, kv_dtype=None, meta=None):
+    """
+    Writes a single-sequence state (list of 3*n_layer tensors) to `path`, atomically.
+    kv_dtype: None keeps att_kv in float32, torch.float16 / torch.bfloat16 downcast it.
+    """
+    assert len(state) % 3 == 0
+    n_layer = len(state) // 3
+    entries, chunks, offset, crc = [], [], 0, 0
+    for j, t in enumerate(state):
+        if j % 3 == 1 and kv_dtype is not None:
+            t = t.to(kv_dtype)
+        t = t.detach().contiguous().cpu()
+        data = t.view(-1).view(torch.uint8).numpy().tobytes()
+        pad = b'\0' * _pad(len(data))
+        entries.append({
+            'name': f'blocks.{j // 3}.{_NAMES[j % 3]}',
+            'dtype': _dtype_name(t.dtype),
+            'shape': list(t.shape),
+            'offset': offset,
+            'nbytes': len(data),
+        })
+        for c in (data, pad):
+            chunks.append(c)
+            crc = zlib.crc32(c, crc)
+        offset += len(data) + len(pad)
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'n_layer': n_layer,
+        'n_embd': state[0].shape[-1],
+        'head_size': state[1].shape[-1],
+        'payload_bytes': offset,
+        'crc32': crc,
+        'tensors': entries,
+        'meta': meta or {},
+    }).encode('utf-8')
+    prefix = MAGIC + struct.pack('<II', FORMAT_VERSION, len(header)) + header
+    prefix += b'\0' * _pad(len(prefix))
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(prefix)
+        for c in chunks:
+            f.write(c)
+    os.replace(tmp, path)
+
+def read_header(buf):
+    if bytes(buf[:8]) != MAGIC:
+        raise ValueError("not an RWKV state file")
+    version, header_len = struct.unpack('<II', bytes(buf[8:16]))
+    if version > FORMAT_VERSION:
+        raise ValueError(f"state file version {version} is newer than supported ({FORMAT_VERSION})")
+    header = json.loads(bytes(buf[16:16 + header_len]).decode('utf-8'))
+    start = 16 + header_len
+    return header, start + _pad(start)
+
+def load_state(path, device='cpu', dtype=None, mmap=True, verify=True):
+    """
+    Reads a state file, returns (state, header). att_x_prev / ffn_x_prev are cast to `dtype` (if given)
+    and att_kv to float32, on `device`. With mmap=True the file is mapped copy-on-write, so tensors that
+    need no conversion share the page cache instead of being read up front.
+    """
+    with open(path, 'rb') as f:
+        if mmap:
+            buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY)
+        else:
+            buf = bytearray(f.read())
+    header, start = read_header(buf)
+    if verify:
+        crc = zlib.crc32(memoryview(buf)[start:start + header['payload_bytes']])
+        if crc != header['crc32']:
+            raise ValueError(f"state file {path} is corrupted (crc32 mismatch)")
+
+    state = []
+    for j, e in enumerate(header['tensors']):
+        t_dtype = _DTYPES[e['dtype']]
+        numel = 1
+        for d in e['shape']:
+            numel *= d
+        t = torch.frombuffer(buf, dtype=t_dtype, count=numel, offset=start + e['offset']).view(e['shape'])
+        target = torch.float32 if j % 3 == 1 else (dtype or t_dtype)
+        state.append(t.to(device=device, dtype=target))
+    return state, header
@@ -0,0 +1,97 @@
+########################################################################################################
+# Slab-allocated RWKV-7 states
+#
+# One preallocated buffer per state kind holds N slots, layer-major:
+#   x  [n_layer, 2, N, C]        att_x_prev / ffn_x_prev, model dtype
+#   kv [n_layer, N, H, 64, 64]   att_kv, float32
+# A slot is an index into N. Slots [0:B] of every layer are contiguous, so a decode batch kept in the
+# first B slots is passed to `RWKV.forward_batch` as views (no stacking, no copies), and the batched
+# kernels update it in place.
+########################################################################################################
+
+import heapq
+import torch
+
+class StatePool():
+    def __init__(self, model, n_slots):
+        ref = model.z['blocks.0.ln1.weight']
+        self.n_layer = model.n_layer
+        self.n_slots = n_slots
+        self.dtype = ref.dtype
+        self.device = ref.device
+        C, H, N = model.n_embd, model.n_head, model.head_size
+        self.x = torch.zeros((self.n_layer, 2, n_slots, C), dtype=self.dtype, device=self.device)
+        self.kv = torch.zeros((self.n_layer, n_slots, H, N, N), dtype=torch.float, device=self.device)
+        self.free_slots = list(range(n_slots)) # min-heap, so live slots stay packed at the front
+        self.used = set()
+
+    def alloc(self, zero=True):
+        """
+        Hands out the lowest free slot, reset to the zero state unless `zero` is False (the caller loads a
+        state into it right away, which overwrites every element anyway).
+        """
+        if not self.free_slots:
+            raise RuntimeError(f"state pool exhausted ({self.n_slots} slots)")
+        slot = heapq.heappop(self.free_slots)
+        self.used.add(slot)
+        if zero:
+            self.reset(slot)
+        return slot
+
+    def free(self, slot):
+        self.used.remove(slot)
+        heapq.heappush(self.free_slots, slot)
+
+    def reset(self, slot):
+        self.x[:, :, slot].zero_()
+        self.kv[:, slot].zero_()
+
+    def state(self, slot):
+        """
+        Single-sequence state of `slot`, as views into the pool.
+        """
+        out = []
+        for i in range(self.n_layer):
+            out += [self.x[i, 0, slot], self.kv[i, slot], self.x[i, 1, slot]]
+        return out
+
+    def batch(self, start, end=None):
+        """
+        Batched state of slots [start:end], as views into the pool (what `forward_batch` takes).
+        """
+        if end is None:
+            start, end = 0, start
+        out = []
+        for i in range(self.n_layer):
+            out += [self.x[i, 0, start:end], self.kv[i, start:end], self.x[i, 1, start:end]]
+        return out
+
+    def load(self, slot, state):
+        """
+        Copies a single-sequence state (list of 3*n_layer tensors) into `slot`.
+        """
+        for i in range(self.n_layer):
+            self.x[i, 0, slot].copy_(state[i*3+0])
+            self.kv[i, slot].copy_(state[i*3+1])
+            self.x[i, 1, slot].copy_(state[i*3+2])
+
+    def read(self, slot):
+        """
+        Copy of the state in `slot`, detached from the pool.
+        """
+        return [s.clone() for s in self.state(slot)]
+
+    def move(self, src, dst):
+        """
+        Moves the state in slot `src` to the free slot `dst` and frees `src`.
+        """
+        self.x[:, :, dst].copy_(self.x[:, :, src])
+        self.kv[:, dst].copy_(self.kv[:, src])
+        self.free_slots.remove(dst)
+        heapq.heapify(self.free_slots)
+        self.used.add(dst)
+        self.free(src)
+
+    @property
+    def nbytes(self):
+        return self.x.numel() * self.x.element_size() + self.kv.numel() * self.kv.element_size()
@@ -0,0 +1,74 @@
+########################################################################################################
+# Quantized storage for parked RWKV-7 states
+#
+# The float32 att_kv matrices ((H, 64, 64) per layer) dominate a state's size. They are stored as int8
+# or fp8 (e4m3) blocks with one float32 scale per head (or per head row), and dequantized on resume.
+# att_x_prev / ffn_x_prev are small and kept as they are.
+########################################################################################################
+
+import torch
+
+QUANT_MODES = {
+    'int8': (torch.int8, 127.0),
+    'fp8': (getattr(torch, 'float8_e4m3fn', None), 448.0),
+}
+
+class QuantizedState():
+    __slots__ = ('tensors', 'scales', 'mode')
+
+    def __init__(self, tensors, scales, mode):
+        self.tensors = tensors # x_prev tensors as-is, att_kv quantized
+        self.scales = scales # per att_kv entry: float32 scales, None for the others
+        self.mode = mode
+
+    @classmethod
+    def from_state(cls, state, mode='int8', granularity='head'):
+        """
+        granularity: 'head' -> one scale per (H) head block, 'row' -> one scale per head row.
+        """
+        qdtype, qmax = QUANT_MODES[mode]
+        if qdtype is None:
+            raise ValueError(f"torch {torch.__version__} has no fp8 dtype")
+        tensors, scales = [], []
+        for j, s in enumerate(state):
+            if j % 3 != 1:
+                tensors.append(s.clone())
+                scales.append(None)
+                continue
+            s = s.float()
+            if granularity == 'head':
+                amax = s.abs().amax(dim=(-2, -1), keepdim=True)
+            else:
+                amax = s.abs().amax(dim=-1, keepdim=True)
+            scale = (amax / qmax).clamp_min(1e-12)
+            q = s / scale
+            if mode == 'int8':
+                q = q.round_().clamp_(-qmax, qmax)
+            tensors.append(q.to(qdtype))
+            scales.append(scale)
+        return cls(tensors, scales, mode)
+
+    def dequantize(self, device=None):
+        state = []
+        for t, scale in zip(self.tensors, self.scales):
+            if scale is None:
+                state.append(t.to(device=device, copy=True))
+            else:
+                state.append(t.to(device=device).float() * scale.to(device=device))
+        return state
+
+    def to(self, device):
+        return QuantizedState([t.to(device) for t in self.tensors], [None if s is None else s.to(device) for s in self.scales], self.mode)
+
+    @property
+    def device(self):
+        return self.tensors[0].device
+
+    @property
+    def nbytes(self):
+        n = 0
+        for t, s in zip(self.tensors, self.scales):
+            n += t.numel() * t.element_size()
+            if s is not None:
+                n += s.numel() * s.element_size()
+        return n
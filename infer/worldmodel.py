@@ -12,39 +12,53 @@ print(torch.version.cuda)
 os.environ['RWKV_JIT_ON'] = '1'
 os.environ["RWKV_CUDA_ON"] = '1' # '1' to compile CUDA kernel (10x faster), requires c++ compiler & cuda libraries
 from infer.rwkv.model import RWKV # pip install rwkv
-from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS
+from infer.rwkv.utils import PIPELINE, PIPELINE_ARGS, build_prompt
 
+from infer.state_io import save_state, load_state
+from infer.checkpoint import load_checkpoint, peak_rss_mb
+from infer.encoder_cache import EncoderCache
 from world.registry import Projector_Registry, Encoder_Registry
 
 
 class Worldinfer():
-    def __init__(self, model_path, encoder_type, encoder_path, strategy='cuda bf16', args=None):
+    def __init__(self, model_path, encoder_type, encoder_path, strategy='cuda bf16', args=None, prefix_cache=None, encoder_cache=None, fused=False):
 
         ss = strategy.split(' ')
         DEVICE = ss[0]
-        if ss[1] == 'fp16':
+        self.DEVICE = DEVICE
+        prec = ss[1][:4] # e.g. 'bf16i4' -> bf16 activations, int4 weights
+        if prec == 'fp16':
             self.DTYPE = torch.half
-        elif ss[1] == 'fp32':
+        elif prec == 'fp32':
             self.DTYPE = torch.float32
-        elif ss[1] == 'bf16':
+        elif prec == 'bf16':
             self.DTYPE = torch.bfloat16
         else:
             assert False, "currently rwkv7 strategy must be: cuda/cpu fp16/fp32/bf16"
         
-        self.model_weight = torch.load(model_path + '.pth', map_location=DEVICE)
-        proj_dict = {}
-        llm_dict = {}
-        for key, value in self.model_weight.items():
-            if 'emb.weight' in key:
-                _, n_embd = value.shape
-            if key.startswith('proj.'):
-                k = key.replace('proj.', '', 1) 
-                proj_dict[k] = value 
-            elif key.startswith('llm.'):
-                k = key.replace('llm.', '', 1)
-                llm_dict[k] = value 
-        model = RWKV(model=llm_dict, strategy=strategy)
-        self.pipeline = PIPELINE(model, "wr_vocab_v20230424")
+        t0 = time.perf_counter()
+        if model_path.endswith('.safetensors'): # pre-converted, see infer/checkpoint.py
+            sections, _ = load_checkpoint(model_path, DEVICE)
+            llm_dict, proj_dict = sections['llm'], sections.get('proj', {})
+            del sections
+            n_embd = llm_dict['emb.weight'].shape[1]
+        else:
+            model_weight = torch.load(model_path + '.pth', map_location=DEVICE)
+            proj_dict = {}
+            llm_dict = {}
+            for key, value in model_weight.items():
+                if 'emb.weight' in key:
+                    _, n_embd = value.shape
+                if key.startswith('proj.'):
+                    k = key.replace('proj.', '', 1) 
+                    proj_dict[k] = value 
+                elif key.startswith('llm.'):
+                    k = key.replace('llm.', '', 1)
+                    llm_dict[k] = value 
+            del model_weight # RWKV converts llm_dict in place, the original tensors must not stay alive
+        model = RWKV(model=llm_dict, strategy=strategy, fused=fused)
+        print(f'loaded {model_path} in {time.perf_counter()-t0:.1f}s, peak RSS {peak_rss_mb():.0f} MB')
+        self.pipeline = PIPELINE(model, "wr_vocab_v20230424", prefix_cache=prefix_cache)
 
         if args==None:
             self.args = PIPELINE_ARGS(temperature = 1.0, top_p = 0.0, top_k=0, # top_k = 0 then ignore
@@ -68,6 +82,9 @@ class Worldinfer():
         }
         self.proj = Projector_Registry[encoder_type] (**proj_config).to('cuda', self.DTYPE)    
         self.proj.load_state_dict(proj_dict)
+        self.encoder_cache = encoder_cache
+        self.modality_kind = {'whisper': 'audio', 'speech': 'audio', 'video': 'video'}.get(encoder_type, 'image') # what feed() accepts
+        self.encoder_id = f'{encoder_type}|{encoder_path}|{model_path}|{self.DTYPE}' # projector weights come with the llm
 
     def process_wr(self, text, image = None):
         content = ''
@@ -81,14 +98,146 @@ class Worldinfer():
                 content+=replacement
         content = f'\x16User:{content}{text}\x17\x16Assistant:'
         return content
+
+    def build_prompt(self, text, image=None, image_tokens=576):
+        """
+        Token ids of process_wr(text, image) as a Prompt, with the placeholder spans recorded instead of
+        tokenizing "<|image_pad|>" * 576. image_tokens: tokens per image (or a list, one per image).
+        """
+        n = len(image) if image is not None else 0
+        counts = image_tokens if isinstance(image_tokens, (list, tuple)) else [image_tokens] * n
+        return build_prompt(self.pipeline.encode, ['\x16User:', *counts, f'{text}\x17\x16Assistant:'])
+
+    def save_state(self, path, state, kv_dtype=None, meta=None):
+        """
+        Persists a generate() state, e.g. to resume a session after a restart or on another replica.
+        kv_dtype=torch.float16 / torch.bfloat16 halves the file size.
+        """
+        save_state(path, state, kv_dtype=kv_dtype, meta=meta)
+
+    def load_state(self, path, mmap=True, verify=True):
+        state, header = load_state(path, device=self.DEVICE, dtype=self.DTYPE, mmap=mmap, verify=verify)
+        model = self.pipeline.model
+        if header['n_layer'] != model.n_layer or header['n_embd'] != model.n_embd:
+            raise ValueError(f"state file is for n_layer={header['n_layer']} n_embd={header['n_embd']}, "
+                             f"model has n_layer={model.n_layer} n_embd={model.n_embd}")
+        return state
+
+    def media_key(self, modality):
+        return EncoderCache.make_key(self.encoder_id, modality)
+
+    @torch.inference_mode()
+    def _encode(self, modality):
+        return self.proj(self.modality(modality))
+
+    def encode_modality(self, modality, key=None):
+        if self.encoder_cache is None:
+            return self._encode(modality)
+        if key is None:
+            key = self.media_key(modality)
+        return self.encoder_cache.get_or_compute(key, lambda: self._encode(modality))
+
+    def encode_batch(self, items):
+        """
+        encode_modality for several inputs (e.g. one per request, see infer/encoder_batcher.py). Images go
+        through the encoder as one batch; audio is encoded one clip at a time since whisper trims the output
+        to each clip's length. Cached inputs are not re-encoded.
+        """
+        out, todo = [None] * len(items), []
+        keys = [self.media_key(m) if self.encoder_cache is not None else None for m in items]
+        for i, key in enumerate(keys):
+            out[i] = self.encoder_cache.get(key) if key is not None else None
+            if out[i] is None:
+                todo.append(i)
+        if not todo:
+            return out
+        if self.modality_kind == 'audio':
+            feats = [self._encode(items[i]) for i in todo]
+        else:
+            groups = [list(items[i]) if isinstance(items[i], (list, tuple)) else [items[i]] for i in todo]
+            feats = self._encode([m for g in groups for m in g]).split([len(g) for g in groups])
+            if len(feats) > 1: # a cached view would keep the whole batch alive
+                feats = [x.clone() for x in feats]
+        for i, x in zip(todo, feats):
+            out[i] = x
+            if keys[i] is not None:
+                self.encoder_cache.put(keys[i], x)
+        return out
+
     def generate(self, text, modality=None, state=None):
+        key = None
         if modality is not None:
-            modality = self.proj(self.modality(modality))
+            if self.encoder_cache is not None or self.pipeline.prefix_cache is not None:
+                key = self.media_key(modality)
+            modality = self.encode_modality(modality, key)
             
-        text = self.process_wr(text, modality)
-        result, state = self.pipeline.generate(text, token_count=500, args=self.args, callback=None, state=state, sign=modality)
+        if modality is not None:
+            feats = modality if modality.dim() == 3 else modality.unsqueeze(0) # [images, tokens, C]
+            prompt = self.build_prompt(text, feats, image_tokens=feats.shape[1])
+        else:
+            prompt = self.process_wr(text)
+        result, state = self.pipeline.generate(prompt, token_count=500, args=self.args, callback=None, state=state, sign=modality, media_key=key)
         return result, state
 
+    def feed(self, text=None, image=None, audio=None, video=None, state=None):
+        """
+        Prefills one piece of a conversation or document into `state` (None starts a new one) and returns the
+        new state; the state passed in is left as it was. The image / audio comes first, as in process_wr, then
+        the text; role markers are part of the text. Only this piece's features are alive and the prefill is
+        chunked, so a long document fed page by page costs the memory of one page:
+
+            state = model.feed(text='\x16User:')
+            for page in pages:
+                state = model.feed(image=page, state=state)
+            state = model.feed(text='Summarize the document.', state=state)
+            answer, state = model.decode(state)
+
+        video (a file or a list of frames, 'video' encoder only) is sampled, deduplicated and capped by the
+        encoder's token budget, then fed one encoder batch of frames at a time.
+        """
+        if sum(m is not None for m in (image, audio, video)) > 1:
+            raise ValueError("feed one modality per call")
+        if video is not None:
+            if self.modality_kind != 'video':
+                raise ValueError(f"this model's encoder takes {self.modality_kind}, not video")
+            frames, bs = self.modality.select(video), self.modality.batch_size
+            for i in range(0, len(frames), bs):
+                state = self.feed(image=frames[i:i + bs], state=state)
+            return self.feed(text=text, state=state)
+        media = image if image is not None else audio
+        kind = 'image' if image is not None else 'audio'
+        if media is not None and kind != self.modality_kind and not (kind == 'image' and self.modality_kind == 'video'):
+            raise ValueError(f"this model's encoder takes {self.modality_kind}, not {kind}")
+
+        parts, sign, key = [], None, None
+        if media is not None:
+            if self.encoder_cache is not None or self.pipeline.prefix_cache is not None:
+                key = self.media_key(media)
+            sign = self.encode_modality(media, key)
+            feats = sign if sign.dim() == 3 else sign.unsqueeze(0) # [items, tokens, C]
+            parts += [feats.shape[1]] * feats.shape[0]
+        if text:
+            parts.append(text)
+        if not parts:
+            return state
+        if state is not None:
+            state = [s.clone() for s in state]
+        prompt = build_prompt(self.pipeline.encode, parts)
+        _, state = self.pipeline.forward_prompt(prompt, state, self.args, sign=sign, media_key=key)
+        return state
+
+    def decode(self, state, text='\x17\x16Assistant:', token_count=500, args=None, callback=None):
+        """
+        Generates from a state built with feed(): feeds `text` (by default the end of the user turn and the
+        assistant cue), then samples. Returns (text, state) like generate(); `state` itself is left as it was.
+        """
+        if not text:
+            raise ValueError("decode needs some text to feed, the next-token logits come from it")
+        if state is not None:
+            state = [s.clone() for s in state]
+        return self.pipeline.generate(text, token_count=token_count, args=args if args is not None else self.args,
+                                      callback=callback, state=state)
+
 
 # def process_wr(text, image = None):
 #     content = ''
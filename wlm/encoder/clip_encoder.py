@@ -62,7 +62,7 @@ class ClipEncoder(nn.Module):
 
         x= torch.from_numpy(self.image_processor(x)['pixel_values'][0]).to(self.device,dtype=torch.bfloat16)
 
-        x = self.model(x.unsqueeze(0), output_hidden_states=True).last_hidden_state
+        x = self.model(x.unsqueeze(0)).last_hidden_state
         
         x = self.adapter(x)
         
@@ -24,7 +24,7 @@ class SiglipEncoder(nn.Module):
 
     def forward(self, x):
         x= self.image_processor(x, return_tensors="pt")['pixel_values'].to(self.device,dtype=torch.bfloat16)
-        x = self.model(x, output_hidden_states=True).last_hidden_state
+        x = self.model(x).last_hidden_state # only the last layer is used, do not keep every hidden state
         return x
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@ import numpy as np
 
 from transformers import CLIPVisionModel, CLIPImageProcessor, CLIPVisionConfig
 
+from .preprocess import ImagePreprocessor
+
 
 
 class VisualAdapter(nn.Module):
@@ -54,15 +56,16 @@ class ClipEncoder(nn.Module):
 
         self.device = device
         self.image_processor = CLIPImageProcessor.from_pretrained(encoder_path)
+        self.preprocess = ImagePreprocessor.from_hf(self.image_processor)
         self.model = CLIPVisionModel.from_pretrained(encoder_path)
         self.encoder_dim = self.model.config.hidden_size
 
         self.adapter = VisualAdapter(self.encoder_dim, project_dim)
     def forward(self, x):
 
-        x= torch.from_numpy(self.image_processor(x)['pixel_values'][0]).to(self.device,dtype=torch.bfloat16)
+        x = self.preprocess(x, device=self.device, dtype=torch.bfloat16)[:1] # the first image, as before
 
-        x = self.model(x.unsqueeze(0), output_hidden_states=True).last_hidden_state
+        x = self.model(x).last_hidden_state
         
         x = self.adapter(x)
         
@@ -0,0 +1,89 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+
+# PIL resample codes used by the HF image processors
+RESAMPLE_MODES = {0: 'nearest', 2: 'bilinear', 3: 'bicubic'}
+
+
+def to_uint8_tensor(image):
+    """
+    [3, H, W] uint8 tensor from a PIL image, an HWC uint8 array or a CHW / HWC uint8 tensor.
+    """
+    if isinstance(image, torch.Tensor):
+        if image.dim() == 3 and image.shape[0] not in (1, 3) and image.shape[-1] in (1, 3):
+            image = image.permute(2, 0, 1)
+        return image.expand(3, -1, -1) if image.shape[0] == 1 else image
+    if hasattr(image, 'convert'): # PIL.Image
+        image = image.convert('RGB')
+    a = np.asarray(image)
+    if a.ndim == 2:
+        a = np.repeat(a[:, :, None], 3, axis=2)
+    return torch.from_numpy(np.ascontiguousarray(a)).permute(2, 0, 1)
+
+
+class ImagePreprocessor():
+    """
+    Torch replacement for SiglipImageProcessor / CLIPImageProcessor: resize, center crop, rescale and
+    normalize on the target device. Images of the same size are resized in one F.interpolate call;
+    antialiased bicubic is PIL's filter, and the result is rounded to uint8 levels like PIL's, so the
+    output matches the HF processor to within a level or two of a few pixels. Rescale and normalize are
+    one fused multiply-add.
+    """
+    def __init__(self, size, mean, std, shortest_edge=False, crop_size=None, resample='bicubic'):
+        self.size = size # (height, width), or the shortest edge when shortest_edge
+        self.shortest_edge = shortest_edge
+        self.crop_size = crop_size # (height, width) or None
+        self.resample = resample
+        mean, std = torch.tensor(mean, dtype=torch.float32), torch.tensor(std, dtype=torch.float32)
+        self.scale = (1 / (255 * std)).view(3, 1, 1) # x / 255 then (x - mean) / std
+        self.bias = (-mean / std).view(3, 1, 1)
+
+    @classmethod
+    def from_hf(cls, processor):
+        size, crop = processor.size, None
+        shortest_edge = 'shortest_edge' in size
+        size = size['shortest_edge'] if shortest_edge else (size['height'], size['width'])
+        if getattr(processor, 'do_center_crop', False):
+            crop = (processor.crop_size['height'], processor.crop_size['width'])
+        return cls(size, processor.image_mean, processor.image_std, shortest_edge, crop,
+                   RESAMPLE_MODES.get(int(processor.resample), 'bicubic'))
+
+    def output_size(self, h, w):
+        if not self.shortest_edge:
+            return self.size
+        short, long = (h, w) if h <= w else (w, h)
+        long = int(self.size * long / short)
+        return (self.size, long) if h <= w else (long, self.size)
+
+    def __call__(self, images, device='cpu', dtype=torch.float32):
+        """
+        [N, 3, H, W] pixel values of `images` (one image or a list) on `device`.
+        """
+        if isinstance(images, torch.Tensor) and images.dim() == 4:
+            images = list(images)
+        elif not isinstance(images, (list, tuple)):
+            images = [images]
+        images = [to_uint8_tensor(x) for x in images]
+        groups = {}
+        for i, x in enumerate(images):
+            groups.setdefault(tuple(x.shape[1:]), []).append(i)
+        out = [None] * len(images)
+        scale, bias = self.scale.to(device), self.bias.to(device)
+        for (h, w), idx in groups.items():
+            x = torch.stack([images[i] for i in idx]).to(device, non_blocking=True).float()
+            oh, ow = self.output_size(h, w)
+            if (oh, ow) != (h, w):
+                if self.resample == 'nearest':
+                    x = F.interpolate(x, size=(oh, ow), mode='nearest')
+                else:
+                    x = F.interpolate(x, size=(oh, ow), mode=self.resample, align_corners=False, antialias=True)
+                    x = x.round_().clamp_(0, 255)
+            if self.crop_size is not None:
+                ch, cw = self.crop_size
+                top, left = max((oh - ch) // 2, 0), max((ow - cw) // 2, 0)
+                x = x[:, :, top:top + ch, left:left + cw]
+            x = torch.addcmul(bias, x, scale)
+            for j, i in enumerate(idx):
+                out[i] = x[j]
+        return torch.stack(out).to(dtype)
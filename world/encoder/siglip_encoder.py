@@ -5,6 +5,8 @@ import numpy as np
 
 from transformers import AutoModel, SiglipImageProcessor
 
+from .preprocess import ImagePreprocessor
+
 class VisualAdapter(nn.Module):
     """
     2D Image to Patch Embedding
@@ -59,12 +61,13 @@ class SiglipEncoder(nn.Module):
         self.device = device
         self.model = AutoModel.from_pretrained(encoder_path).vision_model
         self.image_processor = SiglipImageProcessor.from_pretrained(encoder_path)
+        self.preprocess = ImagePreprocessor.from_hf(self.image_processor)
         self.encoder_dim = 768  #self.model.config.hidden_size
 
         # self.adapter = VisualAdapter(self.encoder_dim, project_dim)
     def forward(self, x):
-        x= self.image_processor(x, return_tensors="pt")['pixel_values'].to(self.device,dtype=torch.bfloat16)
-        x = self.model(x, output_hidden_states=True).last_hidden_state
+        x = self.preprocess(x, device=self.device, dtype=torch.bfloat16)
+        x = self.model(x).last_hidden_state # only the last layer is used, do not keep every hidden state
         return x
 
 
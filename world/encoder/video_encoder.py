@@ -0,0 +1,100 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+from PIL import Image
+
+from .siglip_encoder import SiglipEncoder
+
+
+class VideoEncoder(SiglipEncoder):
+    """
+    SigLIP over the frames of a video. `select(video)` turns a video file or a list of frames into the frames
+    worth encoding: sampled at `fps`, near-duplicates of the previous kept frame dropped (mean absolute
+    difference of 32x32 grayscale thumbnails below `dedup_threshold`), and thinned uniformly to the token
+    budget `max_tokens`. forward() encodes a list of frames in batches of `batch_size`.
+    """
+    def __init__(
+        self,
+        encoder_path,
+        project_dim,
+        fps=1.0,
+        dedup_threshold=0.02,
+        max_tokens=16384,
+        tokens_per_frame=576,
+        batch_size=16,
+        train_mode="adapter",
+        device="cuda",) -> None:
+        super(VideoEncoder, self).__init__(encoder_path, project_dim, train_mode=train_mode, device=device)
+        self.fps = fps
+        self.dedup_threshold = dedup_threshold
+        self.max_frames = max(1, max_tokens // tokens_per_frame)
+        self.batch_size = batch_size
+
+    def forward(self, x):
+        if not isinstance(x, (list, tuple)):
+            x = [x]
+        out = [super(VideoEncoder, self).forward(list(x[i:i + self.batch_size])) for i in range(0, len(x), self.batch_size)]
+        return torch.cat(out)
+
+    def iter_frames(self, video):
+        """
+        Frames of a video file sampled at `fps`, as RGB PIL images. A list of frames is taken as already sampled.
+        """
+        if isinstance(video, (list, tuple)):
+            for frame in video:
+                yield frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+            return
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError("reading video files needs opencv-python (or pass a list of frames)")
+        cap = cv2.VideoCapture(video)
+        if not cap.isOpened():
+            raise ValueError(f"cannot open video {video}")
+        step = max((cap.get(cv2.CAP_PROP_FPS) or self.fps) / self.fps, 1.0)
+        i, next_i = 0, 0.0
+        try:
+            while cap.grab():
+                if i >= next_i:
+                    ok, frame = cap.retrieve()
+                    if not ok:
+                        break
+                    yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                    next_i += step
+                i += 1
+        finally:
+            cap.release()
+
+    def select(self, video):
+        """
+        The frames of `video` to encode, in order, at most max_frames of them.
+        """
+        kept, last, stride, n = [], None, 1, 0
+        for frame in self.iter_frames(video):
+            thumb = np.asarray(frame.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float32) / 255
+            if last is not None and np.abs(thumb - last).mean() < self.dedup_threshold:
+                continue
+            last = thumb
+            n += 1
+            if (n - 1) % stride:
+                continue
+            kept.append(frame.convert('RGB'))
+            if len(kept) > 2 * self.max_frames: # keep memory bounded: halve what we have and the future rate
+                kept = kept[::2]
+                stride *= 2
+        if len(kept) > self.max_frames:
+            idx = np.linspace(0, len(kept) - 1, self.max_frames).round().astype(int)
+            kept = [kept[i] for i in idx]
+        return kept
+
+
+if __name__ == "__main__":
+    encoder_config = {
+        'encoder_path': '/home/rwkv/models/siglip2',
+        'project_dim' : 768
+    }
+    video = VideoEncoder(**encoder_config)
+    frames = video.select('/home/rwkv/data/video/test.mp4')
+    y = video(frames)
+    print(len(frames), y.shape)
@@ -5,9 +5,11 @@ from .encoder.speech_encoder import SpeechEncoder
 from .encoder.whisper_encoder import WhisperEncoder
 from .encoder.clip_encoder import ClipEncoder
 from .encoder.siglip_encoder import SiglipEncoder
+from .encoder.video_encoder import VideoEncoder
 
 Projector_Registry: Dict[str, Type[nn.Module]] = {
     "siglip": VisualAdapter,
+    "video": VisualAdapter, # SigLIP frames, same projector weights as "siglip"
     # "simple": SimpleProjection,
     # "mlp":    MLPAdapter,
 }
@@ -17,5 +19,6 @@ Encoder_Registry: Dict[str, Type[nn.Module]] = {
     "whisper": WhisperEncoder,
     "speech": SpeechEncoder,
     "siglip": SiglipEncoder,
+    "video": VideoEncoder,
 }
 
@@ -4,7 +4,7 @@ import torch
 import io
 # import soundfile as sf
 import numpy as np
-from infer.rwkv.utils import PIPELINE
+from infer.rwkv.utils import PIPELINE, build_prompt
 pipeline = PIPELINE('rwkv', "wr_vocab_v20230424")
 import torch.nn.functional as F
 
@@ -63,22 +63,15 @@ def process_vision_text(
         role = conv.get('from', '').lower()
         content = conv.get('value', '')
         if role in ['user','human']:
-            if "<image>" in content:
-                parts = content.split("<image>")
-                new_parts = []
-                for i in range(len(parts) - 1):
-                    new_parts.append(parts[i])
-                    replacement = (
-                        "<|vision_start|>"
-                        + f"<|image_pad|>" * image_token_length[visual_replicate_index_image]
-                        + "<|vision_end|>"
-                    )
-                    new_parts.append(replacement)
-                    visual_replicate_index_image += 1
-                new_parts.append(parts[-1])
-                content = "".join(new_parts)
-            question = f"\x16User:{content}\x17"
-            input = pipeline.encode(question)
+            # the image placeholders go in as ids (build_prompt), only the text is tokenized
+            parts = content.split("<image>")
+            new_parts = [f"\x16User:{parts[0]}"]
+            for part in parts[1:]:
+                new_parts.append(image_token_length[visual_replicate_index_image])
+                new_parts.append(part)
+                visual_replicate_index_image += 1
+            new_parts[-1] += "\x17"
+            input = list(build_prompt(pipeline.encode, new_parts))
             label = [IGNORE_INDEX]*len(input)
         elif role in ['assistant', 'gpt']:
             answer = f"\x16Assistant:{content}\x17"